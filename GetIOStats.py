@@ -6,6 +6,10 @@
 
 # https://www.kernel.org/doc/Documentation/ABI/testing/procfs-diskstats
 # https://www.kernel.org/doc/Documentation/iostats.txt
+# https://www.kernel.org/doc/Documentation/filesystems/proc.rst (/proc/<pid>/io)
+
+# Also usable as a module, see Collector:
+#   for _delta in GetIOStats.Collector("nvme*", 0.1).deltas(): ...
 
 import os
 import sys
@@ -13,15 +17,151 @@ import getopt
 import time
 from datetime import datetime
 import platform
+import threading
+import queue
+import struct
+import mmap
+import signal
+import math
+import re
+import fnmatch
+import heapq
+from array import array
+from itertools import islice, accumulate
+from collections import namedtuple
+import bisect
+import functools
+import http.server
+import gzip
+import lzma
+import bz2
+import multiprocessing
+import resource
+import errno
+
+try:
+    import numpy
+except ImportError:
+    # Post-processing falls back to the array module
+    numpy = None
 
 SCRIPT_VERSION = "0.5"
 HARDLIMIT_TIMETORUN = 120
 DEFAULT_TIMETORUN = 2
 DEFAULT_COLLECTIONINTERVAL = 0.025
 ENHANCED_KERNELVERSION = 2.6
-EXCLUDED_DEVICES = []
+# Left out of -d all, globs of EXCLUDED_DEVICES or names still select them
+EXCLUDED_DEVICES = ["fd*", "sr*", "loop*"]
+# Seconds between two checks of the device list for hotplugged or removed devices
+DEVICE_RESCAN_INTERVAL = 1.0
+# Captures: characters or bytes handed over to the writer thread at once (about 4096 lines),
+# seconds between two handovers at most, batches waiting at most
+CAPTURE_BATCH_SIZE = 512 * 1024
+CAPTURE_FLUSH_INTERVAL = 1.0
+CAPTURE_QUEUE_DEPTH = 64
+STAT_BUFFER_SIZE = 4096
+HAS_PREADV = hasattr(os, "preadv")
+# Binary capture: header, device dictionary, then fixed-width little-endian records of
+# monotonic ns timestamp, device id, padding and the counters as uint64
+CAPTURE_MAGIC = b"GIOSTAT1"
+CAPTURE_VERSION = 1
+CAPTURE_HEADER = struct.Struct("<8sHHIIqqI")
+CAPTURE_DEVICE = struct.Struct("<IIIH")
+STORE_CHUNK_ROWS = 65536
+STORE_COLUMNS = 13
+OUTPUT_HEADER = "date;time UTC;device;time (ms);delta time (ms);delta reads;delta writes;delta IOPS;delta Bytes read;delta Bytes written;delta Bytes;delta MBytes read;delta MBytes written;total MBytes;reads;writes;reads merged;writes merged;sector read;sector written;read time (ms);write time (ms);i/o in progress;time spent doing i/o (ms);weighted time spent doing i/o (ms);r_await (ms);w_await (ms);%util;avg queue size"
+OUTPUT_ROW_FORMAT = "%s;'%02d:%02d:%02d.%03d;%s;%d;%d;%d;%d;%d;%d;%d;%d;%s;%s;%s;%d;%d;%d;%d;%d;%d;%d;%d;%d;%d;%d;%.2f;%.2f;%.2f;%.2f"
+LIVE_HEADER = "time UTC      device        delta ms    reads   writes     IOPS    MB read MB written   total MB  r_await  w_await   %util  in progress"
+LIVE_ROW_FORMAT = "%-12s  %-12s %9d %8d %8d %8d %10.2f %10.2f %10.2f %8.2f %8.2f %7.2f %12d"
+LIVE_HEADER_ROWS = 40
+LIVE_FORMATS = ("term", "csv")
+# Streaming quantiles: 1% relative accuracy, about 1400 buckets at most from 0.001 to 1e9
+SKETCH_ACCURACY = 0.01
+SKETCH_GAMMA = (1 + SKETCH_ACCURACY) / (1 - SKETCH_ACCURACY)
+SKETCH_LOG_GAMMA = math.log(SKETCH_GAMMA)
+SKETCH_MIN_VALUE = 0.001
+SUMMARY_QUANTILES = (0.5, 0.95, 0.99)
+SUMMARY_HEADER = "device;metric;samples;p50;p95;p99;max"
+# Collector overhead: wake up lateness histogram bucket limits (microseconds), slowest ticks listed
+OVERHEAD_LATENESS_BUCKETS = (50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000, 100000)
+OVERHEAD_SLOWEST_TICKS = 20
+# Resampling of existing logs: default bucket (seconds), lines read per chunk (bytes hint)
+DEFAULT_RESAMPLE_BUCKET = 1.0
+RESAMPLE_CHUNK_SIZE = 4 * 1024 * 1024
+# Log file names: <host>_<device>_<date>_<sector size>.log and <host>_all_<date>.log, resampled or not
+LOG_NAME = re.compile(r"^([^_]+)_(.+?)_(\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2}(?:-\d{3}-\d+)?)(?:_(\d+))?(?:_resampled_[0-9.]+s)?\.log(?:\.gz|\.xz|\.bz2)?$")
+# Compressed logs: codec name, file extension and module. Logs are written by a background thread
+# in blocks of LOG_WRITE_BATCH bytes at most, LOG_QUEUE_DEPTH blocks waiting at most.
+LOG_CODECS = (("gzip", ".gz", gzip), ("xz", ".xz", lzma), ("bz2", ".bz2", bz2))
+LOG_WRITE_BATCH = 1024 * 1024
+LOG_QUEUE_DEPTH = 16
+# Sidecar index of the logs (<log>.idx): byte offset of one row every LOG_INDEX_ROWS rows
+LOG_INDEX_ROWS = 1024
+LOG_INDEX_MAGIC = "GetIOStats index"
+# Flight recorder: seconds kept before a trigger and sampled after it
+DEFAULT_FLIGHT_BEFORE = 60
+DEFAULT_FLIGHT_AFTER = 30
+FLIGHT_RECORD = struct.Struct("<QII" + "Q" * 11)
+# Largest flight recorder ring buffer, in bytes
+FLIGHT_MAX_RING_SIZE = 1024 * 1024 * 1024
+# Per-process I/O: full /proc listing interval (seconds), PIDs tried one by one between two
+# listings above which a listing is done instead, /proc/<pid>/io read buffer
+PROCESS_RESCAN_INTERVAL = 10.0
+PROCESS_MAX_PROBES = 4096
+PROCESS_IO_BUFFER_SIZE = 256
+DEFAULT_PID_MAX = 32768
+PROCESS_HEADER = "date;time UTC;pid;time (ms);delta time (ms);command;delta read bytes;delta write bytes;delta syscr;delta syscw;read bytes;write bytes;syscr;syscw"
+# Open files kept free when the soft limit is raised for files kept open
+OPEN_FILES_MARGIN = 64
+# Post-processing worker processes, 0 for one per CPU
+DEFAULT_WORKERS = 1
+# Adaptive sampling: IOPS threshold when none is given, seconds below the thresholds before
+# going back to the base interval
+DEFAULT_ADAPTIVE_IOPS = 100
+DEFAULT_ADAPTIVE_COOLDOWN = 5
+# OpenMetrics exporter: default address, metrics path and content type
+DEFAULT_EXPORT_ADDRESS = "127.0.0.1"
+EXPORT_PATH = "/metrics"
+EXPORT_CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+# Exported metrics: name and help, for counters the index in IOSample.counters and the scale
+# to the unit of the name (None: sectors, scaled by the sector size of the device)
+EXPORT_COUNTERS = (("getiostats_reads", "Reads completed", 0, 1),
+                   ("getiostats_reads_merged", "Reads merged", 1, 1),
+                   ("getiostats_read_bytes", "Bytes read", 2, None),
+                   ("getiostats_read_time_seconds", "Time spent reading", 3, 0.001),
+                   ("getiostats_writes", "Writes completed", 4, 1),
+                   ("getiostats_writes_merged", "Writes merged", 5, 1),
+                   ("getiostats_written_bytes", "Bytes written", 6, None),
+                   ("getiostats_write_time_seconds", "Time spent writing", 7, 0.001),
+                   ("getiostats_io_time_seconds", "Time spent doing I/Os", 9, 0.001),
+                   ("getiostats_weighted_io_time_seconds", "Weighted time spent doing I/Os", 10, 0.001))
+EXPORT_GAUGES = (("getiostats_read_iops", "Reads per second over the last tick"),
+                 ("getiostats_write_iops", "Writes per second over the last tick"),
+                 ("getiostats_read_bytes_per_second", "Bytes read per second over the last tick"),
+                 ("getiostats_written_bytes_per_second", "Bytes written per second over the last tick"),
+                 ("getiostats_read_await_seconds", "Average read time over the last tick"),
+                 ("getiostats_write_await_seconds", "Average write time over the last tick"),
+                 ("getiostats_utilization_ratio", "Fraction of the last tick spent doing I/Os"),
+                 ("getiostats_queue_size", "Average queue size over the last tick"),
+                 ("getiostats_ios_in_progress", "I/Os in progress"))
 
 kernel_version = 2.5
+# Statistics are read below this root, empty for the running system
+stats_root = ""
+# Codec of the log files written, None for plain text
+log_compression = None
+# In-memory samples handed to the post-processing workers, which inherit them when forked
+compute_samples = None
+# Positions of the samples of each device in the capture, inherited by the workers the same way
+compute_index = None
+
+# Options of -a/--adaptive, -f/--flightrecorder and --query, and the parsed command line
+AdaptiveOptions = namedtuple("AdaptiveOptions", ("baseInterval", "burstIops", "burstBytes", "burstInFlight", "cooldown"))
+FlightOptions = namedtuple("FlightOptions", ("before", "after", "triggerIops", "triggerAwait", "triggerFile"))
+QueryOptions = namedtuple("QueryOptions", ("start", "end", "filter"))
+ScriptArguments = namedtuple("ScriptArguments", ("device", "timeToRun", "interval", "intervalUnit", "stream", "binary", "convert", "live",
+                                                 "flightRecorder", "root", "profile", "resample", "bucket", "merge", "align", "output",
+                                                 "query", "queryOptions", "export", "compression", "adaptive", "workers", "processes"))
 
 
 def parse_script_arguments(arg_args):
@@ -31,20 +171,43 @@ def parse_script_arguments(arg_args):
     _timeToRun = 0
     _collectionInterval = 0
     _collectionIntervalUnit = "ms"
+    _stream = False
+    _binary = False
+    _convert = None
+    _live = None
+    _flightRecorder = None
+    _export = None
+    _compression = None
+    _adaptive = None
+    _workers = DEFAULT_WORKERS
+    _processes = None
+    _adaptiveOptions = AdaptiveOptions(None, None, None, None, DEFAULT_ADAPTIVE_COOLDOWN)
+    _root = ""
+    _profile = False
+    _resample = []
+    _bucket = DEFAULT_RESAMPLE_BUCKET
+    _merge = []
+    _align = None
+    _output = None
+    _query = None
+    _queryOptions = QueryOptions(None, None, None)
+    _flightOptions = FlightOptions(DEFAULT_FLIGHT_BEFORE, DEFAULT_FLIGHT_AFTER, None, None, None)
 
     try:
-        _options, arg_args = getopt.getopt(arg_args,"hd:p:t:i:",["device=","partition=","timetorun=","interval="])
+        _options, arg_args = getopt.getopt(arg_args,"hd:p:t:i:sbc:l:fr:e:z:a:w:",["device=","partition=","timetorun=","interval=","stream","binary","convert=","live=","root=","profile","export=","compress=","workers=","processes=","adaptive=","burst-iops=","burst-bytes=","burst-inflight=","cooldown=","resample=","bucket=","merge=","align=","output=","query=","start=","end=","filter=",
+                                                                      "flightrecorder","before=","after=","trigger-iops=","trigger-await=","trigger-file="])
     except getopt.GetoptError:
         show_help()
         sys.exit(2)
 
-    if len(_options) > 1:
+    if len(_options) > 0:
         for _option, _argument in _options:
             if _option == '-h':
                 show_help()
                 sys.exit(2)
             elif _option in ("-d", "--device"):
-                _device = _argument.lower()
+                # Regular expressions are case sensitive
+                _device = ",".join(x if x.lstrip("!").startswith("re:") else x.lower() for x in _argument.split(","))
             elif _option in ("-p", "--partition"):
                 # not used yet
                 _partition = _argument.lower()
@@ -56,7 +219,7 @@ def parse_script_arguments(arg_args):
                 _timeToRun = _argument
                 if _timeToRun[len(_timeToRun)-1:len(_timeToRun)].upper() == "H":
                     _timeToRun = int(_timeToRun[0:(len(_timeToRun) - 1)]) * 60
-                if _timeToRun[len(_timeToRun)-1:len(_timeToRun)].upper() == "M":
+                elif _timeToRun[len(_timeToRun)-1:len(_timeToRun)].upper() == "M":
                     _timeToRun = int(_timeToRun[0:(len(_timeToRun) - 1)])
                 else:
                     print("")
@@ -64,18 +227,176 @@ def parse_script_arguments(arg_args):
                     show_help()
                     sys.exit(2)
             elif _option in ("-i", "--interval"):
-                _collectionInterval = _argument
+                _collectionInterval = float(_argument)
                 if _collectionInterval < 1:
                     _collectionIntervalUnit = "milliseconds"
                 elif _collectionInterval > 1:
                     _collectionIntervalUnit = "seconds"
                 else:
                     _collectionIntervalUnit = "second"
+            elif _option in ("-s", "--stream"):
+                _stream = True
+            elif _option in ("-b", "--binary"):
+                _stream = True
+                _binary = True
+            elif _option in ("-c", "--convert"):
+                _convert = _argument
+            elif _option in ("-l", "--live"):
+                _live = _argument.lower()
+                if _live not in LIVE_FORMATS:
+                    print ("")
+                    print ("Please specify term or csv with -l/--live.")
+                    show_help()
+                    sys.exit(2)
+            elif _option in ("-r", "--root"):
+                _root = _argument
+                if not os.path.isdir(_root):
+                    print ("")
+                    print ("Please specify an existing directory with -r/--root.")
+                    show_help()
+                    sys.exit(2)
+            elif _option == "--resample":
+                _resample.append(_argument)
+            elif _option == "--bucket":
+                try:
+                    _bucket = float(_argument)
+                except ValueError:
+                    _bucket = 0
+                if _bucket <= 0:
+                    print ("")
+                    print ("Please specify a bucket size in seconds with --bucket.")
+                    show_help()
+                    sys.exit(2)
+            elif _option == "--merge":
+                _merge.append(_argument)
+            elif _option == "--align":
+                try:
+                    _align = float(_argument)
+                except ValueError:
+                    _align = 0
+                if _align <= 0:
+                    print ("")
+                    print ("Please specify a bucket size in seconds with --align.")
+                    show_help()
+                    sys.exit(2)
+            elif _option == "--output":
+                _output = _argument
+            elif _option == "--query":
+                _query = _argument
+            elif _option in ("--start", "--end", "--filter"):
+                _queryOptions = _queryOptions._replace(**{_option[2:]: _argument})
+            elif _option == "--profile":
+                _profile = True
+            elif _option in ("-a", "--adaptive", "--burst-iops", "--burst-bytes", "--burst-inflight", "--cooldown"):
+                _index = ("--adaptive", "--burst-iops", "--burst-bytes", "--burst-inflight", "--cooldown").index("--adaptive" if _option == "-a" else _option)
+                if _index == 0:
+                    _adaptive = True
+                try:
+                    _value = float(_argument)
+                except ValueError:
+                    _value = -1
+                if _value < 0 or (_index == 0 and _value == 0):
+                    print ("")
+                    print ("Please specify a positive number of seconds, IOPS, bytes per second or I/Os with " + _option + ".")
+                    show_help()
+                    sys.exit(2)
+                _adaptiveOptions = _adaptiveOptions._replace(**{AdaptiveOptions._fields[_index]: _value})
+            elif _option in ("-w", "--workers"):
+                try:
+                    _workers = int(_argument)
+                except ValueError:
+                    _workers = -1
+                if _workers < 0:
+                    print ("")
+                    print ("Please specify a number of worker processes with -w/--workers, 0 for one per CPU.")
+                    show_help()
+                    sys.exit(2)
+            elif _option == "--processes":
+                _processes = ",".join(x for x in _argument.split(",") if x)
+                if not _processes:
+                    print ("")
+                    print ("Please specify all, PIDs or command names with --processes.")
+                    show_help()
+                    sys.exit(2)
+            elif _option in ("-z", "--compress"):
+                _compression = _argument.lower()
+                if _compression not in [x[0] for x in LOG_CODECS]:
+                    print ("")
+                    print ("Please specify gzip, xz or bz2 with -z/--compress.")
+                    show_help()
+                    sys.exit(2)
+            elif _option in ("-e", "--export"):
+                # [address:]port, localhost unless an address is given
+                _address, _port = _argument.rpartition(":")[::2]
+                try:
+                    _export = (_address.strip("[]") or DEFAULT_EXPORT_ADDRESS, int(_port))
+                except ValueError:
+                    _export = None
+                if _export is None or not 0 <= _export[1] <= 65535:
+                    print ("")
+                    print ("Please specify a port, or an address and a port, with -e/--export.")
+                    show_help()
+                    sys.exit(2)
+            elif _option in ("-f", "--flightrecorder"):
+                _flightRecorder = True
+            elif _option in ("--before", "--after", "--trigger-iops", "--trigger-await"):
+                _index = ("--before", "--after", "--trigger-iops", "--trigger-await").index(_option)
+                try:
+                    _value = float(_argument)
+                except ValueError:
+                    _value = -1
+                if _value < 0 or (_index == 0 and _value == 0):
+                    print ("")
+                    print ("Please specify a positive number of seconds, IOPS or milliseconds with " + _option + ".")
+                    show_help()
+                    sys.exit(2)
+                _flightOptions = _flightOptions._replace(**{FlightOptions._fields[_index]: _value})
+            elif _option == "--trigger-file":
+                _flightOptions = _flightOptions._replace(triggerFile=_argument)
     else:
         show_help()
         sys.exit(2)
 
-    if _device is not None or _partition is not None:
+    if _flightRecorder is not None:
+        _flightRecorder = _flightOptions
+    if _adaptive is not None:
+        _adaptive = _adaptiveOptions
+
+    if _flightRecorder is None and _flightOptions != (DEFAULT_FLIGHT_BEFORE, DEFAULT_FLIGHT_AFTER, None, None, None):
+        print ("")
+        print ("--before, --after and --trigger-* options are only used with -f/--flightrecorder.")
+        show_help()
+        sys.exit(2)
+    if _flightRecorder is not None and (_stream or _live is not None):
+        print ("")
+        print ("-f/--flightrecorder cannot be combined with -s/--stream, -b/--binary or -l/--live.")
+        show_help()
+        sys.exit(2)
+    if _adaptive is None and _adaptiveOptions != (None, None, None, None, DEFAULT_ADAPTIVE_COOLDOWN):
+        print ("")
+        print ("--burst-* and --cooldown options are only used with -a/--adaptive.")
+        show_help()
+        sys.exit(2)
+    if _adaptive is not None and _adaptive[1:4] == (None, None, None):
+        _adaptive = _adaptive._replace(burstIops=DEFAULT_ADAPTIVE_IOPS)
+    if _export is not None and (_stream or _live is not None or _flightRecorder is not None):
+        print ("")
+        print ("-e/--export cannot be combined with -s/--stream, -b/--binary, -l/--live or -f/--flightrecorder.")
+        show_help()
+        sys.exit(2)
+
+    if _processes is not None and (_flightRecorder is not None or _export is not None):
+        print ("")
+        print ("--processes cannot be combined with -f/--flightrecorder or -e/--export.")
+        show_help()
+        sys.exit(2)
+
+    if (_device is not None or _partition is not None) and (_flightRecorder is not None or _export is not None):
+        # Runs until stopped, the time to run limit does not apply
+        _timeToRun = 0
+        if _collectionInterval == 0:
+            _collectionInterval = DEFAULT_COLLECTIONINTERVAL
+    elif _device is not None or _partition is not None:
         if _timeToRun == 0:
             _timeToRun = DEFAULT_TIMETORUN
         elif _timeToRun > HARDLIMIT_TIMETORUN:
@@ -85,13 +406,32 @@ def parse_script_arguments(arg_args):
             sys.exit(2)
         if _collectionInterval == 0:
             _collectionInterval = DEFAULT_COLLECTIONINTERVAL
+    elif _convert is not None:
+        if not os.path.isfile(_convert):
+            print ("")
+            print ("Please specify an existing binary capture file with -c/--convert.")
+            show_help()
+            sys.exit(2)
+    elif _resample or _merge or _query is not None:
+        for _item in _resample + _merge + ([_query] if _query is not None else []):
+            if not os.path.isfile(_item):
+                print ("")
+                print ("Please specify existing log files with --resample, --merge or --query.")
+                show_help()
+                sys.exit(2)
     else:
         print ("")
         print ("Please specify an existing device with -d/--device or an existing partition with -/--partition.")
         show_help()
         sys.exit(2)
 
-    return [_device, _timeToRun, _collectionInterval, _collectionIntervalUnit]
+    if _adaptive is not None and _adaptive.baseInterval <= _collectionInterval:
+        print ("")
+        print ("Please specify a base interval larger than the -i/--interval value with -a/--adaptive.")
+        show_help()
+        sys.exit(2)
+
+    return ScriptArguments(_device, _timeToRun, _collectionInterval, _collectionIntervalUnit, _stream, _binary, _convert, _live, _flightRecorder, _root, _profile, _resample, _bucket, _merge, _align, _output, _query, _queryOptions, _export, _compression, _adaptive, _workers, _processes)
 
 
 def verify_device_exists(_device):
@@ -113,7 +453,17 @@ def verify_device_exists(_device):
 
 def show_help():
     print ("")
-    print ("get_io_stats.py -d <device(s)|all> -t <time to run (H|M)> -i <interval (seconds)>")
+    print ("get_io_stats.py -d <device(s)|all> -t <time to run (H|M)> -i <interval (seconds)> [-s|-b|-l <term|csv>]")
+    print ("get_io_stats.py -c <binary capture file> [-w <worker processes>]")
+    print ("get_io_stats.py --resample <log file> [--resample <log file>...] [--bucket <seconds>]")
+    print ("get_io_stats.py --merge <log file> [--merge <log file>...] [--align <seconds>] [--output <file>]")
+    print ("get_io_stats.py --query <log file> [--start <time>] [--end <time>] [--filter <device(s)>] [--output <file>]")
+    print ("get_io_stats.py -d <device(s)|all> -t <time to run (H|M)> -r <root of the proc and sys trees>")
+    print ("get_io_stats.py -d <device(s)|all> -t <time to run (H|M)> -z <gzip|xz|bz2>")
+    print ("get_io_stats.py -d <device(s)|all> -t <time to run (H|M)> -i <interval (seconds)> -a <base interval (seconds)> [--burst-iops <n>] [--burst-bytes <n>] [--burst-inflight <n>] [--cooldown <s>]")
+    print ("get_io_stats.py -d <device(s)|all> -t <time to run (H|M)> -i <interval (seconds)> --processes <all|PID(s)|command(s)>")
+    print ("get_io_stats.py -d <device(s)|all> -i <interval (seconds)> -e [<address>:]<port>")
+    print ("get_io_stats.py -d <device(s)|all> -i <interval (seconds)> -f [--before <s>] [--after <s>] [--trigger-iops <n>] [--trigger-await <ms>] [--trigger-file <path>]")
     print ("Version: " + SCRIPT_VERSION)
     print ("")
     print ("Collect I/O statistics from devices or partitions on Linux systems.")
@@ -125,24 +475,53 @@ def show_help():
     print ("get_io_stats.py -d all -t 1H -i 1")
     print (" -> Collect I/O statistics for sdc and sdb devices during 15 minutes with default interval (1 second)")
     print ("get_io_stats.py -d sdc,sdb -t 15M")
+    print (" -> Devices can be selected with globs, regular expressions (re:) and major:minor, ! excludes")
+    print ("    fd*, sr* and loop* devices are left out of all unless selected by name or pattern")
+    print ("get_io_stats.py -d 'nvme*n1,dm-*,8:*,!zram*' -t 15M")
+    print ("get_io_stats.py -d 're:^sd[a-z]$' -t 15M")
+    print (" -> Collect I/O statistics for all devices during 2 hours, streaming samples to disk during the capture")
+    print ("get_io_stats.py -d all -t 2H -i 0.025 -s")
+    print (" -> Same capture in the compact binary format, converted to the usual log files at the end. The devices")
+    print ("    are the ones present at the first tick, devices appearing later are not captured")
+    print ("get_io_stats.py -d all -t 2H -i 0.025 -b")
+    print (" -> Watch I/O statistics of sdc live in the terminal, nothing is kept once displayed")
+    print ("get_io_stats.py -d sdc -t 30M -i 1 -l term")
+    print (" -> Stream live I/O statistics of all disks as CSV on stdout, messages go to stderr")
+    print ("get_io_stats.py -d all -t 1H -i 0.1 -l csv > live.csv")
+    print (" -> Same capture with gzip compressed log files, --resample, --merge and --query read them as they are")
+    print ("get_io_stats.py -d all -t 2H -i 0.025 -b -z gzip")
+    print (" -> Sample every second, every 25ms from the tick where a disk is above 500 IOPS or 50MB/s until 10 seconds after,")
+    print ("    the delta time column follows the interval")
+    print ("get_io_stats.py -d all -t 2H -i 0.025 -s -a 1 --burst-iops 500 --burst-bytes 52428800 --cooldown 10")
+    print (" -> Same capture with the read and written bytes and syscalls of each process from /proc/<pid>/io, at the same")
+    print ("    timestamps as the disk samples, in a _processes_ log. Command names take globs and regular expressions (re:)")
+    print ("get_io_stats.py -d all -t 1H -i 0.5 -s --processes all")
+    print ("get_io_stats.py -d sdc -t 15M -i 0.1 --processes 'postgres,mysqld,1234'")
+    print (" -> Convert an existing binary capture to the usual log files")
+    print ("get_io_stats.py -c myhost_capture_2024-01-01_10-00-00.bin")
+    print (" -> Post-processing in 8 worker processes, each computing the logs of a share of the devices from their")
+    print ("    samples only, -w 0 runs one per CPU. By default (-w 1) it runs in the main process")
+    print ("get_io_stats.py -d all -t 1H -i 0.025 -b -w 8")
+    print (" -> Resample a 25ms capture log to 10 second buckets with the sum, mean and max of the delta columns")
+    print ("get_io_stats.py --resample myhost_sdc_2024-01-01_10-00-00_512.log --bucket 10")
+    print (" -> Merge the _all_ logs of several hosts in time order, timestamps aligned on a 25ms grid")
+    print ("get_io_stats.py --merge node1_all_2024-01-01_10-00-00.log --merge node2_all_2024-01-01_10-00-01.log --align 0.025 --output incident.log")
+    print (" -> Rows of sdb and sdc between 10:15:00 and 10:15:30 from an _all_ log, on stdout")
+    print ("get_io_stats.py --query myhost_all_2024-01-01_10-00-00.log --start 10:15:00 --end 10:15:30 --filter sdb,sdc")
+    print (" -> Profile the collector itself with cProfile, the profile is written next to the log files")
+    print ("get_io_stats.py -d all -t 10M -i 0.025 --profile")
+    print (" -> Collect I/O statistics from a copy of /proc and /sys, /tmp/fixture/proc/diskstats and so on")
+    print ("get_io_stats.py -d all -t 1M -i 0.1 -r /tmp/fixture")
+    print (" -> Run as a flight recorder until stopped, log 2 minutes before and 30 seconds after kill -USR1 <pid>,")
+    print ("    a touch of /tmp/dump, or any disk above 5000 IOPS or 50ms await")
+    print ("get_io_stats.py -d all -i 0.1 -f --before 120 --after 30 --trigger-file /tmp/dump --trigger-iops 5000 --trigger-await 50")
+    print (" -> Run as an exporter until stopped, OpenMetrics counters and rates of the last tick on http://127.0.0.1:9555/metrics")
+    print ("get_io_stats.py -d all -i 1 -e 9555")
     print ("")
 
 
 def init():
 
-    EXCLUDED_DEVICES.append('fd0')
-    EXCLUDED_DEVICES.append('sr0')
-    EXCLUDED_DEVICES.append('loop0')
-    EXCLUDED_DEVICES.append('loop1')
-    EXCLUDED_DEVICES.append('loop2')
-    EXCLUDED_DEVICES.append('loop3')
-    EXCLUDED_DEVICES.append('loop4')
-    EXCLUDED_DEVICES.append('loop5')
-    EXCLUDED_DEVICES.append('loop6')
-    EXCLUDED_DEVICES.append('loop7')
-    EXCLUDED_DEVICES.append('loop8')
-    EXCLUDED_DEVICES.append('loop9')
-
     kernel_version_temp = platform.release().replace('"', '')
     return float(kernel_version_temp.split('.')[0] + '.' + kernel_version_temp.split('.')[1])
 
@@ -152,6 +531,7 @@ def update_progressbar(arg_title, arg_iteration, arg_total):
     _length = 20
     _fill = "#"
 
+    arg_total = max(arg_total, 1)
     _percent = ("{0:." + str(2) + "f}").format(100 * (arg_iteration / float(arg_total)))
     _filledLength = int(_length * arg_iteration / arg_total)
     _bar = _fill * _filledLength + '-' * (_length - _filledLength)
@@ -160,396 +540,2885 @@ def update_progressbar(arg_title, arg_iteration, arg_total):
     sys.stdout.flush()
 
 
-def get_device_sector_size(_device):
+def get_device_sector_size(_device, _root=None):
     
     _sectorSize = 512
     
     try:
-        with open("/sys/block/%s/queue/hw_sector_size" % _device, "rt") as f:
+        with open(stats_path("/sys/block/%s/queue/hw_sector_size" % _device, _root), "rt") as f:
             return int(f.read())
     except (IOError, ValueError):
         # Defaukt is 512 bytes since 2.4 kernels
         return _sectorSize
 
 
-def get_io_stats(_device, _interval, _captureTimeMin):
+@functools.lru_cache(maxsize=16)
+def day_date(arg_day):
+    # "YYYY-MM-DD" of a day since the epoch
+    return datetime.utcfromtimestamp(arg_day * 86400).strftime('%Y-%m-%d')
+
+
+def wall_time_fields(arg_wallNs):
+
+    # UTC date, "HH:MM:SS.mmm" time and ms of the day of a wall clock time in ns, truncated to the
+    # ms on integers, so the text and binary captures of a tick get the same timestamp
+    _day, _totalTime = divmod(arg_wallNs // 1000000, 86400000)
+    return (day_date(_day), "%02d:%02d:%02d.%03d" % (_totalTime // 3600000, _totalTime // 60000 % 60, _totalTime // 1000 % 60, _totalTime % 1000),
+            _totalTime)
+
+
+class TickScheduler(object):
+    # Fixed-rate scheduler sleeping until absolute time.monotonic_ns() deadlines, so that the
+    # time spent reading and parsing statistics does not add up to the collection interval.
+    # A tick started after its deadline is an overrun, deadlines skipped altogether are missed.
+
+    def __init__(self, arg_interval):
+        self.intervalNs = max(1, int(round(arg_interval * 1000000000)))
+        self.ticks = 0
+        self.overruns = 0
+        self.missed = 0
+        # Last tick: its deadline, time actually slept and wake up time after the deadline
+        self.deadlineNs = 0
+        self.sleptNs = 0
+        self.lateNs = 0
+        self.start()
+
+    def start(self):
+        # Wall clock is read once, tick timestamps are derived from the monotonic clock.
+        # Deadlines count from now, the first tick is due at once.
+        self._startNs = time.monotonic_ns()
+        self._wallStartNs = time.time_ns()
+        self._deadlineNs = self._startNs
+
+    def wait(self):
+        _nowNs = time.monotonic_ns()
+        _overrun = _nowNs >= self._deadlineNs
+        self.sleptNs = 0
+        if not _overrun:
+            time.sleep((self._deadlineNs - _nowNs) / 1000000000.0)
+            _wokenNs = time.monotonic_ns()
+            self.sleptNs = _wokenNs - _nowNs
+            _nowNs = _wokenNs
+        self.lateNs = _nowNs - self._deadlineNs
+        if _overrun and self.ticks > 0:
+            self.overruns += 1
+            _skipped = (_nowNs - self._deadlineNs) // self.intervalNs
+            self.missed += _skipped
+            self._deadlineNs += _skipped * self.intervalNs
+        self.ticks += 1
+        self.deadlineNs = self._deadlineNs
+        self._deadlineNs += self.intervalNs
+        return _nowNs
+
+    def wall_time_ns(self, arg_monotonicNs):
+        return self._wallStartNs + (arg_monotonicNs - self._startNs)
+
+    def set_interval(self, arg_interval):
+        # Next deadline becomes the last one plus the new interval
+        _intervalNs = max(1, int(round(arg_interval * 1000000000)))
+        self._deadlineNs += _intervalNs - self.intervalNs
+        self.intervalNs = _intervalNs
+
+    def timestamp(self, arg_monotonicNs):
+        # "YYYY-MM-DD HH:MM:SS.mmm" UTC, as written in the raw samples
+        _date, _time, _totalTime = wall_time_fields(self.wall_time_ns(arg_monotonicNs))
+        return _date + " " + _time
+
+
+class CollectorOverhead(object):
+    # Cost of the collector itself at each tick: reading the statistics, parsing and appending
+    # them, the sleep actually obtained and the wake up lateness against the deadline. Only
+    # distributions and the slowest ticks are kept, so memory does not grow with the run.
+
+    def __init__(self, arg_scheduler):
+        self._scheduler = arg_scheduler
+        self.read = QuantileSketch()
+        self.append = QuantileSketch()
+        self.sleep = QuantileSketch()
+        self.late = QuantileSketch()
+        self.lateness = [0] * (len(OVERHEAD_LATENESS_BUCKETS) + 1)
+        self._slowest = []
+        self.start()
+
+    def start(self):
+        self._startTimes = os.times()
+        self._startNs = time.monotonic_ns()
+
+    def add(self, arg_tickNs, arg_readNs, arg_appendNs):
+        _lateNs = max(0, self._scheduler.lateNs)
+        self.read.add(arg_readNs / 1000000.0)
+        self.append.add(arg_appendNs / 1000000.0)
+        self.sleep.add(self._scheduler.sleptNs / 1000000.0)
+        self.late.add(_lateNs / 1000000.0)
+        _bucket = 0
+        while _bucket < len(OVERHEAD_LATENESS_BUCKETS) and _lateNs >= OVERHEAD_LATENESS_BUCKETS[_bucket] * 1000:
+            _bucket += 1
+        self.lateness[_bucket] += 1
+
+        # Ticks whose statistics were read last after their deadline
+        _tick = (_lateNs + arg_readNs, arg_tickNs, _lateNs, arg_readNs, arg_appendNs)
+        if len(self._slowest) < OVERHEAD_SLOWEST_TICKS:
+            heapq.heappush(self._slowest, _tick)
+        elif _tick > self._slowest[0]:
+            heapq.heapreplace(self._slowest, _tick)
+
+    def metrics(self):
+        return [("read (ms)", self.read), ("parse/append (ms)", self.append), ("sleep (ms)", self.sleep), ("late (ms)", self.late)]
+
+    def format(self):
+        _times = os.times()
+        _user = _times[0] - self._startTimes[0]
+        _system = _times[1] - self._startTimes[1]
+        _elapsed = (time.monotonic_ns() - self._startNs) / 1000000000.0
+        _lines = ["Collector: %d ticks in %.1f seconds at a %.3f ms interval, %d overrun(s), %d missed tick(s)"
+                  % (self._scheduler.ticks, _elapsed, self._scheduler.intervalNs / 1000000.0, self._scheduler.overruns, self._scheduler.missed),
+                  "CPU: %.2f s user, %.2f s system, %.2f%% of one CPU" % (_user, _system, 100.0 * (_user + _system) / _elapsed if _elapsed > 0 else 0.0),
+                  ""]
+        _lines += format_io_summary([("collector", self)])
+
+        _lines += ["", "wake up late (ms);ticks;%"]
+        _total = max(1, sum(self.lateness))
+        _lower = 0
+        for _limit, _count in zip(OVERHEAD_LATENESS_BUCKETS + (None,), self.lateness):
+            _range = "%g-%g" % (_lower / 1000.0, _limit / 1000.0) if _limit is not None else ">=%g" % (_lower / 1000.0)
+            _lines.append("%s;%d;%.2f" % (_range, _count, 100.0 * _count / _total))
+            _lower = _limit
+
+        _lines += ["", "slowest ticks, time UTC;late (ms);read (ms);parse/append (ms)"]
+        for _cost, _tickNs, _lateNs, _readNs, _appendNs in sorted(self._slowest, reverse=True):
+            _lines.append("%s;%.3f;%.3f;%.3f" % (self._scheduler.timestamp(_tickNs), _lateNs / 1000000.0, _readNs / 1000000.0, _appendNs / 1000000.0))
+        return _lines
+
+    def write(self, arg_path):
+        # Created exclusively: a run started in the same second writes arg_path with -1, -2...
+        # before the extension instead of overwriting it. Returns the path written.
+        _lines = self.format()
+        _base, _extension = os.path.splitext(arg_path)
+        _count = 0
+        while True:
+            try:
+                f = open(arg_path, "x")
+                break
+            except FileExistsError:
+                _count += 1
+                arg_path = _base + "-" + str(_count) + _extension
+        with f:
+            f.write("\n".join(_lines) + "\n")
+        print (" " + _lines[1])
+        print (" Collector overhead (jitter histogram, slowest ticks) written to " + arg_path)
+        return arg_path
+
+
+class CaptureWriter(object):
+    # Files fed by the sampling or compute loop and written by a background thread, so the loop
+    # never waits on disk I/O nor on a codec. Data is handed over in batches of arg_batchSize
+    # characters or bytes, and every arg_flushInterval seconds if given, through a bounded queue
+    # that keeps memory flat if the disk cannot keep up.
+    # A capture is one file, opened at once and appended with append(). write(path, data) writes
+    # several files opened by arg_open, truncated the first time with arg_truncate: consecutive
+    # batches of a file go to the same stream and a file written again later gets a stream
+    # appended to it, which the codecs read back as one. Only one file is open at a time.
+    _threadName = "capture-writer"
+
+    def __init__(self, arg_path=None, arg_binary=False, arg_batchSize=CAPTURE_BATCH_SIZE, arg_flushInterval=CAPTURE_FLUSH_INTERVAL,
+                 arg_open=open, arg_truncate=False, arg_queueDepth=CAPTURE_QUEUE_DEPTH):
+        self.path = arg_path
+        self.count = 0
+        self.error = None
+        self._binary = arg_binary
+        self._join = b"".join if arg_binary else "".join
+        self._open = arg_open
+        self._truncate = arg_truncate
+        self._batch = []
+        self._batchPath = arg_path
+        self._batchBytes = 0
+        self._batchSize = arg_batchSize
+        self._flushInterval = arg_flushInterval
+        self._lastHandoff = time.monotonic()
+        self._queue = queue.Queue(arg_queueDepth)
+        self._written = set()
+        self._filePath = None
+        self._file = None
+        if arg_path is not None:
+            # A capture that cannot be written fails before sampling starts
+            self._file = self._open_file(arg_path)
+        self._thread = threading.Thread(target=self._drain, name=self._threadName)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def append(self, arg_data):
+        self._batch.append(arg_data)
+        self._batchBytes += len(arg_data)
+        self.count += 1
+        if self._batchBytes >= self._batchSize or (self._flushInterval is not None and time.monotonic() - self._lastHandoff >= self._flushInterval):
+            self._handoff()
+
+    def write(self, arg_path, arg_data):
+        if arg_path != self._batchPath:
+            self._handoff()
+            self._batchPath = arg_path
+        self.append(arg_data)
+
+    def close(self):
+        self._handoff()
+        self._queue.put(None)
+        self._thread.join()
+        try:
+            if self._file is not None:
+                self._file.close()
+        except (IOError, OSError) as e:
+            self.error = self.error or e
+        if self.error is not None:
+            raise self.error
+
+    def _handoff(self):
+        if self._batch:
+            self._queue.put((self._batchPath, self._join(self._batch)))
+            self._batch = []
+            self._batchBytes = 0
+        self._lastHandoff = time.monotonic()
+
+    def _open_file(self, arg_path):
+        _file = self._open(arg_path, "wb" if self._truncate and arg_path not in self._written else "ab")
+        self._written.add(arg_path)
+        self._filePath = arg_path
+        return _file
+
+    def _drain(self):
+        while True:
+            _item = self._queue.get()
+            if _item is None:
+                break
+            if self.error is not None:
+                # Keep draining so the loops are never blocked on a full queue
+                continue
+            try:
+                if _item[0] != self._filePath:
+                    if self._file is not None:
+                        self._file.close()
+                        self._file = None
+                    self._file = self._open_file(_item[0])
+                self._file.write(_item[1] if self._binary else _item[1].encode("ascii"))
+                if self._flushInterval is not None:
+                    self._file.flush()
+            except (IOError, OSError) as e:
+                self.error = e
+
+
+class CaptureList(list):
+    # In-memory capture: the samples, and the topology of the devices when the capture started
+    topology = None
+
+
+class CaptureFile(object):
+    # Read side of a capture file, can be iterated several times without loading it in memory
+
+    def __init__(self, arg_path, arg_count=None):
+        self.path = arg_path
+        self.topology = read_capture_topology(arg_path)
+        self._count = arg_count
+
+    def __len__(self):
+        if self._count is None:
+            self._count = sum(1 for _ in self)
+        return self._count
+
+    def __iter__(self):
+        with open(self.path, "r") as f:
+            for line in f:
+                yield line
+
+
+class StatReader(object):
+    # Statistics file kept open and re-read with pread() at offset 0 into a reused buffer,
+    # instead of an open/read/close sequence and a text-mode decode on every tick.
+
+    def __init__(self, arg_path, arg_prefix="", arg_bufferSize=STAT_BUFFER_SIZE):
+        self.path = arg_path
+        self.prefix = arg_prefix
+        self._fd = os.open(arg_path, os.O_RDONLY)
+        self._buffer = bytearray(arg_bufferSize)
+        self._view = memoryview(self._buffer)
+
+    def read(self):
+        while True:
+            if HAS_PREADV:
+                _size = os.preadv(self._fd, [self._buffer], 0)
+            else:
+                _data = os.pread(self._fd, len(self._buffer), 0)
+                _size = len(_data)
+                self._buffer[:_size] = _data
+            if _size < len(self._buffer):
+                return str(self._view[:_size], "ascii")
+            # Buffer is full so the content may be truncated, grow it and read again
+            self._view.release()
+            self._buffer = bytearray(len(self._buffer) * 2)
+            self._view = memoryview(self._buffer)
+
+    def read_line(self):
+        # /sys/block/*/stat content prefixed to look like a /proc/diskstats line
+        return self.prefix + self.read()
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+def stats_path(arg_path, arg_root=None):
+
+    # /proc and /sys paths below arg_root or -r/--root, a copy of them or synthetic trees for benchmarks
+    _root = stats_root if arg_root is None else arg_root
+    return _root.rstrip("/") + arg_path if _root else arg_path
+
+
+def discard_message(arg_message):
+    # Message sink of the collector classes when used as a module, the script passes print
+    pass
 
-    _timeToRun = _captureTimeMin * 60 * float(1/_interval)
-    _stats = []
-    _timeRunning = 0
 
-    if len(_device.split(",")) > 1:
-        print (" Capturing I/O usage for multiple disks...")
-        _devices = []
-        if len(_device.split(",")) > 1:
-            for _item in _device.split(","):
-                # Create device dict
-                _devices.append(_item)
-        while _timeRunning <= int(_timeToRun):
-            _diskStatsfile = open("/proc/diskstats", "r")
-            for line in _diskStatsfile:
-                if any(x in line.split() for x in _devices):
-                    if line.split()[2] not in EXCLUDED_DEVICES and line.split()[3] not in EXCLUDED_DEVICES:
-                        # Do not capture excuded devices
-                        _stats.append(datetime.utcnow().strftime('%Y-%m-%d') + " " + datetime.utcnow().strftime('%H:%M:%S.%f')[:-3] + " " + line)
+def get_device_stat_path(_device, _root=None):
+
+    # Partitions are not directly under /sys/block but all block devices are in /sys/class/block
+    if os.path.exists(stats_path("/sys/block/" + _device + "/stat", _root)):
+        return stats_path("/sys/block/" + _device + "/stat", _root)
+    return stats_path("/sys/class/block/" + _device + "/stat", _root)
+
+
+def get_device_numbers(_device, _root=None):
+
+    with open(os.path.join(os.path.dirname(get_device_stat_path(_device, _root)), "dev"), "r") as f:
+        _major, _minor = f.read().strip().split(":")
+    return int(_major), int(_minor)
+
+
+def read_sysfs_attribute(arg_path, arg_default=None):
+
+    try:
+        with open(arg_path, "r") as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return arg_default
+
+
+class BlockDevice(object):
+    # /sys/block entry: disk is the parent disk of a partition, slaves and holders link the
+    # devices of dm and md stacks. Queue attributes are the ones of the disk for a partition.
+    __slots__ = ("name", "major", "minor", "disk", "slaves", "holders", "virtual",
+                 "sectorSize", "logicalBlockSize", "rotational", "queueDepth", "scheduler")
+
+
+class BlockTopology(object):
+    # Snapshot of /sys/block taken once: disks and their partitions, stacked devices with their
+    # slaves and holders, and the queue attributes, so sysfs is not read again per device.
+    # Rollups are series summing the counters of several devices at each tick:
+    #  stack_<top>  lowest level devices of a dm/md stack (RAID members, LVM physical volumes)
+    #  disk_<disk>  partitions of a disk when the disk itself is not captured
+    # Only groups of at least 2 captured devices are made, others would repeat a device series.
+    # With arg_path, the snapshot is the one written by write(), e.g. with a capture, along with
+    # the device selection (-d) it was written for if any.
+
+    def __init__(self, arg_path=None):
+        self.devices = {}
+        self.selection = None
+        if arg_path is not None:
+            self._load(arg_path)
+            return
+        _root = stats_path("/sys/block")
+        try:
+            _names = sorted(os.listdir(_root))
+        except OSError:
+            _names = []
+        for _name in _names:
+            _path = os.path.join(_root, _name)
+            _disk = self._add(_name, _path, None)
+            try:
+                _entries = sorted(os.listdir(_path))
+            except OSError:
+                continue
+            for _entry in _entries:
+                if os.path.isfile(os.path.join(_path, _entry, "partition")):
+                    self._add(_entry, os.path.join(_path, _entry), _disk)
+
+    def _add(self, arg_name, arg_path, arg_disk):
+        _device = BlockDevice()
+        _device.name = arg_name
+        _numbers = read_sysfs_attribute(os.path.join(arg_path, "dev"), "0:0").split(":")
+        _device.major, _device.minor = int(_numbers[0]), int(_numbers[-1])
+        _device.disk = arg_disk.name if arg_disk is not None else None
+        _device.slaves = self._list(os.path.join(arg_path, "slaves"))
+        _device.holders = self._list(os.path.join(arg_path, "holders"))
+        if arg_disk is None:
+            _queue = os.path.join(arg_path, "queue")
+            _device.virtual = "/virtual/" in os.path.realpath(arg_path)
+            _device.sectorSize = int(read_sysfs_attribute(os.path.join(_queue, "hw_sector_size"), "512"))
+            _device.logicalBlockSize = int(read_sysfs_attribute(os.path.join(_queue, "logical_block_size"), "512"))
+            _device.rotational = read_sysfs_attribute(os.path.join(_queue, "rotational"), "")
+            _device.queueDepth = read_sysfs_attribute(os.path.join(_queue, "nr_requests"), "")
+            # "mq-deadline [none]": the active scheduler is between brackets
+            _scheduler = read_sysfs_attribute(os.path.join(_queue, "scheduler"), "")
+            _device.scheduler = _scheduler[_scheduler.find("[") + 1:_scheduler.find("]")] if "[" in _scheduler else _scheduler
+        else:
+            for _attribute in ("virtual", "sectorSize", "logicalBlockSize", "rotational", "queueDepth", "scheduler"):
+                setattr(_device, _attribute, getattr(arg_disk, _attribute))
+        self.devices[arg_name] = _device
+        return _device
+
+    def _list(self, arg_path):
+        try:
+            return sorted(os.listdir(arg_path))
+        except OSError:
+            return []
+
+    def _load(self, arg_path):
+        with open(arg_path, "r") as f:
+            for line in f:
+                if line.startswith("selection;"):
+                    self.selection = line.rstrip("\n")[len("selection;"):]
                     continue
-            _timeRunning += 1
-            _diskStatsfile.close()
-            time.sleep(_interval)
+                _fields = line.rstrip("\n").split(";")
+                if len(_fields) != 11 or _fields[0] == "device":
+                    continue
+                _device = BlockDevice()
+                _device.name = _fields[0]
+                _numbers = _fields[1].split(":")
+                _device.major, _device.minor = int(_numbers[0]), int(_numbers[-1])
+                _device.disk = _fields[2] or None
+                _device.slaves = _fields[3].split(",") if _fields[3] else []
+                _device.holders = _fields[4].split(",") if _fields[4] else []
+                _device.virtual = _fields[5] == "1"
+                _device.sectorSize = int(_fields[6])
+                _device.logicalBlockSize = int(_fields[7])
+                _device.rotational, _device.queueDepth, _device.scheduler = _fields[8:11]
+                self.devices[_device.name] = _device
+
+    def sector_sizes(self):
+        return dict((x.name, x.sectorSize) for x in self.devices.values())
+
+    def sector_size(self, arg_devices):
+        # Sector size of a group: the one of its devices when they all have the same, 512 otherwise
+        _sizes = set(self.devices[x].sectorSize for x in arg_devices)
+        return _sizes.pop() if len(_sizes) == 1 else 512
+
+    def rollups(self, arg_selected):
+        # [(group, [devices])] for the captured devices arg_selected
+        _groups = []
+
+        # Stacks are the connected devices through slaves links
+        _stackOf = {}
+        for _name in sorted(self.devices):
+            _device = self.devices[_name]
+            if not _device.slaves or _name in _stackOf:
+                continue
+            _stack = set()
+            _pending = [_name]
+            while _pending:
+                _item = _pending.pop()
+                if _item in _stack or _item not in self.devices:
+                    continue
+                _stack.add(_item)
+                _pending.extend(self.devices[_item].slaves)
+                _pending.extend(self.devices[_item].holders)
+            for _item in _stack:
+                _stackOf[_item] = _stack
+            _tops = sorted(x for x in _stack if self.devices[x].slaves and not self.devices[x].holders)
+            _members = sorted(x for x in _stack if not self.devices[x].slaves and x in arg_selected)
+            if len(_members) > 1:
+                _groups.append(("stack_" + (_tops or sorted(_stack))[0], _members))
+
+        for _name in sorted(self.devices):
+            _device = self.devices[_name]
+            if _device.disk is not None or _device.virtual or _name in arg_selected:
+                continue
+            _partitions = sorted(x.name for x in self.devices.values() if x.disk == _name and x.name in arg_selected)
+            if len(_partitions) > 1:
+                _groups.append(("disk_" + _name, _partitions))
+        return _groups
+
+    def write(self, arg_path, arg_selection=None):
+        with open(arg_path, "w") as f:
+            if arg_selection is not None:
+                f.write("selection;" + arg_selection + "\n")
+            f.write("device;major:minor;disk;slaves;holders;virtual;sector size;logical block size;rotational;nr_requests;scheduler\n")
+            for _name in sorted(self.devices):
+                _device = self.devices[_name]
+                f.write("%s;%d:%d;%s;%s;%s;%d;%d;%d;%s;%s;%s\n" % (_name, _device.major, _device.minor, _device.disk or "", ",".join(_device.slaves),
+                        ",".join(_device.holders), int(_device.virtual), _device.sectorSize, _device.logicalBlockSize,
+                        _device.rotational, _device.queueDepth, _device.scheduler))
+
+
+def capture_topology_path(arg_path):
+    # Topology snapshot and device selection of a capture, next to the capture file
+    return arg_path + ".topology"
+
+
+def read_capture_topology(arg_path):
+    # None for a capture without a snapshot (older captures)
+    try:
+        return BlockTopology(capture_topology_path(arg_path))
+    except (IOError, OSError):
+        return None
+
+
+def is_device_pattern(arg_item):
+    return arg_item == "all" or arg_item.startswith("re:") or ":" in arg_item or any(x in arg_item for x in "*?[")
+
+
+def compile_device_pattern(arg_pattern):
+
+    # Match function of a device name and its "major:minor"
+    if arg_pattern.startswith("re:"):
+        _search = re.compile(arg_pattern[3:]).search
+        return lambda arg_name, arg_numbers: _search(arg_name) is not None
+    _match = re.compile(fnmatch.translate("*" if arg_pattern == "all" else arg_pattern)).match
+    if ":" in arg_pattern:
+        return lambda arg_name, arg_numbers: _match(arg_numbers) is not None
+    return lambda arg_name, arg_numbers: _match(arg_name) is not None
+
+
+class DeviceSelector(object):
+    # -d/--device compiled once: comma separated device names, globs (nvme*n1, dm-*), regular
+    # expressions (re:^sd[a-z]$), major:minor (8:0, 259:*) and negations (!loop*), "all" being "*".
+    # A device is selected when it matches a name or pattern and no negation. Devices matching
+    # EXCLUDED_DEVICES are not selected by "all" or by negations alone.
+
+    def __init__(self, arg_device):
+        self.text = arg_device
+        self.names = []
+        self._all = False
+        self._include = []
+        self._exclude = []
+        for _item in arg_device.split(","):
+            _negate = _item.startswith("!")
+            _item = _item.lstrip("!")
+            if not _item:
+                continue
+            if _negate:
+                self._exclude.append(compile_device_pattern(_item))
+            elif _item in ("all", "*"):
+                self._all = True
+            elif is_device_pattern(_item):
+                self._include.append(compile_device_pattern(_item))
+            elif _item not in self.names:
+                self.names.append(_item)
+        if not self.names and not self._include:
+            # Negations only: all other devices
+            self._all = True
+        self._excluded = [compile_device_pattern(x) for x in EXCLUDED_DEVICES]
+
+    @property
+    def single(self):
+        return self.explicit and len(self.names) == 1 and not self._exclude
+
+    @property
+    def explicit(self):
+        # Only device names, no pattern to resolve
+        return not self._all and not self._include
+
+    def matches(self, arg_name, arg_major, arg_minor):
+        _numbers = "%d:%d" % (arg_major, arg_minor)
+        if any(x(arg_name, _numbers) for x in self._exclude):
+            return False
+        if arg_name in self.names or any(x(arg_name, _numbers) for x in self._include):
+            return True
+        return self._all and not any(x(arg_name, _numbers) for x in self._excluded)
+
+
+class DiskStatsSource(object):
+    # /proc/diskstats lines of the selected devices. The selection is resolved to line positions
+    # once and again only when the device list changes, a tick just picks lines by position.
+    # A change is seen at once: the number of lines changes, or a line no longer starts with the
+    # major, minor and name it had when resolved (startswith on each line, nothing is split).
+
+    def __init__(self, arg_selector, arg_log=discard_message, arg_root=None):
+        self._selector = arg_selector
+        self._log = arg_log
+        self._reader = StatReader(stats_path("/proc/diskstats", arg_root))
+        self._positions = []
+        self._names = None
+        self._prefixes = None
+
+    def read(self):
+        _lines = self._reader.read().splitlines(True)
+        if self._prefixes is None or len(_lines) != len(self._prefixes) or not all(map(str.startswith, _lines, self._prefixes)):
+            self._resolve(_lines)
+        return [_lines[i] for i in self._positions]
+
+    def close(self):
+        self._reader.close()
+
+    def _resolve(self, arg_lines):
+        _positions = []
+        _names = []
+        _prefixes = []
+        for _index, line in enumerate(arg_lines):
+            _fields = line.split(None, 3)
+            # Up to the name and the space after it, so sda is not taken for sdaa
+            _prefixes.append(line[:len(line) - len(_fields[3])] if len(_fields) > 3 else line)
+            if len(_fields) > 3 and self._selector.matches(_fields[2], int(_fields[0]), int(_fields[1])):
+                _positions.append(_index)
+                _names.append(_fields[2])
+        if self._names is not None and _names != self._names:
+            self._log(" Device list changed, capturing: " + ", ".join(_names))
+        self._positions = _positions
+        self._names = _names
+        self._prefixes = _prefixes
+
+
+class DeviceStatSource(object):
+    # /sys/block/<device>/stat files of the devices named in the selection, kept open and read in
+    # one pass per tick. With arg_prefix the lines get the major, minor and device name so that
+    # they look like /proc/diskstats lines. Missing or removed devices are looked for again every
+    # DEVICE_RESCAN_INTERVAL and captured if they come back.
+
+    def __init__(self, arg_selector, arg_prefix=True, arg_log=discard_message, arg_root=None):
+        self._prefix = arg_prefix
+        self._log = arg_log
+        self._root = arg_root
+        self._readers = []
+        self._names = []
+        self._missing = []
+        self._rescanNs = 0
+        for _item in arg_selector.names:
+            if not self._open(_item):
+                self._log(" Device " + _item + " not found, it will be captured if it appears.")
+                self._missing.append(_item)
+
+    def read(self):
+        if self._missing and time.monotonic_ns() >= self._rescanNs:
+            self._rescan()
+        try:
+            return [_reader.read_line() for _reader in self._readers]
+        except (IOError, OSError):
+            # A device was removed
+            _lines = []
+            for _reader, _item in list(zip(self._readers, self._names)):
+                try:
+                    _lines.append(_reader.read_line())
+                except (IOError, OSError):
+                    self._log(" Device " + _item + " removed, it will be captured if it comes back.")
+                    _reader.close()
+                    self._readers.remove(_reader)
+                    self._names.remove(_item)
+                    self._missing.append(_item)
+            return _lines
+
+    def close(self):
+        for _reader in self._readers:
+            _reader.close()
+
+    def _open(self, arg_device):
+        try:
+            _major, _minor = get_device_numbers(arg_device, self._root)
+            self._readers.append(StatReader(get_device_stat_path(arg_device, self._root), "%4d %7d %s " % (_major, _minor, arg_device) if self._prefix else ""))
+        except (IOError, OSError, ValueError):
+            return False
+        self._names.append(arg_device)
+        return True
+
+    def _rescan(self):
+        for _item in list(self._missing):
+            if self._open(_item):
+                self._log(" Device " + _item + " found, capturing it.")
+                self._missing.remove(_item)
+        self._rescanNs = time.monotonic_ns() + int(DEVICE_RESCAN_INTERVAL * 1000000000)
+
+
+def open_tick_source(_device, _log=discard_message, _root=None, _kernel=None):
+
+    # ValueError when the single device selected does not exist. Statistics below _root, the one
+    # of -r/--root by default, for the _kernel version, the one of kernel_version by default.
+    if _kernel is None:
+        _kernel = kernel_version
+    _selector = DeviceSelector(_device)
+    if _selector.single:
+        _log(" Capturing I/O usage for a single disk...")
+        if _kernel >= ENHANCED_KERNELVERSION:
+            _log(" Capturing from /sys/block")
+            _source = DeviceStatSource(_selector, False, _log, _root)
+            if not _source.read():
+                _source.close()
+                raise ValueError("No device found matching criteria: " + _device)
+            return _source
+        _log(" Capturing from /proc/diskstats")
+        return DiskStatsSource(_selector, _log, _root)
+
+    if _selector.explicit:
+        _log(" Capturing I/O usage for multiple disks...")
+        if _kernel >= ENHANCED_KERNELVERSION:
+            _log(" Capturing from /sys/block")
+            return DeviceStatSource(_selector, True, _log, _root)
+        _log(" Capturing from /proc/diskstats")
+        return DiskStatsSource(_selector, _log, _root)
 
     if _device == "all":
-        print (" Capturing I/O usage for all disks...")
-        while _timeRunning <= int(_timeToRun):
-            _diskStatsfile = open("/proc/diskstats", "r")
-            for line in _diskStatsfile:
-                if line.split()[2] not in EXCLUDED_DEVICES and line.split()[3] not in EXCLUDED_DEVICES:
-                    # Do not capture excuded devices
-                    _stats.append(datetime.utcnow().strftime('%Y-%m-%d') + " " + datetime.utcnow().strftime('%H:%M:%S.%f')[:-3] + " " + line)
-            _timeRunning += 1
-            _diskStatsfile.close()
-            time.sleep(_interval)
+        _log(" Capturing I/O usage for all disks...")
     else:
-        print (" Capturing I/O usage for a single disk...")
-        # if partition: /sys/block/[device]/[partion]/stat
-
-        if kernel_version >= ENHANCED_KERNELVERSION:
-            print (" Capturing from /sys/block")
-            while _timeRunning <= int(_timeToRun):
-                _diskStatsfile = open('/sys/block/' + _device + '/stat', "r")
-                for line in _diskStatsfile:
-                    _stats.append(datetime.utcnow().strftime('%Y-%m-%d') + " " + datetime.utcnow().strftime('%H:%M:%S.%f')[:-3] + " " + line)
-                _timeRunning += 1
-                time.sleep(_interval)
-                _diskStatsfile.close()
+        _log(" Capturing I/O usage for devices matching " + _device + "...")
+    return DiskStatsSource(_selector, _log, _root)
+
+
+def split_stat_line(arg_line, arg_device):
+
+    # Tick source line as device, major, minor and counters (still as strings)
+    _fields = arg_line.split()
+    if len(_fields) > 2 and not _fields[2].isdigit():
+        return _fields[2], int(_fields[0]), int(_fields[1]), _fields[3:]
+    # /sys/block/<device>/stat content of a single device
+    return arg_device, None, None, _fields
+
+
+def iterate_tick_samples(arg_wallNs, arg_lines, arg_device):
+
+    # Tick source lines as IOSample, with the date and time of the tick shared by all devices.
+    # Lines with fewer than 11 counters (2.6.0 to 2.6.24 partitions) are left out.
+    _date, _time, _totalTime = wall_time_fields(arg_wallNs)
+    for line in arg_lines:
+        _device, _major, _minor, _counters = split_stat_line(line, arg_device)
+        if len(_counters) >= 11:
+            yield IOSample(_date, _time, _device, _totalTime, [int(x) for x in _counters[:11]])
+
+
+def iterate_records(arg_records, arg_devices, arg_wallOffsetNs):
+
+    # (monotonic ns, device id, padding, counters...) records as IOSample, with the UTC date
+    # and time a text capture would have
+    _lastNs = None
+    for _record in arg_records:
+        if _record[0] != _lastNs:
+            _lastNs = _record[0]
+            _date, _time, _totalTime = wall_time_fields(arg_wallOffsetNs + _lastNs)
+        yield IOSample(_date, _time, arg_devices[_record[1]][0], _totalTime, list(_record[3:14]))
+
+
+class BinaryCaptureWriter(object):
+    # Binary capture: fixed-width records instead of text lines. The device dictionary is built
+    # from the devices present at the first tick, devices appearing later are not recorded.
+
+    def __init__(self, arg_path, arg_scheduler, arg_device, arg_log=discard_message):
+        self.path = arg_path
+        self._writer = CaptureWriter(arg_path, True)
+        self._scheduler = arg_scheduler
+        self._device = arg_device
+        self._log = arg_log
+        self._ids = None
+        self._record = None
+        self._counters = 0
+        self._unknown = set()
+
+    @property
+    def count(self):
+        return max(0, self._writer.count - 1)
+
+    @property
+    def empty(self):
+        # No header yet: stopped before the first tick
+        return self._ids is None
+
+    def append_tick(self, arg_tickNs, arg_lines):
+        if self._ids is None:
+            self._write_header(arg_tickNs, arg_lines)
+
+        _pack = self._record.pack
+        _padding = [0] * self._counters
+        for line in arg_lines:
+            _device, _major, _minor, _counters = split_stat_line(line, self._device)
+            _id = self._ids.get(_device)
+            if _id is None or len(_counters) < 11:
+                if _device not in self._unknown:
+                    self._unknown.add(_device)
+                    self._log(" Device " + str(_device) + " is not in the capture header, it will not be captured.")
+                continue
+            self._writer.append(_pack(arg_tickNs, _id, 0, *([int(x) for x in _counters] + _padding)[:self._counters]))
+
+    def close(self):
+        self._writer.close()
+
+    def _write_header(self, arg_tickNs, arg_lines):
+        self._ids = {}
+        _entries = []
+        for line in arg_lines:
+            _device, _major, _minor, _counters = split_stat_line(line, self._device)
+            if len(_counters) < 11 or _device in self._ids:
+                continue
+            if _major is None:
+                try:
+                    _major, _minor = get_device_numbers(_device)
+                except (IOError, OSError, ValueError):
+                    _major, _minor = 0, 0
+            self._ids[_device] = len(_entries)
+            self._counters = max(self._counters, len(_counters))
+            _name = _device.encode("ascii")
+            _entries.append(CAPTURE_DEVICE.pack(_major, _minor, get_device_sector_size(_device), len(_name)) + _name)
+        self._counters = max(self._counters, 11)
+        self._record = struct.Struct("<QII" + "Q" * self._counters)
+
+        _size = CAPTURE_HEADER.size + sum(len(x) for x in _entries)
+        _dataOffset = (_size + 7) // 8 * 8
+        self._writer.append(CAPTURE_HEADER.pack(CAPTURE_MAGIC, CAPTURE_VERSION, self._counters, self._record.size, _dataOffset,
+                                                self._scheduler.wall_time_ns(arg_tickNs), arg_tickNs, len(_entries))
+                            + b"".join(_entries) + b"\0" * (_dataOffset - _size))
+
+
+class BinaryCapture(object):
+    # Read side of a binary capture, records are read from a read-only mmap without copying.
+    # Records have a fixed width so record i is at dataOffset + i * recordSize.
+
+    def __init__(self, arg_path):
+        self.path = arg_path
+        with open(arg_path, "rb") as f:
+            if os.fstat(f.fileno()).st_size < CAPTURE_HEADER.size:
+                raise ValueError(arg_path + " has no header, the capture was stopped before its first tick")
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        _magic, _version, self.counters, self.recordSize, self.dataOffset, _wallNs, _monotonicNs, _count = \
+            CAPTURE_HEADER.unpack_from(self._map, 0)
+        if _magic != CAPTURE_MAGIC or _version != CAPTURE_VERSION:
+            raise ValueError(arg_path + " is not a binary capture file")
+        self._wallOffsetNs = _wallNs - _monotonicNs
+
+        # Device dictionary: (name, major, minor, sector size) by device id
+        self.devices = []
+        _offset = CAPTURE_HEADER.size
+        for _ in range(_count):
+            _major, _minor, _sectorSize, _length = CAPTURE_DEVICE.unpack_from(self._map, _offset)
+            _offset += CAPTURE_DEVICE.size
+            self.devices.append((self._map[_offset:_offset + _length].decode("ascii"), _major, _minor, _sectorSize))
+            _offset += _length
+
+        self._record = struct.Struct("<QII" + "Q" * self.counters)
+        # An interrupted capture may end with a partial record
+        self._count = (len(self._map) - self.dataOffset) // self.recordSize
+        self.topology = read_capture_topology(arg_path)
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, arg_index):
+        if arg_index < 0:
+            arg_index += self._count
+        if not 0 <= arg_index < self._count:
+            raise IndexError(arg_index)
+        return self._record.unpack_from(self._map, self.dataOffset + arg_index * self.recordSize)
+
+    def __iter__(self):
+        _view = memoryview(self._map)[self.dataOffset:self.dataOffset + self._count * self.recordSize]
+        try:
+            for _record in self._record.iter_unpack(_view):
+                yield _record
+        finally:
+            _view.release()
+
+    def wall_time_ns(self, arg_monotonicNs):
+        return self._wallOffsetNs + arg_monotonicNs
+
+    def samples(self, arg_devices=None):
+        if arg_devices is None:
+            return iterate_records(self, self.devices, self._wallOffsetNs)
+        _ids = set(i for i, x in enumerate(self.devices) if x[0] in arg_devices)
+        return iterate_records((x for x in self if x[1] in _ids), self.devices, self._wallOffsetNs)
+
+    def samples_at(self, arg_indexes):
+        # Samples of the records at the increasing indexes given
+        return iterate_records((self[i] for i in arg_indexes), self.devices, self._wallOffsetNs)
+
+    def close(self):
+        self._map.close()
+
+
+class FlightRecorder(object):
+    # Flight recorder: the last before + after seconds of samples are kept in a ring buffer of
+    # fixed-width records allocated once at the first tick, so a long running recorder neither
+    # grows nor allocates per sample. When a trigger fires, sampling goes on for after seconds,
+    # then the window is written to the usual log files by a background thread. The first tick
+    # raises ValueError when the ring would be larger than FLIGHT_MAX_RING_SIZE.
+    # Triggers: SIGUSR1, a touch of the trigger file, or a device crossing the IOPS or await threshold.
+
+    def __init__(self, arg_scheduler, arg_device, arg_interval, arg_options):
+        self._scheduler = arg_scheduler
+        self._device = arg_device
+        _before, _after, self._iops, self._await, self._file = arg_options
+        self._beforeNs = int(_before * 1000000000)
+        self._afterNs = int(_after * 1000000000)
+        self._ticks = int(math.ceil((_before + _after) / arg_interval)) + 2
+        self._ring = None
+        self._capacity = 0
+        self._position = 0
+        self._ids = None
+        self._devices = []
+        self._topology = None
+        self._previous = None
+        self._lastTickNs = None
+        self._above = False
+        self._triggerNs = None
+        self._signalled = False
+        self._fileTime = self._file_time()
+        self._dumps = []
+        self._dumpCount = 0
+        self._handlers = (signal.signal(signal.SIGUSR1, self._on_signal),
+                          # Stopping the daemon with kill still writes a pending window
+                          signal.signal(signal.SIGTERM, signal.default_int_handler))
+
+    def append_tick(self, arg_tickNs, arg_lines):
+        if self._ring is None:
+            self._allocate(arg_lines)
+
+        _size = FLIGHT_RECORD.size
+        _above = False
+        _elapsedNs = arg_tickNs - self._lastTickNs if self._lastTickNs is not None else 0
+        for line in arg_lines:
+            _device, _major, _minor, _counters = split_stat_line(line, self._device)
+            _id = self._ids.get(_device)
+            if _id is None or len(_counters) < 11:
+                continue
+            _counters = [int(x) for x in _counters[:11]]
+            FLIGHT_RECORD.pack_into(self._ring, self._position * _size, arg_tickNs, _id, 0, *_counters)
+            self._position = (self._position + 1) % self._capacity
+
+            _previous = self._previous[_id]
+            self._previous[_id] = _counters
+            if _previous is not None and _elapsedNs > 0 and not _above and (self._iops is not None or self._await is not None):
+                _rates = compute_io_rates(_previous, _counters, _elapsedNs / 1000000.0, self._devices[_id][1])
+                _above = io_rates_above(_rates, _counters[8], self._iops, arg_await=self._await)
+        self._lastTickNs = arg_tickNs
+
+        if self._triggerNs is None:
+            _reason = None
+            if _above and not self._above:
+                _reason = "threshold"
+            elif self._signalled:
+                _reason = "SIGUSR1"
+            elif self._file is not None and self._file_time() != self._fileTime:
+                _reason = "trigger file"
+            if _reason is not None:
+                self._triggerNs = arg_tickNs
+                print (" " + self._scheduler.timestamp(arg_tickNs) + " - Triggered by " + _reason + ", recording " + str(self._afterNs // 1000000000) + " more second(s)...")
+        elif arg_tickNs - self._triggerNs >= self._afterNs:
+            self._dump(arg_tickNs)
+        # Thresholds trigger when crossed, not again while the load stays above
+        self._above = _above
+
+    def close(self):
+        signal.signal(signal.SIGUSR1, self._handlers[0])
+        signal.signal(signal.SIGTERM, self._handlers[1])
+        if self._triggerNs is not None and self._lastTickNs is not None:
+            print (" Stopped before the end of the window, writing what was recorded...")
+            self._dump(self._lastTickNs)
+        for _thread in self._dumps:
+            _thread.join()
+
+    def _allocate(self, arg_lines):
+        self._ids = {}
+        for line in arg_lines:
+            _device, _major, _minor, _counters = split_stat_line(line, self._device)
+            if len(_counters) < 11 or _device in self._ids:
+                continue
+            self._ids[_device] = len(self._devices)
+            self._devices.append((_device, get_device_sector_size(_device)))
+        # Dumps use the topology of the devices recorded, not the one of /sys when they are written
+        self._topology = BlockTopology()
+        self._previous = [None] * len(self._devices)
+        self._capacity = max(1, self._ticks * len(self._devices))
+        _size = self._capacity * FLIGHT_RECORD.size
+        if _size > FLIGHT_MAX_RING_SIZE:
+            raise ValueError(" A ring buffer of " + str(_size // 1048576) + " MB (" + str(self._ticks) + " ticks of " + str(len(self._devices)) + " device(s)) is above the "
+                             + str(FLIGHT_MAX_RING_SIZE // 1048576) + " MB limit: use a larger -i/--interval, a shorter window or fewer devices.")
+        self._ring = bytearray(_size)
+        print (" " + str(len(self._devices)) + " device(s) recorded, " + str(len(self._ring) // 1024) + " KB ring buffer.")
+
+    def _on_signal(self, arg_signal, arg_frame):
+        self._signalled = True
+
+    def _file_time(self):
+        if self._file is None:
+            return None
+        try:
+            return os.stat(self._file).st_mtime_ns
+        except OSError:
+            return None
+
+    def _dump(self, arg_tickNs):
+        # Ring in chronological order, copied so sampling can go on while the window is written
+        _offset = self._position * FLIGHT_RECORD.size
+        _data = self._ring[_offset:] + self._ring[:_offset]
+        # Files named after the trigger tick in ms and the dump number, two dumps never share a name
+        self._dumpCount += 1
+        _date, _time, _totalTime = wall_time_fields(self._scheduler.wall_time_ns(self._triggerNs))
+        _dateTime = _date + "_" + _time.replace(":", "-").replace(".", "-") + "-" + str(self._dumpCount)
+        _thread = threading.Thread(target=self._write, args=(_data, self._triggerNs - self._beforeNs, arg_tickNs, self._scheduler.wall_time_ns(0), _dateTime))
+        _thread.start()
+        self._dumps = [x for x in self._dumps if x.is_alive()] + [_thread]
+
+        self._triggerNs = None
+        self._signalled = False
+        self._fileTime = self._file_time()
+
+    def _write(self, arg_data, arg_startNs, arg_endNs, arg_wallOffsetNs, arg_dateTime):
+        # Slots never written have a 0 timestamp and fall out of the window
+        _records = [x for x in FLIGHT_RECORD.iter_unpack(arg_data) if arg_startNs <= x[0] <= arg_endNs]
+        print (" Writing " + str(len(_records)) + " samples recorded around the trigger...")
+        write_all_disks_logs(iterate_records(_records, self._devices, arg_wallOffsetNs), len(_records), self._device, dict(self._devices),
+                             _topology=self._topology, _dateTime=arg_dateTime)
+        update_progressbar(" Completion", len(_records), len(_records))
+        print ("")
+
+
+class OpenMetricsHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != EXPORT_PATH:
+            self.send_error(404)
+            return
+        _body = self.server.exporter.snapshot()
+        self.send_response(200)
+        self.send_header("Content-Type", EXPORT_CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(_body)))
+        self.end_headers()
+        self.wfile.write(_body)
+
+    def log_message(self, arg_format, *arg_args):
+        # Scrapes are not logged, the terminal keeps the collector messages only
+        pass
+
+
+class OpenMetricsExporter(object):
+    # Exporter: the sampling loop only swaps in the lines of the last two ticks, the OpenMetrics
+    # text is built from them by the first scrape that follows a tick and served from cache to
+    # the next ones, so scrapes never read /proc/diskstats and cost the loop nothing but a tuple.
+    # The HTTP server answers from its own threads.
+
+    def __init__(self, arg_scheduler, arg_device, arg_address):
+        self._scheduler = arg_scheduler
+        self._device = arg_device
+        self._ticks = None
+        self._sectorSizes = {}
+        self._lock = threading.Lock()
+        self._snapshotTickNs = None
+        self._snapshot = b"# EOF\n"
+        self.builds = 0
+        self._server = http.server.ThreadingHTTPServer(arg_address, OpenMetricsHandler)
+        self._server.daemon_threads = True
+        self._server.exporter = self
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        self._handler = signal.signal(signal.SIGTERM, signal.default_int_handler)
+        print (" Serving OpenMetrics on http://" + arg_address[0] + ":" + str(self._server.server_address[1]) + EXPORT_PATH)
+
+    def append_tick(self, arg_tickNs, arg_lines):
+        _previous = self._ticks
+        self._ticks = (arg_tickNs, arg_lines, _previous[0] if _previous else None, _previous[1] if _previous else None)
+
+    def close(self):
+        signal.signal(signal.SIGTERM, self._handler)
+        self._server.shutdown()
+        self._server.server_close()
+        print (" " + str(self.builds) + " snapshot(s) built for the scrapes.")
+
+    def snapshot(self):
+        with self._lock:
+            _ticks = self._ticks
+            if _ticks is not None and _ticks[0] != self._snapshotTickNs:
+                self._snapshot = self._build(_ticks)
+                self._snapshotTickNs = _ticks[0]
+                self.builds += 1
+            return self._snapshot
+
+    def _build(self, arg_ticks):
+        _tickNs, _lines, _previousTickNs, _previousLines = arg_ticks
+        _samples = self._parse(_lines)
+        _previous = self._parse(_previousLines) if _previousLines is not None else {}
+        _deltaTime = (_tickNs - _previousTickNs) / 1000000.0 if _previousTickNs is not None else 0.0
+
+        _output = []
+        for _name, _help, _index, _scale in EXPORT_COUNTERS:
+            _unit = "bytes" if _name.endswith("_bytes") else ("seconds" if _name.endswith("_seconds") else None)
+            _output.append("# TYPE " + _name + " counter")
+            if _unit is not None:
+                _output.append("# UNIT " + _name + " " + _unit)
+            _output.append("# HELP " + _name + " " + _help + ".")
+            for _item, _counters in _samples.items():
+                _value = _counters[_index] * (_scale if _scale is not None else self._sectorSizes[_item])
+                _output.append('%s_total{device="%s"} %s' % (_name, _item, repr(_value) if isinstance(_value, float) else _value))
+
+        _rates = {}
+        for _item, _counters in _samples.items():
+            _before = _previous.get(_item)
+            _values = [0.0] * 8 + [_counters[8]]
+            if _before is not None and _deltaTime > 0 and all(x >= y for x, y in zip(_counters, _before)):
+                # Gauges in seconds and ratios
+                _delta = compute_io_rates(_before, _counters, _deltaTime, self._sectorSizes[_item])
+                _values[:8] = [_delta.per_second(_delta.reads), _delta.per_second(_delta.writes),
+                               _delta.per_second(_delta.readBytes), _delta.per_second(_delta.writtenBytes),
+                               _delta.rAwait / 1000.0, _delta.wAwait / 1000.0, _delta.util / 100.0, _delta.queueSize]
+            _rates[_item] = _values
+        for _position, (_name, _help) in enumerate(EXPORT_GAUGES):
+            _output.append("# TYPE " + _name + " gauge")
+            if _name.endswith("_seconds") or _name.endswith("_ratio"):
+                _output.append("# UNIT " + _name + " " + _name.rsplit("_", 1)[1])
+            _output.append("# HELP " + _name + " " + _help + ".")
+            for _item, _values in _rates.items():
+                _output.append('%s{device="%s"} %s' % (_name, _item, repr(float(_values[_position]))))
+
+        _output.append("# TYPE getiostats_sample_timestamp_seconds gauge")
+        _output.append("# UNIT getiostats_sample_timestamp_seconds seconds")
+        _output.append("# HELP getiostats_sample_timestamp_seconds Wall clock time of the last sample.")
+        _output.append("getiostats_sample_timestamp_seconds " + repr(self._scheduler.wall_time_ns(_tickNs) / 1000000000.0))
+        _output.append("# TYPE getiostats_ticks counter")
+        _output.append("# HELP getiostats_ticks Sampling ticks.")
+        _output.append("getiostats_ticks_total " + str(self._scheduler.ticks))
+        _output.append("# TYPE getiostats_overruns counter")
+        _output.append("# HELP getiostats_overruns Ticks that started after the next deadline.")
+        _output.append("getiostats_overruns_total " + str(self._scheduler.overruns))
+        _output.append("# EOF\n")
+        return "\n".join(_output).encode("utf-8")
+
+    def _parse(self, arg_lines):
+        _samples = {}
+        for line in arg_lines:
+            _device, _major, _minor, _counters = split_stat_line(line, self._device)
+            if len(_counters) < 11 or _device in _samples:
+                continue
+            _samples[_device] = [int(x) for x in _counters[:11]]
+            if _device not in self._sectorSizes:
+                self._sectorSizes[_device] = get_device_sector_size(_device)
+        return _samples
+
+
+class AdaptiveRate(object):
+    # Adaptive sampling: ticks at the base interval while the devices are quiet, at the -i interval
+    # from the tick where a device crosses a threshold over the last tick (IOPS, bytes per second,
+    # I/Os in flight) and back to the base interval after cooldown seconds below all of them.
+    # Rows keep their actual delta time, so the intervals in the logs follow the load.
+
+    def __init__(self, arg_scheduler, arg_device, arg_interval, arg_options, arg_log=discard_message):
+        self._scheduler = arg_scheduler
+        self._device = arg_device
+        self._burstInterval = arg_interval
+        self._baseInterval, self._iops, self._bytes, self._inFlight, _cooldown = arg_options
+        self._cooldownNs = int(_cooldown * 1000000000)
+        self._previous = {}
+        self._sectorSizes = {}
+        self._lastTickNs = None
+        self._aboveNs = None
+        self.burst = False
+        self.bursts = 0
+        self.burstNs = 0
+        arg_scheduler.set_interval(self._baseInterval)
+
+        _thresholds = []
+        if self._iops is not None:
+            _thresholds.append("%g IOPS" % self._iops)
+        if self._bytes is not None:
+            _thresholds.append("%g bytes/s" % self._bytes)
+        if self._inFlight is not None:
+            _thresholds.append("%g I/Os in flight" % self._inFlight)
+        arg_log (" Adaptive sampling: every %gs, every %gs above %s, back after %gs below." % (self._baseInterval, self._burstInterval, " or ".join(_thresholds), _cooldown))
+
+    def update(self, arg_tickNs, arg_lines):
+        _elapsedNs = arg_tickNs - self._lastTickNs if self._lastTickNs is not None else 0
+        if self.burst:
+            self.burstNs += _elapsedNs
+        _above = False
+        for line in arg_lines:
+            _device, _major, _minor, _counters = split_stat_line(line, self._device)
+            if len(_counters) < 11:
+                continue
+            _counters = [int(x) for x in _counters[:11]]
+            _previous = self._previous.get(_device)
+            self._previous[_device] = _counters
+            if not _above:
+                _rates = None
+                if _previous is not None:
+                    _sectorSize = self._sectorSizes.get(_device)
+                    if _sectorSize is None:
+                        _sectorSize = get_device_sector_size(_device)
+                        self._sectorSizes[_device] = _sectorSize
+                    _rates = compute_io_rates(_previous, _counters, _elapsedNs / 1000000.0, _sectorSize)
+                _above = io_rates_above(_rates, _counters[8], self._iops, self._bytes, self._inFlight)
+        self._lastTickNs = arg_tickNs
+
+        if _above:
+            self._aboveNs = arg_tickNs
+            if not self.burst:
+                self.burst = True
+                self.bursts += 1
+                self._scheduler.set_interval(self._burstInterval)
+        elif self.burst and arg_tickNs - self._aboveNs >= self._cooldownNs:
+            self.burst = False
+            self._scheduler.set_interval(self._baseInterval)
+
+
+class ProcessSelector(object):
+    # --processes: "all", or comma separated PIDs and globs or regular expressions (re:) of the
+    # command name (/proc/<pid>/comm)
+
+    def __init__(self, arg_text):
+        _items = arg_text.split(",")
+        self.all = "all" in _items
+        self.pids = set(int(x) for x in _items if x.isdigit())
+        self._patterns = [compile_device_pattern(x) for x in _items if x != "all" and not x.isdigit()]
+
+    def matches(self, arg_pid, arg_command):
+        return self.all or arg_pid in self.pids or any(x(arg_command, "") for x in self._patterns)
+
+
+class ProcessIOSource(object):
+    # /proc/<pid>/io of the selected processes, kept open and re-read with pread() like the disk
+    # statistics. /proc is listed with scandir at the first read and every PROCESS_RESCAN_INTERVAL.
+    # In between, new processes are found from the last PID allocated (/proc/loadavg): only the PIDs
+    # allocated since the previous tick are tried, threads being told apart by their Tgid, and
+    # looked at again at the next tick as the command name changes when the fork is followed by exec.
+    # Processes not selected by their name are looked at again at the next listings only when their
+    # /proc entry (a reused PID) or their executable (exec) changed, their status is not read again.
+    # Those whose io file cannot be opened for lack of permission are left out for good.
+    # Processes found after the first listing are new ones: their I/O counts from zero.
+    # A process has exited when its io file can no longer be read.
+
+    def __init__(self, arg_selector, arg_log=discard_message):
+        self._selector = arg_selector
+        self._log = arg_log
+        self._readers = {}
+        self._denied = set()
+        self._unselected = {}
+        self._listed = False
+        self._started = set()
+        self._recent = []
+        self._rescanNs = 0
+        self._warned = False
+        self.found = 0
+        self.exited = 0
+        try:
+            self._loadavg = StatReader(stats_path("/proc/loadavg"), "", PROCESS_IO_BUFFER_SIZE)
+        except (IOError, OSError):
+            # Only the /proc listings find new processes
+            self._loadavg = None
+        self._pidMax = int(read_sysfs_attribute(stats_path("/proc/sys/kernel/pid_max"), DEFAULT_PID_MAX))
+        self._lastPid = self._last_pid()
+
+    def read(self):
+        # (pid, command, read bytes, write bytes, syscr, syscw, started), started is True at the
+        # first read of a process started after the previous tick
+        if time.monotonic_ns() >= self._rescanNs:
+            self._scan()
         else:
-            print (" Capturing from /proc/diskstats")
-            while _timeRunning <= int(_timeToRun):
-                _diskStatsfile = open("/proc/diskstats", "r")
-                for line in _diskStatsfile:
-                    if _device in line.split():
-                        _stats.append(datetime.utcnow().strftime('%Y-%m-%d') + " " + datetime.utcnow().strftime('%H:%M:%S.%f')[:-3] + " " + line)
-                        continue
-                _timeRunning += 1
-                time.sleep(_interval)
-                _diskStatsfile.close()
+            self._find_new()
+        _values = []
+        _exited = []
+        for _pid, (_reader, _command) in self._readers.items():
+            try:
+                _fields = _reader.read().split()
+            except (IOError, OSError):
+                _fields = ()
+            if len(_fields) < 12:
+                _exited.append(_pid)
+                continue
+            # rchar, wchar, syscr, syscw, read_bytes, write_bytes, cancelled_write_bytes
+            _values.append((_pid, _command, int(_fields[9]), int(_fields[11]), int(_fields[5]), int(_fields[7]), _pid in self._started))
+        self._started.clear()
+        for _pid in _exited:
+            self._close(_pid)
+        return _values
+
+    def close(self):
+        for _pid in list(self._readers):
+            self._readers.pop(_pid)[0].close()
+        if self._loadavg is not None:
+            self._loadavg.close()
+
+    def _last_pid(self):
+        if self._loadavg is None:
+            return None
+        try:
+            return int(self._loadavg.read().split()[4])
+        except (IOError, OSError, ValueError, IndexError):
+            return None
+
+    def _scan(self):
+        with os.scandir(stats_path("/proc")) as _entries:
+            _pids = set(int(x.name) for x in _entries if x.name.isdigit())
+        raise_open_files_limit(len(_pids))
+        for _pid in [x for x in self._readers if x not in _pids]:
+            self._close(_pid)
+        self._denied &= _pids
+        self._unselected = dict((x, y) for x, y in self._unselected.items() if x in _pids)
+        self._recent = []
+        for _pid in _pids:
+            if _pid in self._readers or _pid in self._denied:
+                continue
+            # Taken before the status, an exec in between is seen at the next listing
+            _identity = self._identity(_pid)
+            if _identity is not None and self._unselected.get(_pid) == _identity:
+                continue
+            _opened = self._open(_pid, False)
+            if _opened is False and _identity is not None:
+                self._unselected[_pid] = _identity
+            elif _opened and self._listed:
+                self._started.add(_pid)
+        self._listed = True
+        self._lastPid = self._last_pid()
+        self._rescanNs = time.monotonic_ns() + int(PROCESS_RESCAN_INTERVAL * 1000000000)
+
+    def _find_new(self):
+        _recent = self._recent
+        self._recent = []
+        for _pid in _recent:
+            self._recheck(_pid)
+
+        _lastPid = self._last_pid()
+        if _lastPid is None or _lastPid == self._lastPid or self._lastPid is None:
+            return
+        # PIDs wrap around at pid_max
+        _count = (_lastPid - self._lastPid) % self._pidMax
+        if _count > PROCESS_MAX_PROBES:
+            self._scan()
+            return
+        for i in range(1, _count + 1):
+            _pid = (self._lastPid + i) % self._pidMax
+            if _pid not in self._readers:
+                # A PID reused since it was denied is looked at again
+                self._denied.discard(_pid)
+                _opened = self._open(_pid, True)
+                if _opened:
+                    self._started.add(_pid)
+                if _opened is not None:
+                    self._recent.append(_pid)
+        self._lastPid = _lastPid
+
+    def _recheck(self, arg_pid):
+        if arg_pid not in self._readers:
+            if arg_pid not in self._denied and self._open(arg_pid, False):
+                self._started.add(arg_pid)
+            return
+        _status = self._status(arg_pid)
+        if _status is None or _status[0] == self._readers[arg_pid][1]:
+            return
+        if self._selector.matches(arg_pid, _status[0]):
+            self._readers[arg_pid] = (self._readers[arg_pid][0], _status[0])
+        else:
+            self._readers.pop(arg_pid)[0].close()
+            self.found -= 1
+
+    def _identity(self, arg_pid):
+        # (time the /proc entry was made, executable): a reused PID gets a new entry, exec a new
+        # executable. Processes of other users have no readable executable, their I/O neither.
+        _path = stats_path("/proc/%d" % arg_pid)
+        try:
+            _entryTime = os.lstat(_path).st_ctime_ns
+        except OSError:
+            return None
+        try:
+            return (_entryTime, os.readlink(_path + "/exe"))
+        except OSError:
+            return (_entryTime, None)
+
+    def _status(self, arg_pid):
+        # (command name, thread group id)
+        try:
+            with open(stats_path("/proc/%d/status" % arg_pid), "r") as f:
+                _status = dict(line.split(":", 1) for line in islice(f, 8) if ":" in line)
+            return (_status["Name"].strip().replace(";", "_"), int(_status["Tgid"]))
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+
+    def _open(self, arg_pid, arg_probed):
+        # True when opened, False when not selected, None for threads and processes already gone
+        _status = self._status(arg_pid)
+        if _status is None or (arg_probed and _status[1] != arg_pid):
+            # Threads are not listed in /proc but can be opened by their id
+            return None
+        if not self._selector.matches(arg_pid, _status[0]):
+            return False
+        try:
+            self._readers[arg_pid] = (StatReader(stats_path("/proc/%d/io" % arg_pid), "", PROCESS_IO_BUFFER_SIZE), _status[0])
+        except (IOError, OSError) as e:
+            if e.errno == errno.EMFILE and not self._warned:
+                self._warned = True
+                self._log(" Too many processes for the open files limit, some are not captured.")
+            elif e.errno in (errno.EACCES, errno.EPERM):
+                self._denied.add(arg_pid)
+            return None
+        self.found += 1
+        return True
+
+    def _close(self, arg_pid):
+        self._readers.pop(arg_pid)[0].close()
+        self.exited += 1
+
+
+class ProcessIOLog(object):
+    # Per-process I/O deltas written at each tick of the disk samples, with the same timestamps,
+    # to ./<host>_processes_<date>.log and its index. Processes without I/O since the previous
+    # tick cost a read but no row. Processes started during the capture count from zero.
+
+    def __init__(self, arg_scheduler, arg_selector, arg_path, arg_log=discard_message):
+        self.path = log_path(arg_path)
+        self.rows = 0
+        self._scheduler = arg_scheduler
+        self._source = ProcessIOSource(arg_selector, arg_log)
+        self._writer = LogWriter()
+        self._writer.write(self.path, PROCESS_HEADER + "\n")
+        self._start = self._offset = len(PROCESS_HEADER) + 1
+        self._index = []
+        self._previous = {}
+        self._lastWallMs = None
+
+    def append_tick(self, arg_tickNs):
+        # Same truncation to the ms as the disk samples, the delta time being the one of their rows
+        _wallNs = self._scheduler.wall_time_ns(arg_tickNs)
+        _date, _time, _totalTime = wall_time_fields(_wallNs)
+        _deltaTime = _wallNs // 1000000 - self._lastWallMs if self._lastWallMs is not None else 0
+        _prefix = "%s;'%s;" % (_date, _time)
+        _previous = self._previous
+        _current = {}
+        _rows = []
+        for _pid, _command, _readBytes, _writeBytes, _syscr, _syscw, _started in self._source.read():
+            _counters = (_readBytes, _writeBytes, _syscr, _syscw)
+            _current[_pid] = _counters
+            _before = _previous.get(_pid)
+            if _before is None:
+                if not _started:
+                    continue
+                _before = (0, 0, 0, 0)
+            if _counters != _before:
+                _rows.append(_prefix + "%d;%d;%d;%s;%d;%d;%d;%d;%d;%d;%d;%d" % (_pid, _totalTime, _deltaTime, _command,
+                             _readBytes - _before[0], _writeBytes - _before[1], _syscr - _before[2], _syscw - _before[3],
+                             _readBytes, _writeBytes, _syscr, _syscw))
+        self._previous = _current
+        self._lastWallMs = _wallNs // 1000000
+
+        if _rows:
+            self._writer.write(self.path, "\n".join(_rows) + "\n")
+            self._offset = index_log_rows(self._index, _rows, self._offset, self.rows)
+            self.rows += len(_rows)
+
+    def close(self):
+        self._source.close()
+        self._writer.close()
+        write_log_index(self.path, [("", self._start, self._offset, self._index)])
+        print (" Per-process I/O: " + str(self.rows) + " rows from " + str(self._source.found) + " process(es), "
+               + str(self._source.exited) + " exited, written to " + self.path)
+
+
+class Collector(object):
+    # Library entry point: samples the selected devices at a fixed interval, for arg_duration
+    # seconds or until the consumer stops iterating. Nothing is printed to a file nor kept:
+    #   ticks()   (monotonic ns, raw stat lines) of each tick, as read
+    #   samples() IOSample records of each device at each tick
+    #   deltas()  IODelta records of each device from its second tick on
+    # The device selection is the one of -d. The script itself is a consumer of ticks().
+    # With arg_adaptive, an AdaptiveOptions (base interval, IOPS, bytes/s, in flight, cooldown), the interval is
+    # the base one while quiet, see AdaptiveRate. Messages go to arg_log, nowhere by default.
+    # Statistics are read below arg_root, the -r/--root one when not given, for the arg_kernel
+    # version, the one running when not given: collectors with different roots can run side by side.
+    # ticks() raises ValueError when the single device selected does not exist.
+
+    def __init__(self, arg_device="all", arg_interval=DEFAULT_COLLECTIONINTERVAL, arg_duration=None, arg_adaptive=None, arg_log=discard_message,
+                 arg_root=None, arg_kernel=None):
+        self.device = arg_device
+        self.root = stats_root if arg_root is None else arg_root
+        self.kernel = init() if arg_kernel is None else arg_kernel
+        self.interval = arg_interval
+        self._log = arg_log
+        self.scheduler = TickScheduler(arg_interval)
+        self.overhead = CollectorOverhead(self.scheduler)
+        self.adaptive = AdaptiveRate(self.scheduler, arg_device, arg_interval, arg_adaptive, arg_log) if arg_adaptive is not None else None
+        # Variable intervals: the duration is a time, not a number of ticks
+        self._ticks = None if arg_duration is None or self.adaptive is not None else int(arg_duration * float(1/arg_interval)) + 1
+        self._durationNs = int(arg_duration * 1000000000) if arg_duration is not None and self.adaptive is not None else None
+
+    def ticks(self):
+        # The source is opened by the call, so a missing device is reported before the first tick
+        return self._iterate(open_tick_source(self.device, self._log, self.root, self.kernel))
+
+    def _iterate(self, arg_source):
+        # Deadlines and overhead count from the first tick, not from the construction
+        self.scheduler.start()
+        self.overhead.start()
+        try:
+            _ticks = 0
+            _endNs = None
+            while self._ticks is None or _ticks < self._ticks:
+                _tickNs = self.scheduler.wait()
+                if self._durationNs is not None:
+                    # Deadlines, not wake up times: the last one due at the end is sampled, as
+                    # with a number of ticks
+                    if _endNs is None:
+                        _endNs = self.scheduler.deadlineNs + self._durationNs
+                    elif self.scheduler.deadlineNs > _endNs:
+                        break
+                _lines = arg_source.read()
+                _readNs = time.monotonic_ns()
+                yield _tickNs, _lines
+                if self.adaptive is not None:
+                    self.adaptive.update(_tickNs, _lines)
+                # The append time is the one of the consumer
+                self.overhead.add(_tickNs, _readNs - _tickNs, time.monotonic_ns() - _readNs)
+                _ticks += 1
+        finally:
+            arg_source.close()
+
+    def samples(self):
+        for _tickNs, _lines in self.ticks():
+            for _sample in iterate_tick_samples(self.scheduler.wall_time_ns(_tickNs), _lines, self.device):
+                yield _sample
+
+    def deltas(self):
+        _previous = {}
+        _sectorSizes = {}
+        for _sample in self.samples():
+            _item = _sample.device
+            _sectorSize = _sectorSizes.get(_item)
+            if _sectorSize is None:
+                _sectorSize = get_device_sector_size(_item, self.root)
+                _sectorSizes[_item] = _sectorSize
+            _before = _previous.get(_item)
+            _previous[_item] = _sample
+            if _before is not None:
+                _delta = compute_io_delta(_before, _sample, _sectorSize)
+                if _delta is not None:
+                    yield _delta
+
+
+def get_io_stats(_device, _interval, _captureTimeMin, _captureFile=None, _binary=False, _live=None, _liveStream=None, _flightRecorder=None, _profile=False, _export=None, _adaptive=None, _processes=None):
+
+    _collector = Collector(_device, _interval, None if _flightRecorder is not None or _export is not None else _captureTimeMin * 60, _adaptive, print)
+    _scheduler = _collector.scheduler
+    _dateTime = datetime.utcnow().strftime('%Y-%m-%d_%H:%M:%S').replace(":","-")
+    _profiler = None
+    try:
+        _ticks = _collector.ticks()
+    except ValueError as e:
+        print (str(e))
+        print ("Exiting...")
+        sys.exit()
+    _processLog = None
+    _topology = None
+    if _flightRecorder is None and _live is None and _export is None:
+        # Converted with the topology of the capture time, also when done later or elsewhere
+        _topology = BlockTopology()
+        if _captureFile is not None:
+            _topology.write(capture_topology_path(_captureFile), _device)
+    if _processes is not None:
+        _processLog = ProcessIOLog(_scheduler, ProcessSelector(_processes), "./" + os.uname()[1] + "_processes_" + _dateTime + ".log", print)
+
+    if _flightRecorder is not None:
+        _stats = FlightRecorder(_scheduler, _device, _interval, _flightRecorder)
+    elif _export is not None:
+        _stats = OpenMetricsExporter(_scheduler, _device, _export)
+    elif _live is not None:
+        # Nothing is kept, rows are written at each tick
+        _stats = LiveOutput(_scheduler, _device, _live, _liveStream or sys.stdout)
+    elif _binary:
+        _stats = BinaryCaptureWriter(_captureFile, _scheduler, _device, print)
+    elif _captureFile is not None:
+        # Samples are drained to disk by a background writer, memory stays flat
+        _stats = CaptureWriter(_captureFile)
+    else:
+        _stats = CaptureList()
+        _stats.topology = _topology
+
+    try:
+        if _profile:
+            import cProfile
+            _profiler = cProfile.Profile()
+            _profiler.enable()
+        for _tickNs, _lines in _ticks:
+            if not isinstance(_stats, (list, CaptureWriter)):
+                _stats.append_tick(_tickNs, _lines)
+            else:
+                # Single timestamp per tick, shared by all devices
+                _timestamp = _scheduler.timestamp(_tickNs) + " "
+                for line in _lines:
+                    _stats.append(_timestamp + line)
+            if _processLog is not None:
+                _processLog.append_tick(_tickNs)
+    except ValueError as e:
+        # Ring buffer above FLIGHT_MAX_RING_SIZE, refused at the first tick
+        if _flightRecorder is None:
+            raise
+        print (str(e))
+        print ("Exiting...")
+        sys.exit(2)
+    except KeyboardInterrupt:
+        if isinstance(_stats, list):
+            raise
+        print ("")
+        if _binary and _stats.empty:
+            print (" Capture interrupted before its first tick, nothing captured")
+        elif _captureFile is not None:
+            print (" Capture interrupted, samples flushed so far are kept in " + _captureFile)
+    finally:
+        if _profiler is not None:
+            _profiler.disable()
+        _ticks.close()
+        if not isinstance(_stats, list):
+            _stats.close()
+        if _processLog is not None:
+            _processLog.close()
 
+    print ("")
+    print (" " + str(_scheduler.ticks) + " ticks captured, " + str(_scheduler.overruns) + " overrun(s), " + str(_scheduler.missed) + " missed deadline(s)")
+    if _scheduler.overruns > 0:
+        print (" The collection interval was not always met, consider a larger -i/--interval value.")
+    if _collector.adaptive is not None:
+        print (" " + str(_collector.adaptive.bursts) + " burst(s), " + ("%.1f" % (_collector.adaptive.burstNs / 1000000000.0)) + " second(s) sampled at the -i interval")
+    _collector.overhead.write("./" + os.uname()[1] + "_overhead_" + _dateTime + ".log")
+    if _profiler is not None:
+        _profiler.dump_stats("./" + os.uname()[1] + "_profile_" + _dateTime + ".prof")
+        print (" Collector profile written to ./" + os.uname()[1] + "_profile_" + _dateTime + ".prof (python -m pstats)")
+
+    if _live is not None or _flightRecorder is not None or _export is not None:
+        return None
+    if _binary:
+        if _stats.empty:
+            # An empty file cannot be read back nor converted
+            os.remove(_captureFile)
+            if _topology is not None:
+                os.remove(capture_topology_path(_captureFile))
+            return None
+        return BinaryCapture(_captureFile)
+    if _captureFile is not None:
+        return CaptureFile(_captureFile, _stats.count)
     return _stats
 
 
-def compute_io_stats(_iostats, _device):
+class IOSample(object):
+    # Raw sample tokenized once. Counters are the 11 fields common to 2.6+ kernels:
+    # reads, reads merged, sectors read, ms reading, writes, writes merged, sectors written,
+    # ms writing, I/O in progress, ms doing I/O, weighted ms doing I/O
+    __slots__ = ("date", "time", "device", "totalTime", "counters")
+
+    def __init__(self, arg_date, arg_time, arg_device, arg_totalTime, arg_counters):
+        self.date = arg_date
+        self.time = arg_time
+        self.device = arg_device
+        self.totalTime = arg_totalTime
+        self.counters = arg_counters
+
+
+class IODelta(object):
+    # Derived metrics of a device between two samples, those of the log columns: deltas of
+    # time (ms), reads, writes and bytes, r_await and w_await (ms), %util, average queue size,
+    # I/Os in progress, with the sample counters
+    __slots__ = ("date", "time", "device", "totalTime", "deltaTime", "reads", "writes", "readBytes", "writtenBytes",
+                 "rAwait", "wAwait", "util", "queueSize", "inProgress", "sectorSize", "counters")
+
+    def __init__(self, arg_sample, arg_deltaTime, arg_reads, arg_writes, arg_readBytes, arg_writtenBytes,
+                 arg_rAwait, arg_wAwait, arg_util, arg_queueSize, arg_sectorSize):
+        self.date = arg_sample.date
+        self.time = arg_sample.time
+        self.device = arg_sample.device
+        self.totalTime = arg_sample.totalTime
+        self.deltaTime = arg_deltaTime
+        self.reads = arg_reads
+        self.writes = arg_writes
+        self.readBytes = arg_readBytes
+        self.writtenBytes = arg_writtenBytes
+        self.rAwait = arg_rAwait
+        self.wAwait = arg_wAwait
+        self.util = arg_util
+        self.queueSize = arg_queueSize
+        self.inProgress = arg_sample.counters[8]
+        self.sectorSize = arg_sectorSize
+        self.counters = arg_sample.counters
+
+
+class IORates(namedtuple("IORates", ("deltaTime", "reads", "writes", "readBytes", "writtenBytes", "rAwait", "wAwait", "ioAwait", "util", "queueSize"))):
+    # Metrics of a device between two counter lists deltaTime ms apart: deltas of reads, writes
+    # and bytes, r_await, w_await and await of all I/Os (ms), %util, average queue size.
+    # per_second() turns a delta into a rate.
+    __slots__ = ()
+
+    def per_second(self, arg_delta):
+        return arg_delta * 1000.0 / self.deltaTime if self.deltaTime > 0 else 0.0
+
+
+def compute_io_rates(arg_previous, arg_counters, arg_deltaTime, arg_sectorSize):
+
+    # Derived metrics, same definitions as iostat. Used for the logs, the live output, the
+    # exporter and the adaptive sampling and flight recorder thresholds.
+    _reads = arg_counters[0] - arg_previous[0]
+    _writes = arg_counters[4] - arg_previous[4]
+    _readTime = arg_counters[3] - arg_previous[3]
+    _writeTime = arg_counters[7] - arg_previous[7]
+    return IORates(arg_deltaTime, _reads, _writes,
+                   (arg_counters[2] - arg_previous[2]) * arg_sectorSize, (arg_counters[6] - arg_previous[6]) * arg_sectorSize,
+                   _readTime / _reads if _reads > 0 else 0.0,
+                   _writeTime / _writes if _writes > 0 else 0.0,
+                   (_readTime + _writeTime) / (_reads + _writes) if _reads + _writes > 0 else 0.0,
+                   min(100.0, (arg_counters[9] - arg_previous[9]) * 100.0 / arg_deltaTime) if arg_deltaTime > 0 else 0.0,
+                   (arg_counters[10] - arg_previous[10]) / arg_deltaTime if arg_deltaTime > 0 else 0.0)
+
+
+def io_rates_above(arg_rates, arg_inProgress, arg_iops=None, arg_bytes=None, arg_inFlight=None, arg_await=None):
+
+    # True when a device crosses one of the thresholds given: IOPS, bytes per second, I/Os in
+    # flight, await of all I/Os (ms). arg_rates is None until the device has two samples.
+    if arg_inFlight is not None and arg_inProgress >= arg_inFlight:
+        return True
+    if arg_rates is None or arg_rates.deltaTime <= 0:
+        return False
+    if arg_iops is not None and arg_rates.per_second(arg_rates.reads + arg_rates.writes) >= arg_iops:
+        return True
+    if arg_bytes is not None and arg_rates.per_second(arg_rates.readBytes + arg_rates.writtenBytes) >= arg_bytes:
+        return True
+    return arg_await is not None and arg_rates.reads + arg_rates.writes > 0 and arg_rates.ioAwait >= arg_await
+
+
+def compute_io_delta(arg_previous, arg_sample, arg_sectorSize):
+
+    _deltaTime = arg_sample.totalTime - arg_previous.totalTime
+    _rates = compute_io_rates(arg_previous.counters, arg_sample.counters, _deltaTime, arg_sectorSize)
+    if _rates.readBytes + _rates.writtenBytes < 0 or _deltaTime < 0:
+        # Exclude data that will bring inaccuracy (counters reset, day change)
+        return None
+    return IODelta(arg_sample, _deltaTime, _rates.reads, _rates.writes, _rates.readBytes, _rates.writtenBytes,
+                   _rates.rAwait, _rates.wAwait, _rates.util, _rates.queueSize, arg_sectorSize)
+
+
+def parse_io_stat(arg_line, arg_device=None):
+
+    _fields = arg_line.split()
+    if len(_fields) > 4 and not _fields[4].isdigit():
+        # /proc/diskstats: [2] major [3] minor [4] device name [5..] counters
+        _device = _fields[4]
+        _counters = _fields[5:16]
+    else:
+        # /sys/block/*/stat: [2..] counters
+        _device = arg_device
+        _counters = _fields[2:13]
+    if len(_counters) < 11:
+        # Linux 2.6.0 to 2.6.24 partitions only report reads, sectors read, writes and sectors written
+        return None
+
+    _time = _fields[1]
+    _totalTime = (int(_time[:2])*3600000) + (int(_time[3:5])*60000) + (int(_time[6:8])*1000) + int(_time[9:13])
+    return IOSample(_fields[0], _time, _device, _totalTime, [int(x) for x in _counters])
+
+
+class QuantileSketch(object):
+    # Streaming quantiles in bounded memory: values are counted in buckets growing geometrically
+    # by SKETCH_GAMMA, so a quantile is known within SKETCH_ACCURACY relative error whatever the
+    # number of samples and nothing is sorted. Values below SKETCH_MIN_VALUE are counted as zero.
+
+    def __init__(self):
+        self.count = 0
+        self.max = 0.0
+        self._zeros = 0
+        self._buckets = {}
+
+    def add(self, arg_value):
+        self.count += 1
+        if arg_value > self.max:
+            self.max = arg_value
+        if arg_value < SKETCH_MIN_VALUE:
+            self._zeros += 1
+            return
+        _bucket = int(math.ceil(math.log(arg_value) / SKETCH_LOG_GAMMA))
+        self._buckets[_bucket] = self._buckets.get(_bucket, 0) + 1
+
+    def add_many(self, arg_values):
+        if numpy is None or not isinstance(arg_values, numpy.ndarray):
+            for _value in arg_values:
+                self.add(_value)
+            return
+        if len(arg_values) == 0:
+            return
+
+        # Whole column bucketed at once
+        self.count += len(arg_values)
+        self.max = max(self.max, float(arg_values.max()))
+        _small = arg_values < SKETCH_MIN_VALUE
+        self._zeros += int(_small.sum())
+        _buckets, _counts = numpy.unique(numpy.ceil(numpy.log(arg_values[~_small]) / SKETCH_LOG_GAMMA).astype(numpy.int64), return_counts=True)
+        for _bucket, _count in zip(_buckets.tolist(), _counts.tolist()):
+            self._buckets[_bucket] = self._buckets.get(_bucket, 0) + _count
+
+    def quantile(self, arg_quantile):
+        if self.count == 0:
+            return 0.0
+        _rank = arg_quantile * (self.count - 1)
+        _seen = self._zeros
+        if _rank < _seen:
+            return 0.0
+        for _bucket in sorted(self._buckets):
+            _seen += self._buckets[_bucket]
+            if _rank < _seen:
+                # Middle of the bucket in relative terms
+                return min(self.max, 2.0 * SKETCH_GAMMA ** _bucket / (SKETCH_GAMMA + 1))
+        return self.max
+
+
+class DeviceSummary(object):
+    # End of run distribution of the per-interval IOPS, throughput and await of a device.
+    # Await is only accounted for intervals with I/Os of that direction.
+
+    def __init__(self):
+        self.iops = QuantileSketch()
+        self.throughput = QuantileSketch()
+        self.rAwait = QuantileSketch()
+        self.wAwait = QuantileSketch()
+
+    def add(self, arg_deltaTime, arg_deltaReads, arg_deltaWrites, arg_bytes, arg_rAwait, arg_wAwait):
+        if arg_deltaTime > 0:
+            _seconds = arg_deltaTime / 1000.0
+            self.iops.add((arg_deltaReads + arg_deltaWrites) / _seconds)
+            self.throughput.add(arg_bytes / float(1024 ** 2) / _seconds)
+        if arg_deltaReads > 0:
+            self.rAwait.add(arg_rAwait)
+        if arg_deltaWrites > 0:
+            self.wAwait.add(arg_wAwait)
+
+    def metrics(self):
+        return [("IOPS", self.iops), ("MBytes/s", self.throughput), ("r_await (ms)", self.rAwait), ("w_await (ms)", self.wAwait)]
+
+
+def format_io_summary(arg_summaries):
+
+    _lines = [SUMMARY_HEADER]
+    for _item, _summary in arg_summaries:
+        for _metric, _sketch in _summary.metrics():
+            _lines.append("%s;%s;%d;%.2f;%.2f;%.2f;%.2f" % ((_item, _metric, _sketch.count)
+                          + tuple(_sketch.quantile(x) for x in SUMMARY_QUANTILES) + (_sketch.max,)))
+    return _lines
+
+
+def write_io_summary(_path, _summaries):
+
+    with open(_path, "w") as f:
+        f.write("\n".join(format_io_summary(_summaries)) + "\n")
+    print ("")
+    print (" Per device summary (p50/p95/p99/max) written to " + _path)
+
+
+class SampleStore(object):
+    # Columnar sample store. For each device: one array('Q') for the date, the time of day (ms)
+    # and each of the 11 counters. Deltas, bytes and MB conversions and the filtering are done
+    # on whole columns, with NumPy when it is installed and with the array module otherwise.
+    # Columns are computed and emptied every arg_chunkRows samples so memory stays bounded,
+    # the last sample is kept as the reference for the next chunk.
+    # With arg_firstRow the first sample of a device is written with zero deltas, otherwise
+    # it is only used as the reference for the next one.
+
+    def __init__(self, arg_firstRow, arg_chunkRows=STORE_CHUNK_ROWS):
+        self.firstRow = arg_firstRow
+        self._chunkRows = arg_chunkRows
+        self._dates = []
+        self._dateIndex = {}
+        self._columns = {}
+        self._hasReference = {}
+        self.summaries = {}
+
+    def append(self, arg_sample, arg_device):
+        # Returns True when the device chunk is full and compute_rows() should be called
+        _columns = self._columns.get(arg_device)
+        if _columns is None:
+            _columns = [array('Q') for _ in range(STORE_COLUMNS)]
+            self._columns[arg_device] = _columns
+            self._hasReference[arg_device] = False
+
+        _dateIndex = self._dateIndex.get(arg_sample.date)
+        if _dateIndex is None:
+            _dateIndex = len(self._dates)
+            self._dates.append(arg_sample.date)
+            self._dateIndex[arg_sample.date] = _dateIndex
+
+        _columns[0].append(_dateIndex)
+        _columns[1].append(arg_sample.totalTime)
+        for _column, _value in zip(islice(_columns, 2, None), arg_sample.counters):
+            _column.append(_value)
+        return len(_columns[1]) >= self._chunkRows
+
+    def compute_rows(self, arg_device, arg_sectorSize):
+        _columns = self._columns.get(arg_device)
+        if _columns is None or len(_columns[1]) == 0:
+            return []
+
+        # The first row is either the reference kept from the previous chunk or the first sample
+        _skipFirst = self._hasReference[arg_device] or not self.firstRow
+        if numpy is not None:
+            _rows = self._compute_rows_numpy(arg_device, _columns, _skipFirst, arg_sectorSize)
+        else:
+            _rows = self._compute_rows_array(arg_device, _columns, _skipFirst, arg_sectorSize)
+
+        # Keep the last sample as the reference for the next chunk
+        self._columns[arg_device] = [array('Q', x[-1:]) for x in _columns]
+        self._hasReference[arg_device] = True
+        return _rows
+
+    def _compute_rows_numpy(self, arg_device, arg_columns, arg_skipFirst, arg_sectorSize):
+        _values = [numpy.frombuffer(x, dtype=numpy.uint64).astype(numpy.int64) for x in arg_columns]
+        # [1] time [2] reads [4] sectors read [5] ms reading [6] writes [8] sectors written [9] ms writing
+        # [11] ms doing I/O [12] weighted ms doing I/O
+        _deltaTime, _deltaReads, _deltaReadSectors, _deltaReadTime, _deltaWrites, _deltaWriteSectors, _deltaWriteTime, _deltaIoTime, _deltaWeightedTime = \
+            [numpy.diff(_values[x], prepend=_values[x][:1]) for x in (1, 2, 4, 5, 6, 8, 9, 11, 12)]
+
+        # Exclude data that will bring inaccuracy (counters reset, day change)
+        _keep = (_deltaReadSectors + _deltaWriteSectors >= 0) & (_deltaTime >= 0)
+        if arg_skipFirst:
+            _keep[0] = False
+        _index = numpy.nonzero(_keep)[0]
+
+        _deltaTime = _deltaTime[_index]
+        _deltaReads = _deltaReads[_index]
+        _deltaWrites = _deltaWrites[_index]
+        _rBytes = _deltaReadSectors[_index] * arg_sectorSize
+        _wBytes = _deltaWriteSectors[_index] * arg_sectorSize
+        _rMBytes = numpy.round(_rBytes / float(1024 ** 2), 2)
+        _wMBytes = numpy.round(_wBytes / float(1024 ** 2), 2)
+
+        # Derived metrics, same definitions as iostat
+        _rAwait = numpy.where(_deltaReads > 0, _deltaReadTime[_index] / numpy.maximum(_deltaReads, 1), 0.0)
+        _wAwait = numpy.where(_deltaWrites > 0, _deltaWriteTime[_index] / numpy.maximum(_deltaWrites, 1), 0.0)
+        _util = numpy.where(_deltaTime > 0, numpy.minimum(100.0, _deltaIoTime[_index] * 100.0 / numpy.maximum(_deltaTime, 1)), 0.0)
+        _queueSize = numpy.where(_deltaTime > 0, _deltaWeightedTime[_index] / numpy.maximum(_deltaTime, 1), 0.0)
+
+        _summary = self._summary(arg_device)
+        _interval = _deltaTime > 0
+        _seconds = _deltaTime[_interval] / 1000.0
+        _summary.iops.add_many((_deltaReads + _deltaWrites)[_interval] / _seconds)
+        _summary.throughput.add_many((_rBytes + _wBytes)[_interval] / float(1024 ** 2) / _seconds)
+        _summary.rAwait.add_many(_rAwait[_deltaReads > 0])
+        _summary.wAwait.add_many(_wAwait[_deltaWrites > 0])
+
+        return self._format_rows(arg_device,
+                                 [_values[x][_index].tolist() for x in range(STORE_COLUMNS)],
+                                 _deltaTime.tolist(), _deltaReads.tolist(), _deltaWrites.tolist(),
+                                 _rBytes.tolist(), _wBytes.tolist(), _rMBytes.tolist(), _wMBytes.tolist(),
+                                 _rAwait.tolist(), _wAwait.tolist(), _util.tolist(), _queueSize.tolist())
+
+    def _compute_rows_array(self, arg_device, arg_columns, arg_skipFirst, arg_sectorSize):
+        _deltaTime, _deltaReads, _deltaReadSectors, _deltaReadTime, _deltaWrites, _deltaWriteSectors, _deltaWriteTime, _deltaIoTime, _deltaWeightedTime = \
+            [[0] + [b - a for a, b in zip(arg_columns[x], islice(arg_columns[x], 1, None))] for x in (1, 2, 4, 5, 6, 8, 9, 11, 12)]
+
+        # Exclude data that will bring inaccuracy (counters reset, day change)
+        _index = [i for i, (r, w, t) in enumerate(zip(_deltaReadSectors, _deltaWriteSectors, _deltaTime)) if r + w >= 0 and t >= 0]
+        if arg_skipFirst and _index and _index[0] == 0:
+            _index = _index[1:]
+
+        _rBytes = [_deltaReadSectors[i] * arg_sectorSize for i in _index]
+        _wBytes = [_deltaWriteSectors[i] * arg_sectorSize for i in _index]
+        _rMBytes = [round(float(x) / (1024 ** 2), 2) for x in _rBytes]
+        _wMBytes = [round(float(x) / (1024 ** 2), 2) for x in _wBytes]
+
+        # Derived metrics, same definitions as iostat
+        _rAwait = [_deltaReadTime[i] / _deltaReads[i] if _deltaReads[i] > 0 else 0.0 for i in _index]
+        _wAwait = [_deltaWriteTime[i] / _deltaWrites[i] if _deltaWrites[i] > 0 else 0.0 for i in _index]
+        _util = [min(100.0, _deltaIoTime[i] * 100.0 / _deltaTime[i]) if _deltaTime[i] > 0 else 0.0 for i in _index]
+        _queueSize = [_deltaWeightedTime[i] / _deltaTime[i] if _deltaTime[i] > 0 else 0.0 for i in _index]
+
+        _summary = self._summary(arg_device)
+        for i, _rBytesValue, _wBytesValue, _rAwaitValue, _wAwaitValue in zip(_index, _rBytes, _wBytes, _rAwait, _wAwait):
+            _summary.add(_deltaTime[i], _deltaReads[i], _deltaWrites[i], _rBytesValue + _wBytesValue, _rAwaitValue, _wAwaitValue)
+
+        return self._format_rows(arg_device,
+                                 [[x[i] for i in _index] for x in arg_columns],
+                                 [_deltaTime[i] for i in _index], [_deltaReads[i] for i in _index], [_deltaWrites[i] for i in _index],
+                                 _rBytes, _wBytes, _rMBytes, _wMBytes, _rAwait, _wAwait, _util, _queueSize)
+
+    def _summary(self, arg_device):
+        _summary = self.summaries.get(arg_device)
+        if _summary is None:
+            _summary = DeviceSummary()
+            self.summaries[arg_device] = _summary
+        return _summary
+
+    def _format_rows(self, arg_device, arg_columns, *arg_derived):
+        _dates = self._dates
+        _rows = []
+        for _values in zip(arg_columns[0], arg_columns[1], *(arg_derived + tuple(arg_columns[2:]))):
+            _rows.append(format_io_stat_line(_dates[_values[0]], arg_device, *_values[1:]))
+        return _rows
+
+
+def format_io_stat_line(arg_date, arg_device, arg_totalTime, arg_deltaTime, arg_deltaReads, arg_deltaWrites,
+                        arg_rBytes, arg_wBytes, arg_rMBytes, arg_wMBytes, arg_rAwait, arg_wAwait, arg_util, arg_queueSize, *arg_counters):
+
+    # Counters are in kernel order: reads, reads merged, sectors read, ms reading, writes, writes merged,
+    # sectors written, ms writing, I/O in progress, ms doing I/O, weighted ms doing I/O
+    return OUTPUT_ROW_FORMAT % (arg_date, arg_totalTime // 3600000, arg_totalTime // 60000 % 60, arg_totalTime // 1000 % 60, arg_totalTime % 1000,
+                                arg_device, arg_totalTime, arg_deltaTime,
+                                arg_deltaReads, arg_deltaWrites, arg_deltaReads + arg_deltaWrites,
+                                arg_rBytes, arg_wBytes, arg_rBytes + arg_wBytes,
+                                arg_rMBytes, arg_wMBytes, arg_rMBytes + arg_wMBytes,
+                                arg_counters[0], arg_counters[4], arg_counters[1], arg_counters[5],
+                                arg_counters[2], arg_counters[6], arg_counters[3], arg_counters[7],
+                                arg_counters[8], arg_counters[9], arg_counters[10],
+                                arg_rAwait, arg_wAwait, arg_util, arg_queueSize)
+
+
+class LiveOutput(object):
+    # Live mode: only the previous sample of each device is kept, the derived columns of
+    # compute_io_stats_single_disk are computed at each tick and written out right away,
+    # either as a table for the terminal or as the usual semicolon CSV.
+
+    def __init__(self, arg_scheduler, arg_device, arg_format, arg_stream):
+        self._scheduler = arg_scheduler
+        self._device = arg_device
+        self._csv = arg_format == "csv"
+        self._stream = arg_stream
+        self._previous = {}
+        self._sectorSizes = {}
+        self._rows = 0
+        self.summaries = {}
+        if self._csv:
+            self._stream.write(OUTPUT_HEADER + ";sector size\n")
+
+    def append_tick(self, arg_tickNs, arg_lines):
+        _output = []
+        for _sample in iterate_tick_samples(self._scheduler.wall_time_ns(arg_tickNs), arg_lines, self._device):
+            _row = self._compute(_sample)
+            if _row is not None:
+                _output.append(_row)
+
+        if _output:
+            if not self._csv and self._rows % LIVE_HEADER_ROWS < len(_output):
+                _output.insert(0, LIVE_HEADER)
+            self._rows += len(_output)
+            self._stream.write("\n".join(_output) + "\n")
+            self._stream.flush()
+
+    def close(self):
+        self._stream.flush()
+        # Summary goes with the messages, not in the CSV rows
+        print ("")
+        for line in format_io_summary(sorted(self.summaries.items())):
+            print (" " + line)
+
+    def _compute(self, arg_sample):
+        _item = arg_sample.device
+        _sectorSize = self._sectorSizes.get(_item)
+        if _sectorSize is None:
+            _sectorSize = get_device_sector_size(_item)
+            self._sectorSizes[_item] = _sectorSize
+
+        # The first sample of a device is compared to itself, a row of zeros
+        _delta = compute_io_delta(self._previous.get(_item, arg_sample), arg_sample, _sectorSize)
+        self._previous[_item] = arg_sample
+        if _delta is None:
+            return None
+
+        _rMBytes = round(float(_delta.readBytes) / (1024 ** 2), 2)
+        _wMBytes = round(float(_delta.writtenBytes) / (1024 ** 2), 2)
+
+        _summary = self.summaries.get(_item)
+        if _summary is None:
+            _summary = DeviceSummary()
+            self.summaries[_item] = _summary
+        _summary.add(_delta.deltaTime, _delta.reads, _delta.writes, _delta.readBytes + _delta.writtenBytes, _delta.rAwait, _delta.wAwait)
+
+        if self._csv:
+            return format_io_stat_line(_delta.date, _item, _delta.totalTime, _delta.deltaTime, _delta.reads, _delta.writes,
+                                       _delta.readBytes, _delta.writtenBytes, _rMBytes, _wMBytes, _delta.rAwait, _delta.wAwait,
+                                       _delta.util, _delta.queueSize, *_delta.counters) + ";" + str(_sectorSize)
+        return LIVE_ROW_FORMAT % (_delta.time, _item, _delta.deltaTime, _delta.reads, _delta.writes, _delta.reads + _delta.writes,
+                                  _rMBytes, _wMBytes, _rMBytes + _wMBytes, _delta.rAwait, _delta.wAwait, _delta.util, _delta.inProgress)
+
+
+class RollupAccumulator(object):
+    # Counters of the devices of each rollup group summed per tick. The sum of a tick is complete
+    # when a sample of a later tick comes, it is then returned as an IOSample of the group.
+
+    def __init__(self, arg_groups):
+        self.groups = [x for x, _members in arg_groups]
+        self._groupsOf = {}
+        for _group, _members in arg_groups:
+            for _item in _members:
+                self._groupsOf.setdefault(_item, []).append(_group)
+        self._current = {}
+
+    def add(self, arg_sample):
+        _done = []
+        for _group in self._groupsOf.get(arg_sample.device, ()):
+            _sum = self._current.get(_group)
+            if _sum is not None and (_sum.totalTime != arg_sample.totalTime or _sum.date != arg_sample.date):
+                _done.append(_sum)
+                _sum = None
+            if _sum is None:
+                self._current[_group] = IOSample(arg_sample.date, arg_sample.time, _group, arg_sample.totalTime, list(arg_sample.counters))
+            else:
+                _counters = _sum.counters
+                for _index, _value in enumerate(arg_sample.counters):
+                    _counters[_index] += _value
+        return _done
+
+    def flush(self):
+        _done = list(self._current.values())
+        self._current = {}
+        return _done
+
+
+def log_path(arg_path):
+
+    # Log file name with the extension of the codec in use
+    for _name, _extension, _module in LOG_CODECS:
+        if _name == log_compression:
+            return arg_path + _extension
+    return arg_path
+
+
+def open_log(arg_path, arg_mode="r"):
+
+    # Plain or compressed log, the codec is given by the extension. Text modes are text modes
+    # for the codecs too, seek() works on both but is emulated by decompression for the codecs.
+    for _name, _extension, _module in LOG_CODECS:
+        if arg_path.endswith(_extension):
+            return _module.open(arg_path, arg_mode if "b" in arg_mode else arg_mode + "t")
+    return open(arg_path, arg_mode)
+
+
+def strip_log_codec(arg_path):
+    for _name, _extension, _module in LOG_CODECS:
+        if arg_path.endswith(_extension):
+            return arg_path[:-len(_extension)]
+    return arg_path
+
+
+class LogWriter(CaptureWriter):
+    # Log files, plain or compressed by the writer thread so that neither the sampling loop nor
+    # the compute loop waits on the codec. A file is truncated the first time it is written.
+    _threadName = "log-writer"
+
+    def __init__(self):
+        CaptureWriter.__init__(self, None, False, LOG_WRITE_BATCH, None, open_log, True, LOG_QUEUE_DEPTH)
+
+
+class DeviceLogs(object):
+    # Per-device output files. Rows are appended in blocks by a LogWriter which keeps one file
+    # open at a time, so the number of open files does not grow with the number of devices.
+    # The byte offset of every LOG_INDEX_ROWS-th row is kept for the sidecar index written by close(),
+    # offsets are those of the uncompressed text.
+
+    def __init__(self, arg_dateTime, arg_sectorSizes=None):
+        self.devices = []
+        self.paths = {}
+        self.sectorSizes = {}
+        self._dateTime = arg_dateTime
+        self._knownSectorSizes = arg_sectorSizes or {}
+        self._offsets = {}
+        self._rows = {}
+        self._indexes = {}
+        self._writer = LogWriter()
+
+    def add_device(self, arg_device):
+        _sectorSize = self._knownSectorSizes.get(arg_device)
+        if _sectorSize is None:
+            _sectorSize = get_device_sector_size(arg_device)
+        _path = log_path("./" + os.uname()[1] + "_" + arg_device + "_" + self._dateTime + "_" + str(int(_sectorSize)) + ".log")
+        self._writer.write(_path, OUTPUT_HEADER + "\n")
+        self.devices.append(arg_device)
+        self.paths[arg_device] = _path
+        self.sectorSizes[arg_device] = _sectorSize
+        self._offsets[arg_device] = len(OUTPUT_HEADER) + 1
+        self._rows[arg_device] = 0
+        self._indexes[arg_device] = []
+
+    def write(self, arg_device, arg_rows):
+        if arg_rows:
+            self._writer.write(self.paths[arg_device], "\n".join(arg_rows) + "\n")
+            self._offsets[arg_device] = index_log_rows(self._indexes[arg_device], arg_rows, self._offsets[arg_device], self._rows[arg_device])
+            self._rows[arg_device] += len(arg_rows)
+
+    def close(self):
+        # Files are complete once the writer is drained, before write_all_file reads them
+        self._writer.close()
+        for _item in self.devices:
+            write_log_index(self.paths[_item], [(_item, len(OUTPUT_HEADER) + 1, self._offsets[_item], self._indexes[_item])])
+
+    def files(self):
+        return [(_item, self.paths[_item], self.sectorSizes[_item]) for _item in self.devices]
+
+
+def raise_open_files_limit(arg_files):
+
+    # Soft limit of open files raised, up to the hard limit, so that arg_files more can stay open
+    _soft, _hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    _needed = arg_files + OPEN_FILES_MARGIN
+    if _soft != resource.RLIM_INFINITY and _needed > _soft and _soft != _hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (_hard if _hard == resource.RLIM_INFINITY else min(_hard, _needed), _hard))
+
+
+def iterate_log_rows(arg_path, arg_sectorSize):
+
+    # (date, ms) keyed rows of a per-device log with the sector size appended
+    _suffix = ";" + str(arg_sectorSize) + "\n"
+    with open_log(arg_path, "r") as f:
+        next(f)
+        for line in f:
+            _fields = line.split(";", 4)
+            yield (_fields[0], int(_fields[3])), line[:-1] + _suffix
+
+
+def write_all_file(arg_path, arg_files):
+
+    # Rows of the per-device files (device, path, sector size) merged in time order, devices in
+    # the order given at the same time, with the sector size appended. The _all_ file is a
+    # single run of the index. Every per-device file is open during the merge.
+    arg_path = log_path(arg_path)
+    raise_open_files_limit(len(arg_files))
+
+    _index = []
+    _writer = LogWriter()
+    try:
+        _writer.write(arg_path, OUTPUT_HEADER + ";sector size\n")
+        _start = _offset = len(OUTPUT_HEADER) + len(";sector size\n")
+        _rows = heapq.merge(*[iterate_log_rows(_path, _sectorSize) for _item, _path, _sectorSize in arg_files], key=lambda x: x[0])
+        for _row, (_key, line) in enumerate(_rows):
+            if _row % LOG_INDEX_ROWS == 0:
+                _index.append((_key[0], _key[1], _offset))
+            _writer.write(arg_path, line)
+            _offset += len(line)
+    finally:
+        _writer.close()
+    write_log_index(arg_path, [("", _start, _offset, _index)])
 
-    _deltaTime = 0
-    _deltaReads = 0
-    _deltaWrites = 0
-    _deltaReadSectors = 0
-    _deltaWriteSectors = 0
-    _rBytes = 0
-    _wBytes = 0
-    _rMBytes = 0
-    _wMBytes = 0
-    _previousTime = 0
-    _previousReads = 0
-    _previousWrites = 0
-    _previousRsectors = 0
-    _previousWsectors = 0
 
-    _dateTime = datetime.utcnow().strftime('%Y-%m-%d_%H:%M:%S').replace(":","-")
+def index_log_rows(arg_index, arg_rows, arg_offset, arg_count):
+
+    # Entries of the rows to index appended to arg_index, from the cumulated row lengths (newlines
+    # included) of rows written at arg_offset after arg_count rows. Returns the offset after them.
+    _ends = list(accumulate(len(x) + 1 for x in arg_rows))
+    for i in range(-arg_count % LOG_INDEX_ROWS, len(arg_rows), LOG_INDEX_ROWS):
+        arg_index.append(log_index_entry(arg_rows[i], arg_offset + (_ends[i - 1] if i > 0 else 0)))
+    return arg_offset + _ends[-1]
+
+
+def log_index_entry(arg_row, arg_offset):
+    # (date, time (ms), byte offset) of a row
+    _fields = arg_row.split(";", 4)
+    return _fields[0], int(_fields[3]), arg_offset
+
+
+def write_log_index(arg_path, arg_runs):
+
+    # <log>.idx: a line per run (device;start;end offsets) followed by its date;ms;offset entries
+    with open(arg_path + ".idx", "w") as f:
+        f.write(LOG_INDEX_MAGIC + ";" + str(LOG_INDEX_ROWS) + "\n")
+        for _device, _start, _end, _entries in arg_runs:
+            f.write("run;%s;%d;%d\n" % (_device, _start, _end))
+            f.write("".join("%s;%d;%d\n" % x for x in _entries))
 
-    if _device == "all" or len(_device.split(",")) > 1:
-        compute_io_stats_all_disks(_iostats, _device)
+
+def read_log_index(arg_path):
+
+    # [(device, start, end, [(date, ms, offset)])], None without a valid index
+    try:
+        with open(arg_path + ".idx", "r") as f:
+            if not f.readline().startswith(LOG_INDEX_MAGIC + ";"):
+                return None
+            _runs = []
+            for line in f:
+                _fields = line.rstrip("\n").split(";")
+                if _fields[0] == "run":
+                    _runs.append((_fields[1], int(_fields[2]), int(_fields[3]), []))
+                else:
+                    _runs[-1][3].append((_fields[0], int(_fields[1]), int(_fields[2])))
+            return _runs
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+def compute_io_stats(_iostats, _device, _workers=1):
+
+    if not DeviceSelector(_device).single:
+        compute_io_stats_all_disks(_iostats, _device, _workers)
     else:
         compute_io_stats_single_disk(_iostats, _device)
 
     update_progressbar(" Completion", len(_iostats), len(_iostats))
 
 
-def compute_io_stats_all_disks(_iostats, _device):
-    _deltaTime = 0
-    _deltaReads = 0
-    _deltaWrites = 0
-    _deltaReadSectors = 0
-    _deltaWriteSectors = 0
-    _rBytes = 0
-    _wBytes = 0
-    _rMBytes = 0
-    _wMBytes = 0
-    _previousTime = 0
-    _previousReads = 0
-    _previousWrites = 0
-    _previousRsectors = 0
-    _previousWsectors = 0
-
-    _dateTime = datetime.utcnow().strftime('%Y-%m-%d_%H:%M:%S').replace(":","-")
+def compute_io_stats_all_disks(_iostats, _device, _workers=1):
 
     print (" Compute all disks metrics...")
 
-    _uniqueItems = []
-    if len(_device.split(",")) > 1:
-        for _item in _device.split(","):
-            if _item not in EXCLUDED_DEVICES:
-                _uniqueItems.append(_item)
+    # Workers read a streamed capture from its file, in-memory samples through fork
+    global compute_samples
+    _source = ("text", _iostats.path) if isinstance(_iostats, CaptureFile) else ("lines", None)
+    compute_samples = _iostats if _source[0] == "lines" else None
+    _topology = getattr(_iostats, "topology", None)
+    if _topology is None and _source[0] == "text":
+        print ("  No topology recorded with " + _iostats.path + ", the one of this system is used.")
+    try:
+        write_all_disks_logs(iterate_io_stats(_iostats), len(_iostats), _device, None, _source, _workers, _topology)
+    finally:
+        compute_samples = None
+
+
+def iterate_io_stats(_iostats):
+
+    _skipped = set()
+    for _stat in _iostats:
+        _sample = parse_io_stat(_stat)
+        if _sample is None:
+            _item = (_stat.split() + ["?"] * 5)[4]
+            if _item not in _skipped:
+                _skipped.add(_item)
+                print ("  Looks like partition data (" + _item + ")")
+            continue
+        yield _sample
+
+
+def write_all_disks_logs(_samples, _total, _device, _sectorSizes=None, _source=None, _workers=1, _topology=None, _dateTime=None):
+
+    if _dateTime is None:
+        _dateTime = datetime.utcnow().strftime('%Y-%m-%d_%H:%M:%S').replace(":","-")
+
+    # Topology of the capture when known, of this system otherwise
+    if _topology is None:
+        _topology = BlockTopology()
+    _knownSectorSizes = _topology.sector_sizes()
+    _knownSectorSizes.update(_sectorSizes or {})
+    _selector = DeviceSelector(_device)
+
+    # Rollups of the devices the selection captures, written to their own files but not to the _all_ file
+    _groups = _topology.rollups(set(x.name for x in _topology.devices.values() if _selector.matches(x.name, x.major, x.minor)))
+    _groupSectorSizes = dict((_group, _topology.sector_size(_members)) for _group, _members in _groups)
+    # Devices in the order given, even those without samples
+    _selected = _selector.names if _selector.explicit and len(_selector.names) > 1 else None
+
+    _files = None
+    if _source is not None and (_workers or os.cpu_count() or 1) > 1:
+        _files = write_device_logs_parallel(_source, _workers or os.cpu_count(), _selected, _groups, _dateTime, _knownSectorSizes, _groupSectorSizes)
+    if _files is None:
+        _files = write_device_logs(_samples, _total, _selected, _groups, _dateTime, _knownSectorSizes, _groupSectorSizes)
+    _deviceFiles, _rollupFiles, _summaries = _files
+
+    write_all_file("./" + os.uname()[1] + "_all_" + _dateTime + ".log", _deviceFiles)
+    if _topology.devices:
+        _topology.write("./" + os.uname()[1] + "_topology_" + _dateTime + ".log")
+        print ("")
+        print (" Device topology written to ./" + os.uname()[1] + "_topology_" + _dateTime + ".log")
+    if _rollupFiles:
+        print ("")
+        print (" Rollups: " + ", ".join(x[0] for x in _rollupFiles))
+    write_io_summary("./" + os.uname()[1] + "_summary_" + _dateTime + ".log",
+                     [(_item[0], _summaries[_item[0]]) for _item in _deviceFiles + _rollupFiles if _item[0] in _summaries])
+
+
+def write_device_logs(_samples, _total, _selected, _groups, _dateTime, _sectorSizes, _groupSectorSizes):
+
+    # Per-device and rollup logs of the samples, only those of the _selected devices if given.
+    # Returns the (device, path, sector size) of both and the summaries. No progress without _total.
+    _store = SampleStore(False)
+    _logs = DeviceLogs(_dateTime, _sectorSizes)
+    _rollups = RollupAccumulator(_groups)
+    _rollupLogs = DeviceLogs(_dateTime, _groupSectorSizes)
+    if _selected is not None:
+        for _item in _selected:
+            _logs.add_device(_item)
+        _selected = set(_selected)
+
+    _step = max(1, (_total or 0) // 100)
+    for _iCountStats, _sample in enumerate(_samples):
+        if _total is not None and _iCountStats % _step == 0:
+            update_progressbar(" Completion", _iCountStats, _total)
+
+        _item = _sample.device
+        if _item not in _logs.paths:
+            # Devices were selected at capture time
+            if _selected is not None:
+                continue
+            _logs.add_device(_item)
+
+        if _store.append(_sample, _item):
+            _logs.write(_item, _store.compute_rows(_item, _logs.sectorSizes[_item]))
+        for _sum in _rollups.add(_sample):
+            append_rollup(_store, _rollupLogs, _sum)
+
+    for _sum in _rollups.flush():
+        append_rollup(_store, _rollupLogs, _sum)
+    for _item in _logs.devices:
+        _logs.write(_item, _store.compute_rows(_item, _logs.sectorSizes[_item]))
+    for _item in _rollupLogs.devices:
+        _rollupLogs.write(_item, _store.compute_rows(_item, _rollupLogs.sectorSizes[_item]))
+    _logs.close()
+    _rollupLogs.close()
+    return _logs.files(), _rollupLogs.files(), _store.summaries
+
+
+def index_source_devices(arg_source):
+
+    # Positions of the samples of each device of a capture, devices in the order they first
+    # appear: record numbers of a binary capture, line numbers of the in-memory samples, byte
+    # offsets of the lines of a text capture
+    _kind, _path = arg_source
+    _index = {}
+    if _kind == "binary":
+        _capture = BinaryCapture(_path)
+        _ids = [_index.setdefault(x[0], array("Q")) for x in _capture.devices]
+        for i, _record in enumerate(_capture):
+            _ids[_record[1]].append(i)
+        _capture.close()
+        return _index
+    if _kind == "lines":
+        for i, line in enumerate(compute_samples):
+            _fields = line.split(None, 5)
+            if len(_fields) > 4:
+                _index.setdefault(_fields[4], array("Q")).append(i)
+        return _index
+    _offset = 0
+    with open(_path, "rb") as f:
+        for line in f:
+            _fields = line.split(None, 5)
+            if len(_fields) > 4:
+                _index.setdefault(_fields[4].decode(), array("Q")).append(_offset)
+            _offset += len(line)
+    return _index
+
+
+def iterate_source_samples(arg_source, arg_devices):
+
+    # Samples of arg_devices only, in capture order, from their positions in compute_index
+    _kind, _path = arg_source
+    _positions = heapq.merge(*[compute_index[x] for x in arg_devices if x in compute_index])
+    if _kind == "binary":
+        _capture = BinaryCapture(_path)
+        try:
+            for _sample in _capture.samples_at(_positions):
+                yield _sample
+        finally:
+            _capture.close()
+        return
+    if _kind == "lines":
+        _lines = (compute_samples[i] for i in _positions)
     else:
-        for _value in _iostats: 
-            if (_value.split()[4] not in EXCLUDED_DEVICES) and (_value.split()[4] not in _uniqueItems):
-                _uniqueItems.append(_value.split()[4])
-
-    _outputAllfile = "./" + os.uname()[1] + "_all_" + _dateTime + ".log"
-    _outputAllfile = open(_outputAllfile, "w")
-    _outputAllfile.write("date;time UTC;device;time (ms);delta time (ms);delta reads;delta writes;delta IOPS;delta Bytes read;delta Bytes written;delta Bytes;delta MBytes read;delta MBytes written;total MBytes;reads;writes;reads merged;writes merged;sector read;sector written;read time (ms);write time (ms);i/o in progress;time spent doing i/o (ms);weighted time spent doing i/o (ms);sector size\n")
-
-    _iCountStats = 0
-    for _item in _uniqueItems:
-        _sectorSize = get_device_sector_size(_item)
-        _outputfile = "./" + os.uname()[1] + "_" + _item + "_" + _dateTime + "_" + str(int(_sectorSize)) + ".log"
-
-        _outputfile = open(_outputfile, "w") 
-        _outputfile.write("date;time UTC;device;time (ms);delta time (ms);delta reads;delta writes;delta IOPS;delta Bytes read;delta Bytes written;delta Bytes;delta MBytes read;delta MBytes written;total MBytes;reads;writes;reads merged;writes merged;sector read;sector written;read time (ms);write time (ms);i/o in progress;time spent doing i/o (ms);weighted time spent doing i/o (ms)\n")
-
-        for _stat in _iostats:
-            update_progressbar(" Completion", _iCountStats, len(_iostats))
-
-            if _item == _stat.split()[4]:
-                _totalTime = (int(_stat.split()[1][:2])*3600000) + (int(_stat.split()[1][3:5])*60000) + (int(_stat.split()[1][6:8])*1000) + int(_stat.split()[1][9:13])
-                _deltaTime = _totalTime - _previousTime
-                _previousTime = _totalTime
-
-                if _iCountStats == 0:
-                    _deltaTime = 0
-                    _deltaReads = 0
-                    _deltaWrites = 0
-                    _deltaReadSectors = 0
-                    _deltaWriteSectors = 0
-                    _rBytes = 0
-                    _wBytes = 0
-                    _rMBytes = 0
-                    _wMBytes = 0
-                else:
-                    if len(_stat.split()) == 17:
-                        # Linux 2.4
-                        print ("  Looks like kernel version is lower than 2.6 (" + _item + ")")
-                    elif len(_stat.split()) == 16 or len(_stat.split()) == 20:
-                        # Linux 2.6+ for a device or partition (using /proc/disktats)
-                        # [5] reads [6] reads merged [7] sectors read [8] ms spent reading [9] writes [10] writes merged [11] sectors written [12] ms spent writing [13] I/O in progress [14] ms doing I/O [15] weighted ms doing I/Os
-                        _deltaReads = int(_stat.split()[5]) - _previousReads
-                        _deltaWrites = int(_stat.split()[9]) - _previousWrites
-                        _deltaReadSectors = int(_stat.split()[7]) - _previousRsectors
-                        _deltaWriteSectors = int(_stat.split()[11]) - _previousWsectors
-                    elif len(_stat.split()) == 9:
-                        # Linux 2.6+ for a partition
-                        # [3] reads [4] sectors read [5] writes [6] sectors written
-                        print ("  Looks like partition data (" + _item + ")")
-
-                    _rBytes = _deltaReadSectors * int(_sectorSize)
-                    _wBytes = _deltaWriteSectors * int(_sectorSize)
-                    _rMBytes = round(float(_rBytes) / (1024 ** 2), 2)
-                    _wMBytes = round(float(_wBytes) / (1024 ** 2), 2)
-
-                    _outputLine = ''
-                    if len(_stat.split()) == 17:
-                        # Linux 2.4
-                        print ("  Looks like kernel version is lower than 2.6 (" + _item + ")")
-                    if len(_stat.split()) == 16 or len(_stat.split()) == 20:
-                        # Linux 2.6+ for a device
-                        _previousReads = int(_stat.split()[5])
-                        _previousWrites = int(_stat.split()[9])
-                        _previousRsectors = int(_stat.split()[7])
-                        _previousWsectors = int(_stat.split()[11])
-                        if int(_deltaReadSectors + _deltaWriteSectors) >= 0 and _deltaTime >= 0:
-                            # Exclude initial data that will bring inaccuracy
-                            _outputLine = _stat.split()[0] + ";" + "'" + _stat.split()[1] + ";" + _item + ";" \
-                                + str(_totalTime) + ";" + str(_deltaTime) + ";" \
-                                + str(_deltaReads) + ";" + str(_deltaWrites) + ";" + str(_deltaReads + _deltaWrites) + ";" \
-                                + str(_rBytes) + ";" + str(_wBytes) + ";" + str(_rBytes + _wBytes) + ";" \
-                                + str(_rMBytes) + ";" + str(_wMBytes) + ";" + str(_rMBytes + _wMBytes) + ";" \
-                                + _stat.split()[5] + ";" + _stat.split()[9] + ";" \
-                                + _stat.split()[6] + ";" + _stat.split()[10] + ";" \
-                                + _stat.split()[7] + ";" + _stat.split()[11] + ";" \
-                                + _stat.split()[5] + ";" + _stat.split()[9] + ";" \
-                                + _stat.split()[8] + ";" + _stat.split()[12] + ";" \
-                                + _stat.split()[13] + ";" + _stat.split()[14] + ";" \
-                                + _stat.split()[15]
-                    if len(_stat.split()) == 7:
-                        # Linux 2.6+ for a partition
-                        print ("  Looks like partition data (" + _item + ")")
-
-                    if int(_deltaReadSectors + _deltaWriteSectors) >= 0 and _deltaTime >= 0:
-                        # Exclude initial data that will bring inaccuracy
-                        _outputfile.write(_outputLine + '\n')
-                        _outputAllfile.write(_outputLine + ";" + str(_sectorSize) + '\n')
-                _iCountStats = _iCountStats + 1
-        _outputfile.close()
-    _outputAllfile.close()
+        with open(_path, "rb") as f:
+            _map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        # find() gives -1 for a last line without end of line, taken up to the end of the file
+        _lines = (_map[i:_map.find(b"\n", i) % (len(_map) + 1)].decode() for i in _positions)
+    try:
+        for line in _lines:
+            _sample = parse_io_stat(line)
+            if _sample is not None:
+                yield _sample
+    finally:
+        if _kind == "text":
+            _map.close()
+
+
+def compute_device_logs(arg_job):
+
+    # Worker process: write_device_logs for a share of the devices, read from the capture itself
+    _source, _devices, _selected, _groups, _dateTime, _sectorSizes, _groupSectorSizes = arg_job
+    return write_device_logs(iterate_source_samples(_source, set(_devices)), None, _selected, _groups, _dateTime, _sectorSizes, _groupSectorSizes)
+
+
+def write_device_logs_parallel(_source, _workers, _selected, _groups, _dateTime, _sectorSizes, _groupSectorSizes):
+
+    # Devices are shared out to forked worker processes by number of samples, the members of a
+    # rollup group going to the same worker. The capture is read once here to index the samples
+    # of each device, then each worker reads only the samples of its devices: through mmap from
+    # the capture file or from the in-memory samples, the index being inherited through fork.
+    # Nothing is pickled but the job and the returned paths and summaries. None when there is a
+    # single share.
+    global compute_index
+    compute_index = index_source_devices(_source)
+    try:
+        return write_device_logs_shares(_source, _workers, _selected, _groups, _dateTime, _sectorSizes, _groupSectorSizes)
+    finally:
+        compute_index = None
+
+
+def write_device_logs_shares(_source, _workers, _selected, _groups, _dateTime, _sectorSizes, _groupSectorSizes):
+
+    _weights = dict((x, len(y)) for x, y in compute_index.items())
+    if _selected is not None:
+        _weights = dict((x, _weights.get(x, 0)) for x in _selected)
+    _order = dict((x, i) for i, x in enumerate(_weights))
+
+    _components = []
+    for _group, _members in _groups:
+        _merged = set(x for x in _members if x in _weights)
+        for _component in [x for x in _components if x & _merged]:
+            _merged |= _component
+            _components.remove(_component)
+        if _merged:
+            _components.append(_merged)
+    _grouped = set().union(*_components) if _components else set()
+    _components += [set([x]) for x in _weights if x not in _grouped]
+
+    _shares = [[0, []] for _ in range(min(_workers, len(_components)))]
+    if len(_shares) <= 1:
+        return None
+    for _component in sorted(_components, key=lambda x: -sum(_weights[y] for y in x)):
+        _share = min(_shares, key=lambda x: x[0])
+        _share[0] += sum(_weights[x] for x in _component)
+        _share[1].extend(_component)
+
+    _jobs = []
+    for _weight, _devices in _shares:
+        _devices.sort(key=_order.get)
+        _jobs.append((_source, _devices, [x for x in _selected if x in _devices] if _selected is not None else None,
+                      [x for x in _groups if set(x[1]) & set(_devices)], _dateTime, _sectorSizes, _groupSectorSizes))
+
+    print (" " + str(len(_weights)) + " device(s) shared out to " + str(len(_jobs)) + " worker processes...")
+    _deviceFiles = []
+    _rollupFiles = []
+    _summaries = {}
+    with multiprocessing.get_context("fork").Pool(len(_jobs)) as _pool:
+        update_progressbar(" Completion", 0, len(_jobs))
+        for _done, (_files, _rollups, _deviceSummaries) in enumerate(_pool.imap_unordered(compute_device_logs, _jobs)):
+            _deviceFiles += _files
+            _rollupFiles += _rollups
+            _summaries.update(_deviceSummaries)
+            update_progressbar(" Completion", _done + 1, len(_jobs))
+    _groupOrder = dict((x[0], i) for i, x in enumerate(_groups))
+    return sorted(_deviceFiles, key=lambda x: _order.get(x[0], len(_order))), sorted(_rollupFiles, key=lambda x: _groupOrder.get(x[0], 0)), _summaries
+
+
+def append_rollup(_store, _logs, _sample):
+
+    _item = _sample.device
+    if _item not in _logs.paths:
+        _logs.add_device(_item)
+    if _store.append(_sample, _item):
+        _logs.write(_item, _store.compute_rows(_item, _logs.sectorSizes[_item]))
+
+
+def convert_binary_capture(arg_path, arg_workers=1, arg_device=None):
+
+    # Same per-device and _all_ files as compute_io_stats_all_disks writes from a text capture,
+    # for the device selection of the capture unless arg_device is given
+    _capture = BinaryCapture(arg_path)
+    if arg_device is None:
+        arg_device = _capture.topology.selection if _capture.topology is not None and _capture.topology.selection else "all"
+    print (" Convert " + arg_path + " (" + str(len(_capture)) + " records, " + str(len(_capture.devices)) + " devices)...")
+    _sectorSizes = dict((_name, _sectorSize) for _name, _major, _minor, _sectorSize in _capture.devices)
+    if _capture.topology is None:
+        print ("  No topology recorded with " + arg_path + ", the one of this system is used.")
+    write_all_disks_logs(_capture.samples(), len(_capture), arg_device, _sectorSizes, ("binary", arg_path), arg_workers, _capture.topology)
+    update_progressbar(" Completion", len(_capture), len(_capture))
+
+
+class LogBucket(object):
+    # Rows of a device within one time bucket: sum and max of the delta columns, and the
+    # weights to get the bucket r_await, w_await (per I/O) and %util, queue size (per ms).
+    # suffix holds the columns copied as is, like the sector size of the _all_ file.
+    __slots__ = ("date", "index", "suffix", "rows", "sums", "maxs", "readTime", "writeTime", "busyTime", "queueTime")
+
+    def __init__(self, arg_date, arg_index, arg_suffix, arg_columns):
+        self.date = arg_date
+        self.index = arg_index
+        self.suffix = arg_suffix
+        self.rows = 0
+        self.sums = [0.0] * arg_columns
+        self.maxs = [0.0] * arg_columns
+        self.readTime = 0.0
+        self.writeTime = 0.0
+        self.busyTime = 0.0
+        self.queueTime = 0.0
+
+    def format(self, arg_device, arg_bucketMs, arg_formats, arg_columns, arg_derived):
+        # arg_columns: positions of delta time, delta reads and delta writes in the sums
+        _startMs = self.index * arg_bucketMs
+        _values = [_format % _sum + ";%.2f;" % (_sum / self.rows) + _format % _max for _format, _sum, _max in zip(arg_formats, self.sums, self.maxs)]
+        _line = "%s;'%02d:%02d:%02d.%03d;%s;%d;%d;" % (self.date, _startMs // 3600000, _startMs // 60000 % 60, _startMs // 1000 % 60, _startMs % 1000,
+                                                      arg_device, _startMs, self.rows) + ";".join(_values)
+        if arg_derived:
+            _elapsed, _reads, _writes = [self.sums[x] for x in arg_columns]
+            _line += ";%.2f;%.2f;%.2f;%.2f" % (self.readTime / _reads if _reads > 0 else 0.0, self.writeTime / _writes if _writes > 0 else 0.0,
+                                               self.busyTime / _elapsed if _elapsed > 0 else 0.0, self.queueTime / _elapsed if _elapsed > 0 else 0.0)
+        return _line + self.suffix
+
+
+def resample_log(arg_path, arg_bucket):
+
+    # Streams a per-device or _all_ log and writes one row per device and time bucket, memory
+    # only holds the current bucket of each device whatever the size of the log
+    _bucketMs = max(1, int(round(arg_bucket * 1000)))
+    _outputPath = log_path(os.path.splitext(strip_log_codec(arg_path))[0] + "_resampled_%gs.log" % arg_bucket)
+
+    with open_log(arg_path, "r") as _input:
+        _header = _input.readline().rstrip("\n").split(";")
+        try:
+            _date, _device, _time = _header.index("date"), _header.index("device"), _header.index("time (ms)")
+            _reads, _writes, _deltaTime = _header.index("delta reads"), _header.index("delta writes"), _header.index("delta time (ms)")
+        except ValueError:
+            print (" " + arg_path + " is not a per-device or _all_ log, skipped.")
+            return None
+        _deltas = [i for i, x in enumerate(_header) if x.startswith("delta ") or x == "total MBytes"]
+        # Logs written before the derived columns were added only get the delta columns
+        _derived = [_header.index(x) for x in ("r_await (ms)", "w_await (ms)", "%util", "avg queue size")] if "%util" in _header else None
+        _sector = _header.index("sector size") if "sector size" in _header else None
+
+        _names = [_header[i] for i in _deltas]
+        _output = LogWriter()
+        try:
+            _output.write(_outputPath, "date;time UTC;device;time (ms);rows;" + ";".join("%s sum;%s mean;%s max" % (x, x, x) for x in _names)
+                          + (";r_await (ms);w_await (ms);%util;avg queue size" if _derived else "") + (";sector size" if _sector is not None else "") + "\n")
+            _formats = ["%.2f" if "MBytes" in x else "%d" for x in _names]
+
+            _columns = [_deltas.index(_deltaTime), _deltas.index(_reads), _deltas.index(_writes)]
+            _buckets = {}
+            _rows = 0
+            for _lines in iter(lambda: _input.readlines(RESAMPLE_CHUNK_SIZE), []):
+                for line in _lines:
+                    _fields = line.rstrip("\n").split(";")
+                    if len(_fields) < len(_header):
+                        continue
+                    _item = _fields[_device]
+                    _index = int(_fields[_time]) // _bucketMs
+                    _bucket = _buckets.get(_item)
+                    if _bucket is None or _bucket.index != _index or _bucket.date != _fields[_date]:
+                        if _bucket is not None:
+                            _output.write(_outputPath, _bucket.format(_item, _bucketMs, _formats, _columns, _derived) + "\n")
+                        _bucket = LogBucket(_fields[_date], _index, ";" + _fields[_sector] if _sector is not None else "", len(_deltas))
+                        _buckets[_item] = _bucket
+
+                    _sums = _bucket.sums
+                    _maxs = _bucket.maxs
+                    for _column, _position in enumerate(_deltas):
+                        _value = float(_fields[_position])
+                        _sums[_column] += _value
+                        if _value > _maxs[_column]:
+                            _maxs[_column] = _value
+                    if _derived:
+                        # Await is per I/O of the row, %util and queue size per ms of the row
+                        _elapsed = float(_fields[_deltaTime])
+                        _bucket.readTime += float(_fields[_derived[0]]) * float(_fields[_reads])
+                        _bucket.writeTime += float(_fields[_derived[1]]) * float(_fields[_writes])
+                        _bucket.busyTime += float(_fields[_derived[2]]) * _elapsed
+                        _bucket.queueTime += float(_fields[_derived[3]]) * _elapsed
+                    _bucket.rows += 1
+                    _rows += 1
+
+            for _item, _bucket in _buckets.items():
+                _output.write(_outputPath, _bucket.format(_item, _bucketMs, _formats, _columns, _derived) + "\n")
+        finally:
+            _output.close()
+
+    print (" " + arg_path + ": " + str(_rows) + " rows resampled to " + ("%g" % arg_bucket) + " second buckets in " + _outputPath)
+    return _outputPath
+
+
+def find_log_runs(arg_path, arg_header):
+
+    # (start, end) byte offsets of the parts of a log in time order. Per-device logs are one
+    # run, _all_ logs are one run per device since rows are grouped by device.
+    _index = read_log_index(arg_path)
+    if _index is not None:
+        return [(_start, _end) for _device, _start, _end, _entries in _index]
+    _date, _time = arg_header.index("date"), arg_header.index("time (ms)")
+    _runs = []
+    with open_log(arg_path, "rb") as f:
+        _start = _offset = len(f.readline())
+        if "_all_" not in os.path.basename(arg_path):
+            # The uncompressed size of a compressed log is only known once read
+            return [(_start, os.fstat(f.fileno()).st_size if strip_log_codec(arg_path) == arg_path else _start + sum(len(x) for x in f))]
+        _previous = None
+        for line in f:
+            _fields = line.split(b";", _time + 1)
+            if len(_fields) > _time:
+                _key = (_fields[_date], int(_fields[_time]))
+                if _previous is not None and _key < _previous:
+                    _runs.append((_start, _offset))
+                    _start = _offset
+                _previous = _key
+            _offset += len(line)
+    _runs.append((_start, _offset))
+    return _runs
+
+
+def iterate_log_run(arg_path, arg_start, arg_end, arg_host, arg_sector, arg_header, arg_align):
+
+    # (date, ms) keyed rows of a run, the host and sector size are added to the row
+    _date, _timeUTC, _time = arg_header.index("date"), arg_header.index("time UTC"), arg_header.index("time (ms)")
+    _sector = arg_header.index("sector size") if "sector size" in arg_header else None
+    with open_log(arg_path, "rb") as f:
+        f.seek(arg_start)
+        _remaining = arg_end - arg_start
+        for line in f:
+            _remaining -= len(line)
+            if _remaining < 0:
+                break
+            _fields = line.decode("ascii").rstrip("\r\n").split(";")
+            if len(_fields) < len(arg_header):
+                continue
+            _ms = int(_fields[_time])
+            if arg_align:
+                _ms -= _ms % arg_align
+                _fields[_time] = str(_ms)
+                _fields[_timeUTC] = "'%02d:%02d:%02d.%03d" % (_ms // 3600000, _ms // 60000 % 60, _ms // 1000 % 60, _ms % 1000)
+            if _sector is None:
+                _fields.append(arg_sector)
+            yield (_fields[_date], _ms), arg_host + ";" + ";".join(_fields) + "\n"
+            if _remaining == 0:
+                break
+
+
+def parse_query_time(arg_text, arg_date):
+
+    # "YYYY-MM-DD HH:MM:SS[.mmm]" or "HH:MM:SS[.mmm]" on arg_date, as a (date, ms) key
+    _parts = arg_text.strip().split()
+    _date = _parts[0] if len(_parts) > 1 else arg_date
+    _time = _parts[-1].split(":")
+    return _date.encode("ascii"), int(round((int(_time[0]) * 3600 + int(_time[1]) * 60 + float(_time[2] if len(_time) > 2 else 0)) * 1000))
+
+
+def iterate_indexed_run(arg_open, arg_start, arg_end, arg_entries, arg_from, arg_to, arg_selector):
+
+    # Rows of a run from arg_from to arg_to, starting at the last index entry strictly before
+    # arg_from: rows of a tick share their key and the rows of the _all_ file, all devices in
+    # one run, may have an index entry in the middle of a tick.
+    # Each run reads through its own mmap or decompressed stream, opened by arg_open.
+    _position = arg_start
+    _keys = [(x[0].encode("ascii"), x[1]) for x in arg_entries]
+    _entry = bisect.bisect_left(_keys, arg_from) - 1
+    if _entry >= 0:
+        _position = arg_entries[_entry][2]
+    with arg_open() as f:
+        f.seek(_position)
+        while _position < arg_end:
+            _line = f.readline()
+            if not _line:
+                break
+            _position += len(_line)
+            _fields = _line.split(b";", 4)
+            if len(_fields) < 5:
+                continue
+            _key = (_fields[0], int(_fields[3]))
+            if _key > arg_to:
+                break
+            if _key < arg_from:
+                continue
+            if arg_selector is not None and not arg_selector.matches(_fields[2].decode("ascii"), 0, 0):
+                continue
+            yield _key, _line
+
+
+def query_log(arg_path, arg_from, arg_to, arg_filter, arg_output):
+
+    # Rows of a time range from a log through its sidecar index and mmap, in time order. Runs of
+    # the _all_ file whose device is not selected are not read at all. Without index the log is
+    # scanned once for its runs and each run read from its start. Compressed logs are read
+    # through the codec, which has to decompress up to the offset of the index entry.
+    _selector = DeviceSelector(arg_filter) if arg_filter else None
+    with open_log(arg_path, "rb") as f:
+        _header = f.readline()
+        _first = f.readline().split(b";", 1)[0].decode("ascii")
+    if not _first:
+        return 0
+    _runs = read_log_index(arg_path)
+    if _runs is None:
+        print (" No index for " + arg_path + ", the log is scanned.")
+        _runs = [(None, _start, _end, []) for _start, _end in find_log_runs(arg_path, _header.decode("ascii").rstrip("\r\n").split(";"))]
+
+    _file = None
+    if strip_log_codec(arg_path) == arg_path:
+        _file = open(arg_path, "rb")
+        _open = lambda: mmap.mmap(_file.fileno(), 0, access=mmap.ACCESS_READ)
+    else:
+        _open = lambda: open_log(arg_path, "rb")
+
+    _from = parse_query_time(arg_from, _first) if arg_from else (b"", 0)
+    _to = parse_query_time(arg_to, _first) if arg_to else (b"~", 0)
+    _readers = []
+    for _device, _start, _end, _entries in _runs:
+        # Runs of the _all_ files written before the time order have a device
+        if _device and _selector is not None:
+            if not _selector.matches(_device, 0, 0):
+                continue
+            _readers.append(iterate_indexed_run(_open, _start, _end, _entries, _from, _to, None))
+        else:
+            _readers.append(iterate_indexed_run(_open, _start, _end, _entries, _from, _to, _selector))
+
+    _rows = 0
+    try:
+        arg_output.write(_header)
+        for _key, _line in heapq.merge(*_readers, key=lambda x: x[0]):
+            arg_output.write(_line)
+            _rows += 1
+        arg_output.flush()
+    finally:
+        if _file is not None:
+            _file.close()
+    return _rows
+
+
+def merge_logs(arg_paths, arg_align, arg_output):
+
+    # Streaming k-way merge on a heap: one reader per sorted run of each log, so memory depends on
+    # the number of logs and devices, not on their size. Logs must have the same columns, the
+    # _all_ file sector size column being added to the others from their file name. Rows of the
+    # same time keep the order of the logs given, then of the devices in each log (heapq.merge
+    # is stable). With arg_align, times are rounded down to a multiple of arg_align seconds.
+    _header = None
+    _runs = []
+    for _path in arg_paths:
+        with open_log(_path, "r") as f:
+            _fileHeader = f.readline().rstrip("\r\n").split(";")
+        _columns = [x for x in _fileHeader if x != "sector size"]
+        if _header is None:
+            _header = _columns
+        elif _columns != _header:
+            print (" " + _path + " does not have the columns of " + arg_paths[0] + ", skipped.")
+            continue
+        _match = LOG_NAME.match(os.path.basename(_path))
+        _host = _match.group(1) if _match else os.path.basename(_path)
+        _sector = _match.group(4) if _match and _match.group(4) else ""
+        for _start, _end in find_log_runs(_path, _fileHeader):
+            _runs.append(iterate_log_run(_path, _start, _end, _host, _sector, _fileHeader, int(round(arg_align * 1000)) if arg_align else 0))
+
+    if _header is None:
+        return None
+    print (" Merging " + str(len(_runs)) + " sorted run(s) from " + str(len(arg_paths)) + " log(s)...")
+    _rows = 0
+    _output = LogWriter()
+    try:
+        _output.write(arg_output, "host;" + ";".join(_header) + ";sector size\n")
+        for _key, _line in heapq.merge(*_runs, key=lambda x: x[0]):
+            _output.write(arg_output, _line)
+            _rows += 1
+    finally:
+        _output.close()
+    print (" " + str(_rows) + " rows merged in " + arg_output)
+    return arg_output
 
 
 def compute_io_stats_single_disk(_iostats, _device):
-    _deltaTime = 0
-    _deltaReads = 0
-    _deltaWrites = 0
-    _deltaReadSectors = 0
-    _deltaWriteSectors = 0
-    _rBytes = 0
-    _wBytes = 0
-    _rMBytes = 0
-    _wMBytes = 0
-    _previousTime = 0
-    _previousReads = 0
-    _previousWrites = 0
-    _previousRsectors = 0
-    _previousWsectors = 0
 
     _dateTime = datetime.utcnow().strftime('%Y-%m-%d_%H:%M:%S').replace(":","-")
 
     print (" Compute disk" + _device + " metrics...")
 
-    _sectorSize = get_device_sector_size(_device)
-    _outputfile = "./" + os.uname()[1] + "_" + _device + "_" + _dateTime + "_" + str(int(_sectorSize)) + ".log"
-    _outputfile = open(_outputfile, "w")
-
-    _outputfile.write("date;time UTC;device;time (ms);delta time (ms);delta reads;delta writes;delta IOPS;delta Bytes read;delta Bytes written;delta Bytes;delta MBytes read;delta MBytes written;total MBytes;reads;writes;reads merged;writes merged;sector read;sector written;read time (ms);write time (ms);i/o in progress;time spent doing i/o (ms);weighted time spent doing i/o (ms)\n")
-
-    _iCountStats = 0
-    while _iCountStats < len(_iostats):
-        _stat = _iostats[_iCountStats]
-        update_progressbar(" Completion", _iCountStats, len(_iostats))
-
-        _totalTime = (int(_stat.split()[1][:2])*3600000) + (int(_stat.split()[1][3:5])*60000) + (int(_stat.split()[1][6:8])*1000) + int(_stat.split()[1][9:13])
-        _deltaTime = _totalTime - _previousTime
-        _previousTime = _totalTime
-
-        # Get data
-        if _iCountStats == 0:
-            _deltaTime = 0
-            _deltaReads = 0
-            _deltaWrites = 0
-            _deltaReadSectors = 0
-            _deltaWriteSectors = 0
-            _rBytes = 0
-            _wBytes = 0
-            _rMBytes = 0
-            _wMBytes = 0
-        else:
-            if len(_stat.split()) == 15:
-                # Linux 2.4
-                _deltaReads = int(_stat.split()[5]) - _previousReads
-                _deltaWrites = int(_stat.split()[9]) - _previousWrites
-                _deltaReadSectors = int(_stat.split()[7]) - _previousRsectors
-                _deltaWriteSectors = int(_stat.split()[11]) - _previousWsectors
-            elif len(_stat.split()) == 14 or len(_stat.split()) == 17:
-                # Linux 2.6+ for a device (using /proc/disktats)
-                _deltaReads = int(_stat.split()[5]) - _previousReads
-                _deltaWrites = int(_stat.split()[9]) - _previousWrites
-                _deltaReadSectors = int(_stat.split()[7]) - _previousRsectors
-                _deltaWriteSectors = int(_stat.split()[11]) - _previousWsectors
-            elif len(_stat.split()) == 13:
-                # Linux 2.6+ for a device or a partition (using /sys/block/*/stat)
-                # [2] reads [3] reads merged [4] sectors read [5] ms spent reading [6] writes [7] writes merged [8] sectors written [9] ms spent writing [10] I/O in progress [11] ms doing I/O [12] weighted ms doing I/Os
-                _deltaReads = int(_stat.split()[2]) - _previousReads
-                _deltaWrites = int(_stat.split()[6]) - _previousWrites
-                _deltaReadSectors = int(_stat.split()[4]) - _previousRsectors
-                _deltaWriteSectors = int(_stat.split()[8]) - _previousWsectors
-            elif len(_stat.split()) == 7:
-                # Linux 2.6+ for a partition
-                _deltaReads = int(_stat.split()[5]) - _previousReads
-                _deltaWrites = int(_stat.split()[9]) - _previousWrites
-                _deltaReadSectors = int(_stat.split()[7]) - _previousRsectors
-                _deltaWriteSectors = int(_stat.split()[11]) - _previousWsectors
-
-        if int(_deltaReadSectors + _deltaWriteSectors) >= 0 and _deltaTime >= 0:
-            _rBytes = _deltaReadSectors * int(_sectorSize)
-            _wBytes = _deltaWriteSectors * int(_sectorSize)
-            _rMBytes = round(float(_rBytes) / (1024 ** 2), 2)
-            _wMBytes = round(float(_wBytes) / (1024 ** 2), 2)
-
-            # Append context data with actual data
-            _outputLine = ''
-            if len(_stat.split()) == 15:
-                # Linux 2.4
-                _previousReads = int(_stat.split()[5])
-                _previousWrites = int(_stat.split()[9])
-                _previousRsectors = int(_stat.split()[7])
-                _previousWsectors = int(_stat.split()[11])
-
-                _outputLine = _stat.split()[0] + ";" + "'" + _stat.split()[1] + ";" \
-                    + _device + ";" \
-                    + str(_totalTime) + ";" + str(_deltaTime) + ";" \
-                    + str(_deltaReads) + ";" + str(_deltaWrites) + ";" + str(_deltaReads + _deltaWrites) + ";" \
-                    + str(_rBytes) + ";" + str(_wBytes) + ";" + str(_rBytes + _wBytes) + ";" \
-                    + str(_rMBytes) + ";" + str(_wMBytes) + ";" + str(_rMBytes + _wMBytes) + ";" \
-                    + _stat.split()[2] + ";" + _stat.split()[6] + ";" \
-                    + _stat.split()[3] + ";" + _stat.split()[7] + ";" \
-                    + _stat.split()[4] + ";" + _stat.split()[8] + ";" \
-                    + _stat.split()[5] + ";" + _stat.split()[9] + ";" \
-                    + _stat.split()[10] + ";" + _stat.split()[11] + ";" \
-                    + _stat.split()[12] + '\n'
-            if len(_stat.split()) == 14 or len(_stat.split()) == 17:
-                # Linux 2.6+ for a device
-                _previousReads = int(_stat.split()[5])
-                _previousWrites = int(_stat.split()[9])
-                _previousRsectors = int(_stat.split()[7])
-                _previousWsectors = int(_stat.split()[11])
-
-                _outputLine = _stat.split()[0] + ";" + "'" + _stat.split()[1] + ";" \
-                    + _device + ";" \
-                    + str(_totalTime) + ";" + str(_deltaTime) + ";" \
-                    + str(_deltaReads) + ";" + str(_deltaWrites) + ";" + str(_deltaReads + _deltaWrites) + ";" \
-                    + str(_rBytes) + ";" + str(_wBytes) + ";" + str(_rBytes + _wBytes) + ";" \
-                    + str(_rMBytes) + ";" + str(_wMBytes) + ";" + str(_rMBytes + _wMBytes) + ";" \
-                    + _stat.split()[2] + ";" + _stat.split()[6] + ";" \
-                    + _stat.split()[3] + ";" + _stat.split()[7] + ";" \
-                    + _stat.split()[4] + ";" + _stat.split()[8] + ";" \
-                    + _stat.split()[5] + ";" + _stat.split()[9] + ";" \
-                    + _stat.split()[10] + ";" + _stat.split()[11] + ";" \
-                    + _stat.split()[12] + '\n'
-            elif len(_stat.split()) == 13:
-                # Linux 2.6+ for a device or a partition (using /sys/block/*/stat)
-                _previousReads = int(_stat.split()[2])
-                _previousWrites = int(_stat.split()[6])
-                _previousRsectors = int(_stat.split()[4])
-                _previousWsectors = int(_stat.split()[8])
-                #"reads;writes;reads merged;writes merged;sector read;sector written;read time (ms);write time (ms);i/o in progress;time spent doing i/o (ms);weighted time spent doing i/o (ms)\n")
-                _outputLine = _stat.split()[0] + ";" + "'" + _stat.split()[1] + ";" \
-                    + _device + ";" \
-                    + str(_totalTime) + ";" + str(_deltaTime) + ";" \
-                    + str(_deltaReads) + ";" + str(_deltaWrites) + ";" + str(_deltaReads + _deltaWrites) + ";" \
-                    + str(_rBytes) + ";" + str(_wBytes) + ";" + str(_rBytes + _wBytes) + ";" \
-                    + str(_rMBytes) + ";" + str(_wMBytes) + ";" + str(_rMBytes + _wMBytes) + ";" \
-                    + _stat.split()[2] + ";" + _stat.split()[6] + ";" \
-                    + _stat.split()[3] + ";" + _stat.split()[7] + ";" \
-                    + _stat.split()[4] + ";" + _stat.split()[8] + ";" \
-                    + _stat.split()[5] + ";" + _stat.split()[9] + ";" \
-                    + _stat.split()[10] + ";" + _stat.split()[11] + ";" \
-                    + _stat.split()[12] + '\n'
-            if len(_stat.split()) == 7:
-                # Linux 2.6+ for a partition
-                _previousReads = int(_stat.split()[5])
-                _previousWrites = int(_stat.split()[9])
-                _previousRsectors = int(_stat.split()[7])
-                _previousWsectors = int(_stat.split()[11])
-
-                _outputLine = _stat.split()[0] + ";" + "'" + _stat.split()[1] + ";" \
-                    + _device + ";" \
-                    + str(_totalTime) + ";" + str(_deltaTime) + ";" \
-                    + str(_deltaReads) + ";" + str(_deltaWrites) + ";" + str(_deltaReads + _deltaWrites) + ";" \
-                    + str(_rBytes) + ";" + str(_wBytes) + ";" + str(_rBytes + _wBytes) + ";" \
-                    + str(_rMBytes) + ";" + str(_wMBytes) + ";" + str(_rMBytes + _wMBytes) + ";" \
-                    + _stat.split()[2] + ";" + _stat.split()[6] + ";" \
-                    + _stat.split()[3] + ";" + _stat.split()[7] + ";" \
-                    + _stat.split()[4] + ";" + _stat.split()[8] + ";" \
-                    + _stat.split()[5] + ";" + _stat.split()[9] + ";" \
-                    + _stat.split()[10] + ";" + _stat.split()[11] + ";" \
-                    + _stat.split()[12] + '\n'
-
-            _outputfile.write(_outputLine)
-        _iCountStats = _iCountStats + 1
-    _outputfile.close()
+    _store = SampleStore(True)
+    _logs = DeviceLogs(_dateTime)
+    _logs.add_device(_device)
+    _sectorSize = _logs.sectorSizes[_device]
 
-if __name__ == '__main__':
+    _total = len(_iostats)
+    _step = max(1, _total // 100)
+    for _iCountStats, _stat in enumerate(_iostats):
+        if _iCountStats % _step == 0:
+            update_progressbar(" Completion", _iCountStats, _total)
+
+        _sample = parse_io_stat(_stat, _device)
+        if _sample is None:
+            continue
 
-    os.system('clear')
+        if _store.append(_sample, _device):
+            _logs.write(_device, _store.compute_rows(_device, _sectorSize))
+
+    _logs.write(_device, _store.compute_rows(_device, _sectorSize))
+    _logs.close()
+    write_io_summary("./" + os.uname()[1] + "_summary_" + _dateTime + ".log", list(_store.summaries.items()))
+
+if __name__ == '__main__':
 
     scriptArguments = parse_script_arguments(sys.argv[1:])
 
+    if scriptArguments.live == "csv" or (scriptArguments.query is not None and scriptArguments.output is None):
+        # stdout only carries the CSV rows
+        liveStream = sys.stdout
+        sys.stdout = sys.stderr
+    else:
+        liveStream = None
+        os.system('clear')
+
     kernel_version = init()
+    stats_root = scriptArguments.root
+    log_compression = scriptArguments.compression
 
     print ("")
     print ("GetIOStats.py - Script version: " + SCRIPT_VERSION)
@@ -560,14 +3429,111 @@ if __name__ == '__main__':
         print ("Exiting...")
         sys.exit()
 
-    print (datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S') + " - Capturing I/Os metrics for device(s): " + scriptArguments[0] + ". Estimated duration: " + str(scriptArguments[1]) + " minute(s), interval: " + str(scriptArguments[2]) + " " + scriptArguments[3] + ". No output during capture.")
-    print (" Data is kept in memory so if this script is interrupted, no data will be collected.")
-    ioStats = get_io_stats(scriptArguments[0], float(scriptArguments[2]), int(scriptArguments[1]))
+    if scriptArguments.convert is not None:
+        print ("")
+        print (datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S') + " - Converting binary capture " + scriptArguments.convert + " to log files.")
+        try:
+            convert_binary_capture(scriptArguments.convert, scriptArguments.workers)
+        except ValueError as e:
+            print (" " + str(e))
+            print ("Exiting...")
+            sys.exit(2)
+        print ("")
+        print (datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S') + " - Process Completed. Please send the log file(s) to the Microsoft support engineer.")
+        print ("")
+        sys.exit()
+
+    if scriptArguments.query is not None:
+        _queryOptions = scriptArguments.queryOptions
+        if scriptArguments.output is not None:
+            with open_log(scriptArguments.output, "wb") as f:
+                _rows = query_log(scriptArguments.query, _queryOptions.start, _queryOptions.end, _queryOptions.filter, f)
+        else:
+            _rows = query_log(scriptArguments.query, _queryOptions.start, _queryOptions.end, _queryOptions.filter, liveStream.buffer)
+        print (" " + str(_rows) + " rows from " + scriptArguments.query + (" written to " + scriptArguments.output if scriptArguments.output is not None else ""))
+        sys.exit()
+
+    if scriptArguments.merge:
+        print ("")
+        print (datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S') + " - Merging " + str(len(scriptArguments.merge)) + " log file(s)"
+               + (", aligned on " + ("%g" % scriptArguments.align) + " second buckets." if scriptArguments.align else "."))
+        merge_logs(scriptArguments.merge, scriptArguments.align,
+                   scriptArguments.output or log_path("./merged_" + datetime.utcnow().strftime('%Y-%m-%d_%H:%M:%S').replace(":","-") + ".log"))
+        print ("")
+        print (datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S') + " - Process Completed.")
+        print ("")
+        sys.exit()
+
+    if scriptArguments.resample:
+        print ("")
+        print (datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S') + " - Resampling " + str(len(scriptArguments.resample)) + " log file(s) to " + ("%g" % scriptArguments.bucket) + " second buckets.")
+        for _item in scriptArguments.resample:
+            resample_log(_item, scriptArguments.bucket)
+        print ("")
+        print (datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S') + " - Process Completed.")
+        print ("")
+        sys.exit()
+
+    if scriptArguments.live is not None:
+        print (datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S') + " - Live I/Os metrics for device(s): " + scriptArguments.device + ". Duration: " + str(scriptArguments.timeToRun) + " minute(s), interval: " + str(scriptArguments.interval) + " " + scriptArguments.intervalUnit + ". Press Ctrl-C to stop.")
+        try:
+            get_io_stats(scriptArguments.device, float(scriptArguments.interval), int(scriptArguments.timeToRun), None, False, scriptArguments.live, liveStream, _profile=scriptArguments.profile, _adaptive=scriptArguments.adaptive, _processes=scriptArguments.processes)
+        except BrokenPipeError:
+            # Output piped to a command that exited (head, less...), stop quietly
+            os.dup2(os.open(os.devnull, os.O_WRONLY), (liveStream or sys.stdout).fileno())
+            sys.exit()
+        print ("")
+        print (datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S') + " - Process Completed.")
+        print ("")
+        sys.exit()
+
+    if scriptArguments.export is not None:
+        print (datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S') + " - Exporter for device(s): " + scriptArguments.device + ", interval: " + str(scriptArguments.interval) + " " + scriptArguments.intervalUnit + ". Press Ctrl-C to stop.")
+        get_io_stats(scriptArguments.device, float(scriptArguments.interval), 0, _profile=scriptArguments.profile, _export=scriptArguments.export, _adaptive=scriptArguments.adaptive)
+        print ("")
+        print (datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S') + " - Process Completed.")
+        print ("")
+        sys.exit()
+
+    if scriptArguments.flightRecorder is not None:
+        _flightOptions = scriptArguments.flightRecorder
+        _triggers = "kill -USR1 " + str(os.getpid())
+        if _flightOptions.triggerFile is not None:
+            _triggers += ", touch " + _flightOptions.triggerFile
+        if _flightOptions.triggerIops is not None:
+            _triggers += ", " + str(_flightOptions.triggerIops) + " IOPS"
+        if _flightOptions.triggerAwait is not None:
+            _triggers += ", " + str(_flightOptions.triggerAwait) + "ms await"
+        print (datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S') + " - Flight recorder for device(s): " + scriptArguments.device + ". Keeping " + str(_flightOptions.before) + " second(s) before and " + str(_flightOptions.after) + " second(s) after a trigger, interval: " + str(scriptArguments.interval) + " " + scriptArguments.intervalUnit + ". Press Ctrl-C to stop.")
+        print (" Triggers: " + _triggers)
+        get_io_stats(scriptArguments.device, float(scriptArguments.interval), 0, None, False, None, None, scriptArguments.flightRecorder, scriptArguments.profile, _adaptive=scriptArguments.adaptive)
+        print ("")
+        print (datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S') + " - Process Completed. Please send the log file(s) to the Microsoft support engineer.")
+        print ("")
+        sys.exit()
+
+    print (datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S') + " - Capturing I/Os metrics for device(s): " + scriptArguments.device + ". Estimated duration: " + str(scriptArguments.timeToRun) + " minute(s), interval: " + str(scriptArguments.interval) + " " + scriptArguments.intervalUnit + ". No output during capture.")
+    captureFile = None
+    if scriptArguments.stream:
+        captureFile = "./" + os.uname()[1] + "_capture_" + datetime.utcnow().strftime('%Y-%m-%d_%H:%M:%S').replace(":","-") + (".bin" if scriptArguments.binary else ".raw")
+        print (" Samples are streamed to " + captureFile + " so if this script is interrupted, samples captured so far are kept.")
+    else:
+        print (" Data is kept in memory so if this script is interrupted, no data will be collected.")
+    ioStats = get_io_stats(scriptArguments.device, float(scriptArguments.interval), int(scriptArguments.timeToRun), captureFile, scriptArguments.binary, _profile=scriptArguments.profile, _adaptive=scriptArguments.adaptive, _processes=scriptArguments.processes)
+    if ioStats is None:
+        print ("")
+        print (datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S') + " - Nothing to process.")
+        print ("")
+        sys.exit()
 
     # Process collected data and flush to output files
     print ("")
     print (datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S') + " - Processing I/O statistics and flushing to file: " + str(len(ioStats)) + " samples.")
-    compute_io_stats(ioStats, scriptArguments[0])
+    if scriptArguments.binary:
+        ioStats.close()
+        convert_binary_capture(captureFile, scriptArguments.workers, scriptArguments.device)
+    else:
+        compute_io_stats(ioStats, scriptArguments.device, scriptArguments.workers)
 
     print ("")
     print (datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S') + " - Process Completed. Please send the log file(s) to the Microsoft support engineer.")
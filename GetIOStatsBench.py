@@ -0,0 +1,231 @@
+#!/usr/bin/python
+
+# GetIOStatsBench.py # benchmark of GetIOStats.py collection and post-processing
+# Synthetic /proc/diskstats and /sys/block trees are generated for 1, 64 and 1024 devices with
+# 14 (2.6 kernels), 18 (4.18+, discards) and 20 (5.5+, flushes) field lines, and the collector is
+# pointed at them through GetIOStats.stats_root, so no real disk is needed.
+# Each case runs in its own process so that the peak RSS reported is the one of the case.
+
+import os
+import sys
+import getopt
+import time
+import shutil
+import tempfile
+import subprocess
+import resource
+from datetime import datetime, timedelta
+
+import GetIOStats
+
+BENCH_DEVICES = (1, 64, 1024)
+BENCH_FIELDS = (14, 18, 20)
+BENCH_DURATION = 2.0
+BENCH_INTERVAL = 0.01
+# Samples generated for the post-processing cases, whatever the device count
+BENCH_SAMPLES = 200000
+BENCH_HEADER = "%-18s %7s %6s %10s %10s %10s %10s %9s %12s %10s" % ("case", "devices", "fields", "seconds", "ticks/s", "jitter ms", "max ms", "overruns", "samples/s", "peak RSS KB")
+BENCH_ROW_FORMAT = "%-18s %7d %6d %10.2f %10.1f %10.3f %10.3f %9d %12.0f %10d"
+
+
+def show_help():
+    print ("")
+    print ("GetIOStatsBench.py [-t <seconds per collector case>] [-i <interval (seconds)>] [-n <samples per post-processing case>]")
+    print ("")
+    print ("Benchmark GetIOStats.py on synthetic diskstats trees: sampling rate, jitter, samples parsed per second and peak RSS.")
+    print ("")
+
+
+def device_name(arg_index):
+
+    # sda..sdz, sdaa..sdzz, like the kernel names SCSI disks
+    _name = ""
+    arg_index += 1
+    while arg_index > 0:
+        arg_index, _letter = divmod(arg_index - 1, 26)
+        _name = chr(ord("a") + _letter) + _name
+    return "sd" + _name
+
+
+def device_counters(arg_index, arg_tick, arg_fields):
+
+    # Counters growing at a steady pace, different for each device
+    _reads = arg_tick * (3 + arg_index % 7)
+    _writes = arg_tick * (2 + arg_index % 5)
+    _counters = [_reads, _reads // 4, _reads * 8, _reads * 2,
+                 _writes, _writes // 3, _writes * 16, _writes * 3,
+                 arg_index % 4, arg_tick * 10, arg_tick * 25]
+    return _counters + [arg_tick] * (arg_fields - 3 - len(_counters))
+
+
+def diskstats_line(arg_index, arg_tick, arg_fields):
+    return "%4d %7d %s %s" % (8 + arg_index // 16, (arg_index % 16) * 16, device_name(arg_index),
+                              " ".join(str(x) for x in device_counters(arg_index, arg_tick, arg_fields)))
+
+
+def create_fixture(arg_root, arg_devices, arg_fields):
+
+    os.makedirs(os.path.join(arg_root, "proc"))
+    with open(os.path.join(arg_root, "proc", "diskstats"), "w") as f:
+        for _index in range(arg_devices):
+            f.write(diskstats_line(_index, 1000, arg_fields) + "\n")
+
+    for _index in range(arg_devices):
+        _path = os.path.join(arg_root, "sys", "block", device_name(_index))
+        os.makedirs(os.path.join(_path, "queue"))
+        with open(os.path.join(_path, "stat"), "w") as f:
+            f.write(" ".join("%8d" % x for x in device_counters(_index, 1000, arg_fields)) + "\n")
+        with open(os.path.join(_path, "dev"), "w") as f:
+            f.write("%d:%d\n" % (8 + _index // 16, (_index % 16) * 16))
+        with open(os.path.join(_path, "queue", "hw_sector_size"), "w") as f:
+            f.write("512\n")
+
+
+def generate_samples(arg_devices, arg_fields, arg_samples, arg_single):
+
+    # Text capture lines as get_io_stats returns them, 25ms apart
+    _samples = []
+    _start = datetime(2024, 1, 1)
+    for _tick in range(max(2, arg_samples // arg_devices)):
+        _timestamp = (_start + timedelta(milliseconds=25 * _tick)).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3] + " "
+        if arg_single:
+            _samples.append(_timestamp + " ".join(str(x) for x in device_counters(0, _tick, arg_fields)))
+            continue
+        for _index in range(arg_devices):
+            _samples.append(_timestamp + diskstats_line(_index, _tick, arg_fields))
+    return _samples
+
+
+def run_collector(arg_device, arg_duration, arg_interval):
+
+    # Same loop as get_io_stats with the in-memory sink, wake up times are kept for the jitter
+    _collector = GetIOStats.Collector(arg_device, arg_interval)
+    _scheduler = _collector.scheduler
+    _stats = []
+    _wakes = []
+    _endNs = time.monotonic_ns() + int(arg_duration * 1000000000)
+    _ticks = _collector.ticks()
+    try:
+        for _tickNs, _lines in _ticks:
+            if _tickNs >= _endNs:
+                break
+            _timestamp = _scheduler.timestamp(_tickNs) + " "
+            for line in _lines:
+                _stats.append(_timestamp + line)
+            _wakes.append(_tickNs)
+    finally:
+        _ticks.close()
+
+    _deviations = [abs(_wakes[i] - _wakes[i - 1] - _scheduler.intervalNs) / 1000000.0 for i in range(1, len(_wakes))] or [0.0]
+    _seconds = (_wakes[-1] - _wakes[0]) / 1000000000.0 if len(_wakes) > 1 else 0.0
+    return [_seconds, (len(_wakes) - 1) / _seconds if _seconds > 0 else 0.0, sum(_deviations) / len(_deviations), max(_deviations),
+            _scheduler.overruns, len(_stats) / _seconds if _seconds > 0 else 0.0]
+
+
+def run_postprocessing(arg_devices, arg_fields, arg_samples, arg_single, arg_workers=1):
+
+    _samples = generate_samples(arg_devices, arg_fields, arg_samples, arg_single)
+    _start = time.perf_counter()
+    if arg_single:
+        GetIOStats.compute_io_stats_single_disk(_samples, device_name(0))
+    else:
+        GetIOStats.compute_io_stats_all_disks(_samples, "all", arg_workers)
+    _seconds = time.perf_counter() - _start
+    return [_seconds, 0.0, 0.0, 0.0, 0, len(_samples) / _seconds]
+
+
+def run_case(arg_case, arg_root, arg_devices, arg_fields, arg_duration, arg_interval, arg_samples):
+
+    # Child process: GetIOStats messages are dropped, only the result line goes to stdout
+    _stdout = os.dup(1)
+    _null = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(_null, 1)
+    _workDir = tempfile.mkdtemp(prefix="getiostats_bench_")
+    try:
+        os.chdir(_workDir)
+        GetIOStats.kernel_version = GetIOStats.init()
+        GetIOStats.stats_root = arg_root
+        # One descriptor per device is kept open by the /sys/block source
+        _soft, _hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if _hard == resource.RLIM_INFINITY or _hard > _soft:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (_hard if _hard != resource.RLIM_INFINITY else max(_soft, 65536), _hard))
+
+        if arg_case == "collect diskstats":
+            _result = run_collector("all", arg_duration, arg_interval)
+        elif arg_case == "collect sysfs":
+            # A single device goes through the single disk source, without the diskstats prefix
+            _result = run_collector(",".join(device_name(x) for x in range(arg_devices)), arg_duration, arg_interval)
+        elif arg_case == "compute workers":
+            # One worker process per CPU, peak RSS is the one of the parent only
+            _result = run_postprocessing(arg_devices, arg_fields, arg_samples, False, 0)
+        else:
+            _result = run_postprocessing(arg_devices, arg_fields, arg_samples, arg_case == "compute single")
+        sys.stdout.flush()
+    finally:
+        os.chdir("/")
+        shutil.rmtree(_workDir, ignore_errors=True)
+        os.dup2(_stdout, 1)
+
+    print (";".join(str(x) for x in _result + [resource.getrusage(resource.RUSAGE_SELF).ru_maxrss]))
+
+
+def main(arg_args):
+
+    _duration = BENCH_DURATION
+    _interval = BENCH_INTERVAL
+    _samples = BENCH_SAMPLES
+
+    try:
+        _options, arg_args = getopt.getopt(arg_args, "ht:i:n:", ["duration=", "interval=", "samples=", "case="])
+    except getopt.GetoptError:
+        show_help()
+        sys.exit(2)
+
+    _case = None
+    for _option, _argument in _options:
+        if _option == "-h":
+            show_help()
+            sys.exit(2)
+        elif _option in ("-t", "--duration"):
+            _duration = float(_argument)
+        elif _option in ("-i", "--interval"):
+            _interval = float(_argument)
+        elif _option in ("-n", "--samples"):
+            _samples = int(_argument)
+        elif _option == "--case":
+            _case = _argument
+
+    if _case is not None:
+        # --case <name>;<root>;<devices>;<fields>, used by the parent process
+        _name, _root, _devices, _fields = _case.split(";")
+        run_case(_name, _root, int(_devices), int(_fields), _duration, _interval, _samples)
+        return
+
+    print ("GetIOStatsBench.py - GetIOStats.py version: " + GetIOStats.SCRIPT_VERSION + ", Python " + sys.version.split()[0])
+    print ("Collector cases: " + str(_duration) + " second(s) at a " + str(_interval) + " second interval. Post-processing cases: " + str(_samples) + " samples.")
+    print ("")
+    print (BENCH_HEADER)
+    _fixtures = tempfile.mkdtemp(prefix="getiostats_fixture_")
+    try:
+        for _devices in BENCH_DEVICES:
+            for _fields in BENCH_FIELDS:
+                _root = os.path.join(_fixtures, "%d_%d" % (_devices, _fields))
+                create_fixture(_root, _devices, _fields)
+                _cases = ["collect diskstats", "collect sysfs", "compute all"]
+                if _devices == 1:
+                    _cases.append("compute single")
+                elif (os.cpu_count() or 1) > 1:
+                    _cases.append("compute workers")
+                for _name in _cases:
+                    _output = subprocess.check_output([sys.executable, os.path.abspath(__file__), "-t", str(_duration), "-i", str(_interval), "-n", str(_samples),
+                                                       "--case", ";".join([_name, _root, str(_devices), str(_fields)])], universal_newlines=True)
+                    _result = _output.strip().splitlines()[-1].split(";")
+                    print (BENCH_ROW_FORMAT % tuple([_name, _devices, _fields] + [float(x) for x in _result[:4]] + [int(_result[4]), float(_result[5]), int(_result[6])]))
+                    sys.stdout.flush()
+                shutil.rmtree(_root)
+    finally:
+        shutil.rmtree(_fixtures, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
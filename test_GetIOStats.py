@@ -0,0 +1,828 @@
+#!/usr/bin/python
+
+# test_GetIOStats.py # behavior checks of GetIOStats.py, python -m pytest -q
+# Statistics come from the synthetic trees and samples of GetIOStatsBench.py, logs are written
+# to a temporary directory.
+
+import glob
+import io
+import os
+import random
+import re
+import shutil
+import signal
+import subprocess
+import threading
+import time
+import urllib.request
+
+import pytest
+
+import GetIOStats
+import GetIOStatsBench
+
+
+@pytest.fixture
+def fixture_root(tmp_path, monkeypatch):
+
+    # 12 devices of 14 fields, the log files are written below tmp_path/work
+    _root = str(tmp_path / "root")
+    GetIOStatsBench.create_fixture(_root, 12, 14)
+    monkeypatch.setattr(GetIOStats, "stats_root", _root)
+    monkeypatch.setattr(GetIOStats, "kernel_version", GetIOStats.init())
+    (tmp_path / "work").mkdir()
+    monkeypatch.chdir(tmp_path / "work")
+    return _root
+
+
+def read_log(arg_pattern):
+    _paths = glob.glob(arg_pattern)
+    assert len(_paths) == 1, _paths
+    with open(_paths[0], "rb") as f:
+        return _paths[0], f.read()
+
+
+def read_output_files(arg_directory):
+    # {file name without its date: content} of the log, index, summary and topology files
+    _files = {}
+    for _path in glob.glob(os.path.join(arg_directory, "*")):
+        with open(_path, "rb") as f:
+            _files[re.sub(r"\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2}", "DATE", os.path.basename(_path))] = f.read()
+    return _files
+
+
+def test_query_tick_across_index_stride(fixture_root, monkeypatch):
+
+    # An index entry every 5 rows of the _all_ file: ticks of 12 rows all have one in the middle
+    monkeypatch.setattr(GetIOStats, "LOG_INDEX_ROWS", 5)
+    _samples = GetIOStatsBench.generate_samples(12, 14, 12 * 40, False)
+    GetIOStats.compute_io_stats_all_disks(_samples, "all", 1)
+    _path, _log = read_log("*_all_*.log")
+    _rows = _log.splitlines(True)[1:]
+
+    for _tick in range(1, 40):
+        _time = "00:00:%02d.%03d" % (_tick * 25 // 1000, _tick * 25 % 1000)
+        _expected = [x for x in _rows if (";'" + _time + ";").encode("ascii") in x]
+        assert len(_expected) == 12
+        _output = io.BytesIO()
+        assert GetIOStats.query_log(_path, _time, _time, None, _output) == 12
+        assert _output.getvalue().splitlines(True)[1:] == _expected
+
+
+def test_process_exec_into_selected_name(monkeypatch):
+
+    # Not selected as bash, selected at the next listing once it has exec'd sleep
+    monkeypatch.setattr(GetIOStats, "PROCESS_RESCAN_INTERVAL", 0)
+    _process = subprocess.Popen(["bash", "-c", "sleep 0.5; exec sleep 5"])
+    _source = GetIOStats.ProcessIOSource(GetIOStats.ProcessSelector("re:^sleep$"))
+    try:
+        assert _process.pid not in [x[0] for x in _source.read()]
+        _deadline = time.monotonic() + 5
+        while GetIOStats.read_sysfs_attribute("/proc/%d/comm" % _process.pid) != "sleep" and time.monotonic() < _deadline:
+            time.sleep(0.05)
+        assert _process.pid in [x[0] for x in _source.read()]
+    finally:
+        _source.close()
+        _process.kill()
+        _process.wait()
+
+
+def test_process_found_by_rescan_started(monkeypatch):
+
+    # Started after the first listing and found by a rescan, not by the PID probes: counts from zero
+    monkeypatch.setattr(GetIOStats, "PROCESS_RESCAN_INTERVAL", 0)
+    _source = GetIOStats.ProcessIOSource(GetIOStats.ProcessSelector("re:^sleep$"))
+    _process = None
+    try:
+        _source.read()
+        _process = subprocess.Popen(["sleep", "5"])
+        _deadline = time.monotonic() + 5
+        while GetIOStats.read_sysfs_attribute("/proc/%d/comm" % _process.pid) != "sleep" and time.monotonic() < _deadline:
+            time.sleep(0.05)
+        assert [x[6] for x in _source.read() if x[0] == _process.pid] == [True]
+        assert [x[6] for x in _source.read() if x[0] == _process.pid] == [False]
+    finally:
+        _source.close()
+        if _process is not None:
+            _process.kill()
+            _process.wait()
+
+
+def test_process_rescan_skips_unselected(monkeypatch):
+
+    # The status of processes not selected is read once, not at every listing
+    monkeypatch.setattr(GetIOStats, "PROCESS_RESCAN_INTERVAL", 0)
+    _source = GetIOStats.ProcessIOSource(GetIOStats.ProcessSelector("re:^no such command$"))
+    _status = _source._status
+    _reads = []
+    monkeypatch.setattr(_source, "_status", lambda x: _reads.append(x) or _status(x))
+    try:
+        _source.read()
+        _first = set(_reads)
+        del _reads[:]
+        _source.read()
+        assert len(_first) > 1
+        assert not _first & set(_reads)
+    finally:
+        _source.close()
+
+
+def test_process_log_delta_rows(tmp_path, monkeypatch):
+
+    # A child writing 5 then 10 times: its rows carry the syscw deltas (plus its answers, the same at
+    # both ticks), the timestamps of the disk samples of the tick and their delta time, whatever
+    # the ns within the ms of the ticks
+    monkeypatch.chdir(tmp_path)
+    _child = subprocess.Popen(["python", "-c", "import os, sys\n"
+                               "for line in sys.stdin:\n"
+                               "    for i in range(int(line)):\n"
+                               "        os.write(1, b'')\n"
+                               "    print('ok', flush=True)\n"],
+                              stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True)
+    _scheduler = GetIOStats.TickScheduler(0.01)
+    _baseNs = time.monotonic_ns()
+    _baseNs += (900000 - _scheduler.wall_time_ns(_baseNs)) % 1000000
+    _ticks = [_baseNs, _baseNs + 10200000, _baseNs + 20000000]
+    _log = GetIOStats.ProcessIOLog(_scheduler, GetIOStats.ProcessSelector(str(_child.pid)), "processes.log")
+    try:
+        _log.append_tick(_ticks[0])
+        for _tickNs, _count in zip(_ticks[1:], (5, 10)):
+            _child.stdin.write("%d\n" % _count)
+            _child.stdin.flush()
+            assert _child.stdout.readline() == "ok\n"
+            _log.append_tick(_tickNs)
+    finally:
+        _log.close()
+        _child.kill()
+        _child.wait()
+
+    _rows = [x.split(";") for x in read_log("processes.log")[1].decode().splitlines()[1:]]
+    _expected = []
+    _syscw = None
+    for i, _count in ((1, 5), (2, 10)):
+        _date, _time, _totalTime = GetIOStats.wall_time_fields(_scheduler.wall_time_ns(_ticks[i]))
+        _previous = GetIOStats.wall_time_fields(_scheduler.wall_time_ns(_ticks[i - 1]))[2]
+        _expected.append([_date, "'" + _time, str(_child.pid), str(_totalTime), str(_totalTime - _previous)])
+    assert [x[:5] for x in _rows] == _expected
+    assert int(_rows[1][9]) - int(_rows[0][9]) == 5
+    assert [x[4] for x in _rows] == ["11", "9"]
+    assert int(_rows[1][13]) - int(_rows[0][13]) == int(_rows[1][9])
+
+
+def test_stream_capture_interrupted(fixture_root, monkeypatch):
+
+    # Ctrl-C at the 50th tick: the ticks before it are read back whole from the capture file
+    _open_tick_source = GetIOStats.open_tick_source
+
+    class InterruptedSource(object):
+        def __init__(self, *arg_args):
+            self._source = _open_tick_source(*arg_args)
+            self._reads = 0
+
+        def read(self):
+            self._reads += 1
+            if self._reads == 50:
+                raise KeyboardInterrupt()
+            return self._source.read()
+
+        def close(self):
+            self._source.close()
+
+    monkeypatch.setattr(GetIOStats, "open_tick_source", InterruptedSource)
+    _capture = GetIOStats.get_io_stats("all", 0.001, 1, "capture.raw")
+    assert isinstance(_capture, GetIOStats.CaptureFile)
+    assert len(_capture) == 49 * 12
+    _samples = [GetIOStats.parse_io_stat(x) for x in _capture]
+    assert all(x is not None for x in _samples)
+    assert [x.device for x in _samples] == [GetIOStatsBench.device_name(i) for i in range(12)] * 49
+
+
+def test_capture_writer_backpressure():
+
+    # The disk is stuck: appends block once the queue and the batch being written are full,
+    # then go on in order once it writes again
+    class StuckFile(object):
+        def __init__(self):
+            self.data = []
+            self.writing = threading.Event()
+            self.resume = threading.Event()
+
+        def write(self, arg_data):
+            self.writing.set()
+            self.resume.wait()
+            self.data.append(arg_data)
+
+        def close(self):
+            pass
+
+    _file = StuckFile()
+    _writer = GetIOStats.CaptureWriter("capture.raw", arg_batchSize=1, arg_flushInterval=None, arg_open=lambda *x: _file, arg_queueDepth=2)
+    _appends = threading.Thread(target=lambda: [_writer.append("%d\n" % i) for i in range(10)])
+    _appends.start()
+    assert _file.writing.wait(5)
+    _appends.join(0.2)
+    assert _appends.is_alive()
+    assert _writer.count == 4
+    _file.resume.set()
+    _appends.join(5)
+    _writer.close()
+    assert b"".join(_file.data) == "".join("%d\n" % i for i in range(10)).encode("ascii")
+
+
+SELECTOR_DEVICES = [("sda", 8, 0), ("sda1", 8, 1), ("sdb", 8, 16), ("nvme0n1", 259, 0), ("nvme0n1p1", 259, 1),
+                    ("dm-0", 253, 0), ("zram0", 252, 0), ("loop0", 7, 0), ("sr0", 11, 0), ("fd0", 2, 0)]
+SELECTOR_ALL = ["sda", "sda1", "sdb", "nvme0n1", "nvme0n1p1", "dm-0", "zram0"]
+
+
+@pytest.mark.parametrize("arg_device, arg_selected", [
+    ("all", SELECTOR_ALL),
+    ("*", SELECTOR_ALL),
+    ("sda,sdb", ["sda", "sdb"]),
+    ("nvme*n1", ["nvme0n1"]),
+    ("dm-*,sd?", ["sda", "sdb", "dm-0"]),
+    ("re:^sd[a-z]$", ["sda", "sdb"]),
+    ("re:p[0-9]+$", ["nvme0n1p1", "loop0"]),
+    ("8:*", ["sda", "sda1", "sdb"]),
+    ("259:0", ["nvme0n1"]),
+    ("!zram*", SELECTOR_ALL[:-1]),
+    ("!sd*,!8:*", ["nvme0n1", "nvme0n1p1", "dm-0", "zram0"]),
+    ("all,!zram*,!dm-*", ["sda", "sda1", "sdb", "nvme0n1", "nvme0n1p1"]),
+    ("sd*,!sda1", ["sda", "sdb"]),
+    ("all,loop0", SELECTOR_ALL + ["loop0"]),
+    ("loop*,sr*", ["loop0", "sr0"]),
+    ("!loop0", SELECTOR_ALL),
+])
+def test_device_selector(arg_device, arg_selected):
+
+    # Globs, re:, major:minor and negations; fd, sr and loop devices only when asked for by name or pattern
+    _selector = GetIOStats.DeviceSelector(arg_device)
+    assert [x[0] for x in SELECTOR_DEVICES if _selector.matches(*x)] == arg_selected
+
+
+@pytest.mark.parametrize("arg_device, arg_explicit, arg_single", [
+    ("sda", True, True),
+    ("sda,sdb", True, False),
+    ("sda,!sdb", True, False),
+    ("sd*", False, False),
+    ("all", False, False),
+])
+def test_device_selector_kind(arg_device, arg_explicit, arg_single):
+
+    _selector = GetIOStats.DeviceSelector(arg_device)
+    assert (_selector.explicit, _selector.single) == (arg_explicit, arg_single)
+
+
+def test_diskstats_resolved_on_change_only(fixture_root, monkeypatch):
+
+    # Resolved at the first read and when a device replaces another, not at every tick nor every second
+    _messages = []
+    _source = GetIOStats.DiskStatsSource(GetIOStats.DeviceSelector("sd*"), _messages.append)
+    _resolve = _source._resolve
+    _resolved = []
+    monkeypatch.setattr(_source, "_resolve", lambda x: _resolved.append(len(x)) or _resolve(x))
+    _path = os.path.join(fixture_root, "proc", "diskstats")
+    with open(_path, "r") as f:
+        _lines = f.read().splitlines()
+    try:
+        _first = _source.read()
+        for _ in range(3):
+            assert _source.read() == _first
+        assert _resolved == [12]
+        with open(_path, "w") as f:
+            f.write("\n".join(_lines[:3] + [_lines[3].replace(" sdd ", " sdzz ")] + _lines[4:]) + "\n")
+        assert [x.split()[2] for x in _source.read()] == [x.split()[2] for x in _first[:3]] + ["sdzz"] + [x.split()[2] for x in _first[4:]]
+        _source.read()
+        assert _resolved == [12, 12]
+        assert len(_messages) == 1
+    finally:
+        _source.close()
+
+
+def test_binary_capture_timestamps_match_text(fixture_root):
+
+    # Tick times at any ns within the ms, the binary records must give the text capture timestamps
+    _scheduler = GetIOStats.TickScheduler(0.001)
+    _line = GetIOStatsBench.diskstats_line(0, 1000, 14) + "\n"
+    _ticks = [1000000000 + i * 1000037 + (i * i * 7919) % 1000000 for i in range(20000)]
+    _writer = GetIOStats.BinaryCaptureWriter("capture.bin", _scheduler, "all")
+    for _tickNs in _ticks:
+        _writer.append_tick(_tickNs, [_line])
+    _writer.close()
+
+    _capture = GetIOStats.BinaryCapture("capture.bin")
+    _binary = [(x.date, x.time, x.totalTime) for x in _capture.samples()]
+    _capture.close()
+    _text = [(x.date, x.time, x.totalTime) for x in (GetIOStats.parse_io_stat(_scheduler.timestamp(y) + " " + _line) for y in _ticks)]
+    assert _binary == _text
+
+
+def test_binary_capture_interrupted_before_first_tick(fixture_root, monkeypatch):
+
+    # Nothing to read back nor to convert: no empty capture left, a ValueError for one
+    class InterruptedSource(object):
+        def read(self):
+            raise KeyboardInterrupt()
+
+        def close(self):
+            pass
+
+    monkeypatch.setattr(GetIOStats, "open_tick_source", lambda *x: InterruptedSource())
+    assert GetIOStats.get_io_stats("all", 0.01, 1, "capture.bin", True) is None
+    assert glob.glob("capture.bin*") == []
+
+    open("empty.bin", "wb").close()
+    with pytest.raises(ValueError, match="before its first tick"):
+        GetIOStats.convert_binary_capture("empty.bin")
+
+
+def test_collector_missing_device(fixture_root, capsys):
+
+    # A library error, nothing printed and no SystemExit
+    with pytest.raises(ValueError):
+        next(GetIOStats.Collector("nosuchdisk", 0.01).deltas())
+    assert capsys.readouterr().out == ""
+
+
+def test_collectors_with_their_own_roots(tmp_path, capsys):
+
+    # Side by side in one process, each reading its own root, the module globals left as they are
+    _roots = [str(tmp_path / "root4"), str(tmp_path / "root6")]
+    GetIOStatsBench.create_fixture(_roots[0], 4, 14)
+    GetIOStatsBench.create_fixture(_roots[1], 6, 18)
+    _kernel, _root = GetIOStats.kernel_version, GetIOStats.stats_root
+    _ticks = [GetIOStats.Collector("all", 0.001, arg_root=x).ticks() for x in _roots]
+    for _ in range(3):
+        assert [len(next(x)[1]) for x in _ticks] == [4, 6]
+    for _iterator in _ticks:
+        _iterator.close()
+    assert (GetIOStats.kernel_version, GetIOStats.stats_root) == (_kernel, _root)
+
+    # Messages go to the log given, not to the standard output
+    _messages = []
+    _writer = GetIOStats.BinaryCaptureWriter(str(tmp_path / "capture.bin"), GetIOStats.TickScheduler(0.001), "all", _messages.append)
+    _writer.append_tick(1000000, [GetIOStatsBench.diskstats_line(0, 1000, 14) + "\n"])
+    _writer.append_tick(2000000, [GetIOStatsBench.diskstats_line(1, 1000, 14) + "\n"])
+    _writer.close()
+    assert len(_messages) == 1
+    assert capsys.readouterr().out == ""
+
+
+def test_collector_ticks_from_first_iteration(fixture_root):
+
+    # Time spent between the construction and the iteration is neither overrun nor missed ticks
+    _collector = GetIOStats.Collector("all", 0.05, 0.2)
+    _ticks = _collector.ticks()
+    time.sleep(0.3)
+    assert len(list(_ticks)) == 5
+    assert _collector.scheduler.missed == 0
+
+
+def test_scheduler_slow_consumer(monkeypatch):
+
+    # On a simulated clock: a 25ms consumer at the second tick of a 10ms grid makes one overrun and
+    # one missed deadline, the next ticks are back on the grid of the first one
+    class Clock(object):
+        nowNs = 5000000000
+
+        def monotonic_ns(self):
+            return self.nowNs
+
+        def time_ns(self):
+            return self.nowNs
+
+        def sleep(self, arg_seconds):
+            self.nowNs += int(round(arg_seconds * 1000000000))
+
+    _clock = Clock()
+    monkeypatch.setattr(GetIOStats, "time", _clock)
+    _scheduler = GetIOStats.TickScheduler(0.01)
+    _ticks = []
+    _deadlines = []
+    for _consumerMs in (3, 25, 3, 3, 3):
+        _ticks.append(_scheduler.wait() - 5000000000)
+        _deadlines.append(_scheduler.deadlineNs - 5000000000)
+        _clock.nowNs += _consumerMs * 1000000
+    assert _ticks == [0, 10000000, 35000000, 40000000, 50000000]
+    assert _deadlines == [0, 10000000, 30000000, 40000000, 50000000]
+    assert (_scheduler.ticks, _scheduler.overruns, _scheduler.missed) == (5, 1, 1)
+
+
+def test_overhead_logs_not_overwritten(fixture_root):
+
+    # Two runs writing in the same second get their own file
+    _paths = []
+    for _ in range(3):
+        _collector = GetIOStats.Collector("all", 0.001, 0.01)
+        _ticks = len(list(_collector.ticks()))
+        _paths.append(_collector.overhead.write("host_overhead_2024-01-01_00-00-00.log"))
+    assert _paths == ["host_overhead_2024-01-01_00-00-00.log", "host_overhead_2024-01-01_00-00-00-1.log", "host_overhead_2024-01-01_00-00-00-2.log"]
+    assert sorted(glob.glob("*_overhead_*")) == sorted(_paths)
+    assert all(open(x).readline().startswith("Collector: %d ticks " % _ticks) for x in _paths)
+
+
+def test_tick_samples_match_parsed_lines(fixture_root):
+
+    # Samples built from the split fields equal the parse of the timestamped text line
+    _scheduler = GetIOStats.TickScheduler(0.001)
+    _lines = [GetIOStatsBench.diskstats_line(i, 1000, 14) for i in range(12)]
+    _tickNs = 1000000000 + 123456789
+    _samples = list(GetIOStats.iterate_tick_samples(_scheduler.wall_time_ns(_tickNs), _lines, "all"))
+    _parsed = [GetIOStats.parse_io_stat(_scheduler.timestamp(_tickNs) + " " + x) for x in _lines]
+    assert len(_samples) == 12
+    assert [(x.date, x.time, x.device, x.totalTime, x.counters) for x in _samples] == \
+        [(x.date, x.time, x.device, x.totalTime, x.counters) for x in _parsed]
+
+
+def test_convert_with_capture_topology(fixture_root):
+
+    # Converted with the topology recorded when the capture started, not the one of /sys now
+    _capture = GetIOStats.get_io_stats("all", 0.01, 0.001, "capture.bin", True)
+    _capture.close()
+    shutil.rmtree(os.path.join(fixture_root, "sys", "block", "sdl"))
+    GetIOStats.convert_binary_capture("capture.bin")
+    _path, _log = read_log("*_topology_*.log")
+    assert _log.count(b"\n") == 13
+    assert b"\nsdl;8:176;" in _log
+    assert GetIOStats.BlockTopology("capture.bin.topology").sector_sizes() == dict((GetIOStatsBench.device_name(i), 512) for i in range(12))
+
+
+def test_convert_with_capture_selection(fixture_root):
+
+    # Partitions only: their disk is not captured, so the conversion makes their disk_sda rollup
+    os.makedirs(os.path.join(fixture_root, "sys", "class", "block"))
+    for _index in (1, 2):
+        _path = os.path.join(fixture_root, "sys", "block", "sda", "sda%d" % _index)
+        os.makedirs(_path)
+        for _name, _value in (("partition", "%d" % _index), ("dev", "8:%d" % _index), ("stat", "1 0 8 1 1 0 8 1 0 1 2")):
+            with open(os.path.join(_path, _name), "w") as f:
+                f.write(_value + "\n")
+        os.symlink(_path, os.path.join(fixture_root, "sys", "class", "block", "sda%d" % _index))
+    _capture = GetIOStats.get_io_stats("sda1,sda2", 0.01, 0.001, "capture.bin", True)
+    _capture.close()
+    GetIOStats.convert_binary_capture("capture.bin")
+    assert len(glob.glob("*_disk_sda_*.log")) == 1
+
+
+def test_flight_recorder_dumps_within_a_second(fixture_root):
+
+    # Two windows triggered 40ms apart are written to their own files
+    _scheduler = GetIOStats.TickScheduler(0.01)
+    _recorder = GetIOStats.FlightRecorder(_scheduler, "all", 0.01, (0.02, 0.02, None, None, None))
+    try:
+        for _tick in range(8):
+            if _tick in (1, 5):
+                os.kill(os.getpid(), signal.SIGUSR1)
+            _recorder.append_tick(1000000000 + _tick * 10000000, [GetIOStatsBench.diskstats_line(i, 1000 + _tick, 14) for i in range(12)])
+    finally:
+        _recorder.close()
+    _paths = sorted(glob.glob("*_all_*.log"))
+    assert len(_paths) == 2
+    assert all(GetIOStats.LOG_NAME.match(x) for x in _paths)
+
+
+
+@pytest.mark.parametrize("arg_trigger", ["iops", "await"])
+def test_flight_recorder_threshold_triggers(fixture_root, capsys, arg_trigger):
+
+    # 100 IOPS and 2ms await for 4 ticks, then 200 IOPS or 20ms await: one trigger at the crossing
+    # with 150 IOPS or 10ms, not again while above, and its window written
+    _scheduler = GetIOStats.TickScheduler(0.01)
+    _options = (0.02, 0.02, 150, None, None) if arg_trigger == "iops" else (0.02, 0.02, None, 10, None)
+    _recorder = GetIOStats.FlightRecorder(_scheduler, "all", 0.01, _options)
+    _reads = _readTicks = 0
+    _ticks = [1000000000 + i * 10000000 for i in range(10)]
+    try:
+        for i, _tickNs in enumerate(_ticks):
+            _reads += 2 if i >= 4 and arg_trigger == "iops" else 1
+            _readTicks += 20 if i >= 4 and arg_trigger == "await" else 2
+            _recorder.append_tick(_tickNs, ["   8       0 sda %d 0 %d %d 0 0 0 0 0 %d %d" % (_reads, _reads * 8, _readTicks, i * 10, _readTicks)])
+    finally:
+        _recorder.close()
+    _triggers = [x for x in capsys.readouterr().out.splitlines() if "Triggered by" in x]
+    assert _triggers == [" " + _scheduler.timestamp(_ticks[4]) + " - Triggered by threshold, recording 0 more second(s)..."]
+    assert len(glob.glob("*_all_*.log")) == 1
+
+
+def test_flight_recorder_ring_limit(fixture_root, monkeypatch):
+
+    # Refused at the first tick, before the ring is allocated
+    _recorder = GetIOStats.FlightRecorder(GetIOStats.TickScheduler(0.01), "all", 0.01, (0.02, 0.02, None, None, None))
+    monkeypatch.setattr(GetIOStats, "FLIGHT_MAX_RING_SIZE", 12 * 6 * GetIOStats.FLIGHT_RECORD.size - 1)
+    try:
+        with pytest.raises(ValueError, match="above the 0 MB limit"):
+            _recorder.append_tick(1000000000, [GetIOStatsBench.diskstats_line(i, 1000, 14) for i in range(12)])
+        assert _recorder._ring is None
+    finally:
+        _recorder.close()
+
+
+@pytest.mark.parametrize("arg_fields", [14, 18, 20])
+def test_bench_fixture_lines_parse(tmp_path, arg_fields):
+
+    # The bench trees and samples are accepted by the collector parsing, whatever the kernel format
+    _root = str(tmp_path / "root")
+    GetIOStatsBench.create_fixture(_root, 40, arg_fields)
+    with open(os.path.join(_root, "proc", "diskstats"), "r") as f:
+        _lines = f.read().splitlines()
+    _samples = [GetIOStats.parse_io_stat("2024-01-01 00:00:00.000 " + x) for x in _lines]
+    assert [x.device for x in _samples] == [GetIOStatsBench.device_name(i) for i in range(40)]
+    assert all(x.counters == GetIOStatsBench.device_counters(i, 1000, arg_fields)[:11] for i, x in enumerate(_samples))
+    with open(os.path.join(_root, "sys", "block", "sdc", "stat"), "r") as f:
+        assert GetIOStats.parse_io_stat("2024-01-01 00:00:00.000 " + f.read(), "sdc").counters == _samples[2].counters
+
+    for _single in (False, True):
+        _lines = GetIOStatsBench.generate_samples(4, arg_fields, 400, _single)
+        _samples = [GetIOStats.parse_io_stat(x, "sda" if _single else None) for x in _lines]
+        assert None not in _samples
+        assert len(_samples) == (100 if _single else 400)
+        assert _samples[-1].totalTime == 99 * 25
+
+
+@pytest.mark.parametrize("arg_stream", [False, True])
+def test_parallel_logs_match_serial(fixture_root, tmp_path, monkeypatch, arg_stream):
+
+    # In-memory samples reach the workers through fork, streamed ones through the capture file
+    _samples = GetIOStatsBench.generate_samples(12, 14, 12 * 200, False)
+    if arg_stream:
+        with open(str(tmp_path / "capture.raw"), "w") as f:
+            f.write("\n".join(_samples) + "\n")
+        _samples = GetIOStats.CaptureFile(str(tmp_path / "capture.raw"))
+    _outputs = []
+    for _workers in (1, 2):
+        _directory = tmp_path / ("workers_%d" % _workers)
+        _directory.mkdir()
+        monkeypatch.chdir(_directory)
+        GetIOStats.compute_io_stats_all_disks(_samples, "all", _workers)
+        _outputs.append(read_output_files(str(_directory)))
+    assert len(_outputs[0]) == 12 * 2 + 4
+    assert _outputs[0] == _outputs[1]
+
+
+@pytest.mark.parametrize("arg_kind", ["lines", "text"])
+def test_worker_reads_its_devices_only(tmp_path, monkeypatch, arg_kind):
+
+    # A worker parses the lines of its devices only, in capture order, the last without end of line
+    _lines = GetIOStatsBench.generate_samples(12, 14, 12 * 50, False)
+    _path = str(tmp_path / "capture.raw")
+    with open(_path, "w") as f:
+        f.write("\n".join(_lines))
+    monkeypatch.setattr(GetIOStats, "compute_samples", _lines)
+    monkeypatch.setattr(GetIOStats, "compute_index", GetIOStats.index_source_devices((arg_kind, _path)))
+    _parsed = []
+    _parse = GetIOStats.parse_io_stat
+    monkeypatch.setattr(GetIOStats, "parse_io_stat", lambda x: _parsed.append(x) or _parse(x))
+    _devices = set(x.split()[4] for x in _lines[:12:5] + _lines[-1:])
+    _samples = [(x.device, x.totalTime, x.counters) for x in GetIOStats.iterate_source_samples((arg_kind, _path), _devices)]
+    _expected = [x for x in _lines if x.split()[4] in _devices]
+    assert _parsed == _expected
+    assert _samples == [(x.device, x.totalTime, x.counters) for x in map(_parse, _expected)]
+
+
+@pytest.mark.parametrize("arg_many", [False, True])
+def test_quantile_sketch_accuracy(arg_many):
+
+    # Log-normal await-like values with idle intervals at 0: each quantile within SKETCH_ACCURACY
+    # of the value of the same rank in the sorted values
+    _random = random.Random(12345)
+    _values = [_random.lognormvariate(0.5, 1.5) for _ in range(100000)] + [0.0] * 5000
+    _sketch = GetIOStats.QuantileSketch()
+    if arg_many:
+        if GetIOStats.numpy is None:
+            pytest.skip("NumPy is not installed")
+        _sketch.add_many(GetIOStats.numpy.array(_values))
+    else:
+        for _value in _values:
+            _sketch.add(_value)
+    _sorted = sorted(_values)
+    assert (_sketch.count, _sketch.max) == (len(_values), _sorted[-1])
+    for _quantile in (0.01, 0.25, 0.5, 0.9, 0.95, 0.99, 0.999, 1.0):
+        _exact = _sorted[int(_quantile * (len(_sorted) - 1))]
+        assert abs(_sketch.quantile(_quantile) - _exact) <= GetIOStats.SKETCH_ACCURACY * _exact * (1 + 1e-9)
+
+
+@pytest.mark.skipif(GetIOStats.numpy is None, reason="NumPy is not installed")
+def test_sample_store_numpy_matches_array(monkeypatch):
+
+    # Small chunks for the references carried between chunks, a counter reset to be left out
+    _samples = [GetIOStats.parse_io_stat(x) for x in GetIOStatsBench.generate_samples(4, 14, 4 * 500, False)]
+    _samples[4 * 250].counters = [0] * 11
+
+    def compute_rows():
+        _store = GetIOStats.SampleStore(False, 97)
+        _rows = []
+        for _sample in _samples:
+            if _store.append(_sample, _sample.device):
+                _rows += _store.compute_rows(_sample.device, 512)
+        for _device in sorted(_store.summaries):
+            _rows += _store.compute_rows(_device, 512)
+        return _rows, GetIOStats.format_io_summary(sorted(_store.summaries.items()))
+
+    _numpy = compute_rows()
+    monkeypatch.setattr(GetIOStats, "numpy", None)
+    _array = compute_rows()
+    assert len(_numpy[0]) == 4 * 499 - 1
+    assert _numpy == _array
+
+
+def test_query_index_matches_scan(fixture_root, monkeypatch):
+
+    monkeypatch.setattr(GetIOStats, "LOG_INDEX_ROWS", 7)
+    GetIOStats.compute_io_stats_all_disks(GetIOStatsBench.generate_samples(12, 14, 12 * 300, False), "all", 1)
+    _paths = [read_log("*_all_*.log")[0], read_log("*_sdc_*.log")[0]]
+    _queries = [(_path, _from, _to, _filter) for _path in _paths
+                for _from, _to in ((None, None), ("00:00:01.000", "00:00:03.500"), ("00:00:02.025", "00:00:02.025"), ("00:00:06.990", None), ("00:00:09", None))
+                for _filter in (None, "sdc", "sd[ab]", "re:^sd[c-e]$")]
+
+    def run_queries():
+        _results = []
+        for _query in _queries:
+            _output = io.BytesIO()
+            _results.append((GetIOStats.query_log(*(_query + (_output,))), _output.getvalue()))
+        return _results
+
+    _indexed = run_queries()
+    for _path in _paths:
+        os.remove(_path + ".idx")
+    _scanned = run_queries()
+    assert sum(x[0] for x in _indexed) > 0
+    assert _indexed == _scanned
+
+
+def scrape_metrics(arg_port):
+    with urllib.request.urlopen("http://127.0.0.1:%d/metrics" % arg_port) as f:
+        return f.headers["Content-Type"], f.read().decode("utf-8")
+
+
+def parse_metrics(arg_text):
+
+    # {(name, labels): value}, every sample of a declared family and every family declared once
+    assert arg_text.endswith("\n# EOF\n")
+    _types = {}
+    _samples = {}
+    for line in arg_text.splitlines()[:-1]:
+        if line.startswith("#"):
+            _fields = line.split(" ", 3)
+            assert _fields[1] in ("TYPE", "UNIT", "HELP") and len(_fields) >= 4, line
+            if _fields[1] == "TYPE":
+                assert _fields[2] not in _types and _fields[3] in ("counter", "gauge"), line
+                _types[_fields[2]] = _fields[3]
+            else:
+                assert _fields[2] in _types, line
+            continue
+        _match = re.match(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{device="[^"]+"\})? (\S+)$', line)
+        assert _match is not None, line
+        _name = _match.group(1)
+        _family = _name[:-len("_total")] if _name.endswith("_total") else _name
+        assert _types.get(_family) == ("counter" if _family != _name else "gauge"), line
+        _samples[(_name, _match.group(2))] = float(_match.group(3))
+    return _samples
+
+
+def test_exporter_scrapes(fixture_root):
+
+    _scheduler = GetIOStats.TickScheduler(0.01)
+    _exporter = GetIOStats.OpenMetricsExporter(_scheduler, "all", ("127.0.0.1", 0))
+    _port = _exporter._server.server_address[1]
+    try:
+        for _tick in range(2):
+            _exporter.append_tick(1000000000 + _tick * 10000000, [GetIOStatsBench.diskstats_line(i, 1000 + _tick, 14) for i in range(12)])
+        _type, _first = scrape_metrics(_port)
+        _exporter.append_tick(1020000000, [GetIOStatsBench.diskstats_line(i, 1005, 14) for i in range(12)])
+        _second = scrape_metrics(_port)[1]
+    finally:
+        _exporter.close()
+
+    assert _type.startswith("application/openmetrics-text")
+    _before = parse_metrics(_first)
+    _after = parse_metrics(_second)
+    _counters = [x for x in _after if x[0].endswith("_total") and x[1] is not None]
+    assert len(_counters) == 12 * len(GetIOStats.EXPORT_COUNTERS)
+    assert all(_after[x] >= _before[x] for x in _counters)
+    assert _after[("getiostats_reads_total", '{device="sdb"}')] > _before[("getiostats_reads_total", '{device="sdb"}')]
+    # sdb: 4 reads per tick, 4 ticks in 10ms
+    assert _after[("getiostats_read_iops", '{device="sdb"}')] == 1600.0
+    assert _after[("getiostats_ticks_total", None)] == _scheduler.ticks
+
+
+def read_log_rows(arg_path):
+    # [{column: value}] of the rows of a log
+    with GetIOStats.open_log(arg_path, "r") as f:
+        _header = f.readline().rstrip("\n").split(";")
+        return [dict(zip(_header, x.rstrip("\n").split(";"))) for x in f]
+
+
+def test_resample_bucket_sums(fixture_root):
+
+    # Rows from 00:00:00.400 to 00:00:04.975, 25ms apart, in 300ms buckets: the first and last
+    # buckets only hold 8 rows and start on the bucket grid, the sums are the ones of the rows
+    GetIOStats.compute_io_stats_all_disks(GetIOStatsBench.generate_samples(12, 14, 12 * 200, False)[12 * 15:], "all", 1)
+    _all = read_log("*_all_*.log")[0]
+    _rows = read_log_rows(_all)
+    _deltas = [x for x in _rows[0] if x.startswith("delta ") or x == "total MBytes"]
+    _expected = {}
+    for _row in _rows:
+        _sums = _expected.setdefault((_row["device"], int(_row["time (ms)"]) // 300 * 300), [0] + [0.0] * len(_deltas))
+        _sums[0] += 1
+        for i, _column in enumerate(_deltas):
+            _sums[i + 1] += float(_row[_column])
+
+    _buckets = read_log_rows(GetIOStats.resample_log(_all, 0.3))
+    assert len(_buckets) == len(_expected) == 12 * 16
+    for _bucket in _buckets:
+        _sums = _expected[(_bucket["device"], int(_bucket["time (ms)"]))]
+        assert int(_bucket["rows"]) == _sums[0]
+        assert [float(_bucket[x + " sum"]) for x in _deltas] == pytest.approx(_sums[1:], abs=0.005)
+    _sda = [x for x in _buckets if x["device"] == "sda"]
+    assert [(x["time UTC"], x["rows"]) for x in (_sda[0], _sda[1], _sda[-1])] == [("'00:00:00.300", "8"), ("'00:00:00.600", "12"), ("'00:00:04.800", "8")]
+
+
+def write_host_log(arg_path, arg_rows):
+    # _all_ log of (device, ms) rows, counters left at 0
+    with open(arg_path, "w") as f:
+        f.write(GetIOStats.OUTPUT_HEADER + ";sector size\n")
+        for _device, _ms in arg_rows:
+            f.write("2024-01-01;'%02d:%02d:%02d.%03d;%s;%d;" % (_ms // 3600000, _ms // 60000 % 60, _ms // 1000 % 60, _ms % 1000, _device, _ms)
+                    + ";".join(["0"] * (GetIOStats.OUTPUT_HEADER.count(";") - 3)) + ";512\n")
+
+
+@pytest.mark.parametrize("arg_align", [None, 0.025])
+def test_merge_order(fixture_root, arg_align):
+
+    # node2 given first, node1 7ms later: rows in time order, rows of the same time in the order of
+    # the logs given then of the devices in each log, and with --align 0.025 the times of node1
+    # rounded down to the 25ms grid of node2
+    write_host_log("node2_all_2024-01-01_00-00-00.log", [("sdb", x) for x in (1000, 1025, 1050)] + [("sda", x) for x in (1000, 1025, 1050)])
+    write_host_log("node1_all_2024-01-01_00-00-00.log", [("sda", x) for x in (1007, 1032, 1057)])
+    GetIOStats.merge_logs(["node2_all_2024-01-01_00-00-00.log", "node1_all_2024-01-01_00-00-00.log"], arg_align, "merged.log")
+    _rows = [(x["host"], x["device"], x["time (ms)"], x["time UTC"]) for x in read_log_rows("merged.log")]
+    _expected = []
+    for _ms in (1000, 1025, 1050):
+        _expected += [("node2", "sdb", _ms), ("node2", "sda", _ms), ("node1", "sda", _ms if arg_align else _ms + 7)]
+    assert _rows == [(x[0], x[1], str(x[2]), "'00:00:%02d.%03d" % (x[2] // 1000, x[2] % 1000)) for x in _expected]
+
+
+def run_log_tools(arg_samples):
+
+    # Decompressed bytes of the _all_ log, of its resampling, of a merge and of a query
+    GetIOStats.compute_io_stats_all_disks(arg_samples, "all", 1)
+    _all = read_log("*_all_*" + GetIOStats.log_path(".log"))[0]
+    _sdb = read_log("*_sdb_*" + GetIOStats.log_path(".log"))[0]
+    _resampled = GetIOStats.resample_log(_all, 0.1)
+    _merged = GetIOStats.log_path("merged.log")
+    GetIOStats.merge_logs([_all, _sdb], None, _merged)
+    _query = io.BytesIO()
+    GetIOStats.query_log(_all, "00:00:01.000", "00:00:02.000", "sd[b-d]", _query)
+    _outputs = []
+    for _path in (_all, _resampled, _merged):
+        assert _path.endswith(GetIOStats.log_path(".log"))
+        with GetIOStats.open_log(_path, "rb") as f:
+            _outputs.append(f.read())
+    return _outputs + [_query.getvalue()]
+
+
+@pytest.mark.parametrize("arg_codec", [x[0] for x in GetIOStats.LOG_CODECS])
+def test_compressed_logs_round_trip(fixture_root, tmp_path, monkeypatch, arg_codec):
+
+    _samples = GetIOStatsBench.generate_samples(12, 14, 12 * 200, False)
+    _outputs = []
+    for _codec in (None, arg_codec):
+        monkeypatch.setattr(GetIOStats, "log_compression", _codec)
+        _directory = tmp_path / ("codec_" + str(_codec))
+        _directory.mkdir()
+        monkeypatch.chdir(_directory)
+        _outputs.append(run_log_tools(_samples))
+    assert all(len(x) > 1000 for x in _outputs[0])
+    assert _outputs[0] == _outputs[1]
+
+
+def test_adaptive_duration_ticks(fixture_root):
+
+    # Quiet devices: the base interval all along, and as many ticks as without -a at that interval
+    _fixed = GetIOStats.Collector("all", 0.05, 0.25)
+    _adaptive = GetIOStats.Collector("all", 0.01, 0.25, GetIOStats.AdaptiveOptions(0.05, 100, None, None, 5))
+    assert len(list(_fixed.ticks())) == 6
+    assert len(list(_adaptive.ticks())) == 6
+    assert _adaptive.adaptive.bursts == 0
+
+
+def test_adaptive_burst_and_cooldown():
+
+    # 5 I/Os per counter step over 10ms ticks: 10 steps are 5000 IOPS, above 1000
+    _scheduler = GetIOStats.TickScheduler(0.01)
+    _adaptive = GetIOStats.AdaptiveRate(_scheduler, "all", 0.01, GetIOStats.AdaptiveOptions(1.0, 1000, None, 2, 0.05))
+    assert _scheduler.intervalNs == 1000000000
+    _step = 1000
+    _states = []
+    for _tick, _increment in enumerate((0, 0, 10, 10, 0, 0, 0, 0, 0, 0, 1)):
+        _step += _increment
+        _adaptive.update(1000000000 + _tick * 10000000, [GetIOStatsBench.diskstats_line(0, _step, 14)])
+        _states.append((_adaptive.burst, _scheduler.intervalNs))
+    _burst, _base = (True, 10000000), (False, 1000000000)
+    # Above at 20 and 30ms, back to the base interval 50ms after the last tick above
+    assert _states == [_base, _base, _burst, _burst, _burst, _burst, _burst, _burst, _base, _base, _base]
+    assert _adaptive.bursts == 1
+    assert _adaptive.burstNs == 60000000
+
+    # I/Os in flight (sdc: 2) cross the threshold without any rate
+    _adaptive.update(1110000000, [GetIOStatsBench.diskstats_line(2, 1000, 14)])
+    assert _adaptive.burst and _adaptive.bursts == 2